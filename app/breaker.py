@@ -0,0 +1,94 @@
+import time
+from collections import deque
+from typing import Deque, List
+from . import metrics
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitBreaker:
+    """Fails storage calls fast while Neo4j is erroring or slow.
+
+    Outcomes are counted in one-second buckets over the last `window_s`. Once
+    at least `min_calls` were made, the breaker opens when the share of failed
+    calls reaches `error_rate` or the share of calls slower than `slow_call_s`
+    reaches `slow_rate`. While open, `allow()` is false. After `open_s` it lets
+    `half_open_calls` probes through: a successful probe closes it, a failed or
+    slow one opens it again.
+
+    Callers pair every true `allow()` with one `record()`. Single event loop,
+    no locking.
+    """
+    def __init__(self, window_s: float = 30.0, min_calls: int = 20, error_rate: float = 0.5,
+                 slow_call_s: float = 2.0, slow_rate: float = 0.8, open_s: float = 15.0, half_open_calls: int = 1):
+        self.window_s = window_s
+        self.min_calls = max(1, min_calls)
+        self.error_rate = error_rate
+        self.slow_call_s = slow_call_s
+        self.slow_rate = slow_rate
+        self.open_s = open_s
+        self.half_open_calls = max(1, half_open_calls)
+        self.state = CLOSED
+        self._buckets: Deque[List[int]] = deque()  # [second, calls, failures, slow]
+        self._opened_at = 0.0
+        self._probes = 0
+
+    def _move(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        self._probes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state != HALF_OPEN:
+            self._buckets.clear()
+        metrics.BREAKER_STATE.set(STATE_VALUES[state])
+        metrics.BREAKER_TRANSITIONS.labels(state=state).inc()
+
+    def _trim(self, now: float):
+        while self._buckets and self._buckets[0][0] <= now - self.window_s:
+            self._buckets.popleft()
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker lets a probe through (0 when it would now)."""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_s - time.monotonic())
+
+    def is_open(self) -> bool:
+        return self.state == OPEN and self.retry_in() > 0
+
+    def allow(self) -> bool:
+        if self.state == OPEN and self.retry_in() <= 0:
+            self._move(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+        elif self.state == CLOSED:
+            return True
+        metrics.BREAKER_REJECTED.inc()
+        return False
+
+    def record(self, ok: bool, seconds: float):
+        slow = seconds >= self.slow_call_s
+        if self.state == HALF_OPEN:
+            self._move(OPEN if not ok or slow else CLOSED)
+            return
+        if self.state == OPEN:
+            return  # allowed before the breaker opened
+        now = time.monotonic()
+        second = int(now)
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0, 0])
+        b = self._buckets[-1]
+        b[1] += 1
+        b[2] += not ok
+        b[3] += slow
+        self._trim(now)
+        calls = sum(b[1] for b in self._buckets)
+        if calls < self.min_calls:
+            return
+        if sum(b[2] for b in self._buckets) >= self.error_rate * calls or \
+                sum(b[3] for b in self._buckets) >= self.slow_rate * calls:
+            self._move(OPEN)
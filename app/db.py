@@ -1,18 +1,88 @@
-from typing import Optional, Dict, Any
-from neo4j import GraphDatabase, Driver
+import asyncio
+from typing import Optional, Dict, Any, Iterable, List, Set, Tuple
+from neo4j import GraphDatabase, AsyncGraphDatabase, Driver, AsyncDriver
 from .settings import settings
+from .dedup import RecentUids
+from .tilecache import TileCache
+from .simplify import track_buckets
+from . import metrics, worker
 
 _driver: Optional[Driver] = None
+_async_driver: Optional[AsyncDriver] = None
+recent_uids = RecentUids(settings.DEDUP_CACHE_SIZE, settings.DEDUP_CACHE_TTL_S)
+spatial_cache = TileCache(settings.QUERY_CACHE_SIZE, settings.QUERY_CACHE_TTL_S,
+                          settings.QUERY_CACHE_TILE_ZOOM, settings.QUERY_CACHE_MAX_TILES,
+                          settings.QUERY_CACHE_MAX_ROWS, settings.QUERY_CACHE_MAX_RESULT_ROWS)
+
+def _driver_config() -> Dict[str, Any]:
+    return {
+        "max_connection_pool_size": settings.NEO4J_MAX_POOL_SIZE,
+        "connection_acquisition_timeout": settings.NEO4J_ACQUISITION_TIMEOUT,
+        "max_connection_lifetime": settings.NEO4J_MAX_CONNECTION_LIFETIME,
+    }
 
 def get_driver() -> Driver:
+    """Blocking driver, used by the scripts."""
     global _driver
     if _driver is None:
         _driver = GraphDatabase.driver(
             settings.NEO4J_URI,
             auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD),
+            **_driver_config(),
         )
     return _driver
 
+def close_driver():
+    global _driver
+    if _driver is not None:
+        _driver.close()
+        _driver = None
+
+def get_async_driver() -> AsyncDriver:
+    """asyncio driver, used by the API so DB writes never block the event loop."""
+    global _async_driver
+    if _async_driver is None:
+        _async_driver = AsyncGraphDatabase.driver(
+            settings.NEO4J_URI,
+            auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD),
+            **_driver_config(),
+        )
+    return _async_driver
+
+def after_fork():
+    """In a forked child: drop (never close) drivers inherited from the parent;
+    their connections belong to it. New ones are made on first use."""
+    global _driver, _async_driver
+    _driver = _async_driver = None
+
+worker.on_fork(after_fork)
+
+async def warm_async_pool(connections: int, timeout_s: float) -> int:
+    """Open up to `connections` pooled connections before the worker takes traffic.
+
+    Returns how many succeeded; a database that is down only costs `timeout_s`.
+    """
+    if connections <= 0:
+        return 0
+    driver = get_async_driver()
+
+    async def one():
+        async with driver.session(database=settings.NEO4J_DATABASE) as s:
+            await (await s.run("RETURN 1")).consume()
+
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*(one() for _ in range(connections)), return_exceptions=True),
+                                         timeout_s)
+    except asyncio.TimeoutError:
+        return 0
+    return sum(1 for r in results if not isinstance(r, BaseException))
+
+async def close_async_driver():
+    global _async_driver
+    if _async_driver is not None:
+        await _async_driver.close()
+        _async_driver = None
+
 UPSERT_CYPHER = """MERGE (p:PhoneLog {uid: $uid})
 ON CREATE SET
   p.created_at = timestamp(),
@@ -59,13 +129,259 @@ FOREACH (_ IN CASE WHEN $device_id IS NOT NULL THEN [1] ELSE [] END |
 RETURN p.uid AS uid
 """
 
+PARAM_KEYS = [
+    "uid","user_id","device_id","geom_type","coordinates","longitude","latitude",
+    "timestamp","epoch_millis","speed","battery_state","motion","battery_level",
+    "vertical_accuracy","horizontal_accuracy","pauses","wifi","deferred",
+    "significant_change","locations_in_payload","activity","altitude","desired_accuracy"
+]
+
+# Same properties as UPSERT_CYPHER, driven by one row per point so a whole
+# ingest request is a single round trip / transaction. User/Device nodes must
+# already exist (see ENSURE_OWNERS_CYPHER): they are looked up instead of
+# MERGEd, and relationships of points created by this statement (flagged by a
+# property that never outlives the transaction) are CREATEd outright.
+# Rows must have distinct uids (see _dedupe_rows).
+UPSERT_BATCH_CYPHER = """UNWIND $rows AS row
+MERGE (p:PhoneLog {uid: row.uid})
+ON CREATE SET
+  p.created_at = timestamp(),
+  p.schema_version = 1,
+  p._created = true
+SET
+  p.user_id = row.user_id,
+  p.device_id = row.device_id,
+  p.geom_type = row.geom_type,
+  p.coordinates = row.coordinates,
+  p.longitude = row.longitude,
+  p.latitude = row.latitude,
+  p.timestamp = row.timestamp,
+  p.epoch_millis = row.epoch_millis,
+  p.speed = row.speed,
+  p.battery_state = row.battery_state,
+  p.motion = row.motion,
+  p.battery_level = row.battery_level,
+  p.vertical_accuracy = row.vertical_accuracy,
+  p.horizontal_accuracy = row.horizontal_accuracy,
+  p.pauses = row.pauses,
+  p.wifi = row.wifi,
+  p.deferred = row.deferred,
+  p.significant_change = row.significant_change,
+  p.locations_in_payload = row.locations_in_payload,
+  p.activity = row.activity,
+  p.altitude = row.altitude,
+  p.desired_accuracy = row.desired_accuracy,
+  p.loc = CASE
+            WHEN row.latitude IS NOT NULL AND row.longitude IS NOT NULL
+            THEN point({latitude: toFloat(row.latitude), longitude: toFloat(row.longitude), crs: 'wgs-84'})
+            ELSE p.loc
+          END,
+  p.updated_at = timestamp(),
+  p.normalized = true
+WITH p, row, coalesce(p._created, false) AS is_new
+REMOVE p._created
+WITH p, row, is_new
+OPTIONAL MATCH (u:User {id: row.user_id})
+OPTIONAL MATCH (d:Device {id: row.device_id})
+FOREACH (_ IN CASE WHEN u IS NOT NULL AND is_new THEN [1] ELSE [] END |
+  CREATE (p)-[:BY_USER]->(u)
+)
+FOREACH (_ IN CASE WHEN u IS NOT NULL AND NOT is_new THEN [1] ELSE [] END |
+  MERGE (p)-[:BY_USER]->(u)
+)
+FOREACH (_ IN CASE WHEN d IS NOT NULL AND is_new THEN [1] ELSE [] END |
+  CREATE (p)-[:FROM_DEVICE]->(d)
+)
+FOREACH (_ IN CASE WHEN d IS NOT NULL AND NOT is_new THEN [1] ELSE [] END |
+  MERGE (p)-[:FROM_DEVICE]->(d)
+)
+RETURN count(p) AS n
+"""
+
+ENSURE_OWNERS_CYPHER = """FOREACH (id IN $users | MERGE (:User {id: id}))
+FOREACH (id IN $devices | MERGE (:Device {id: id}))
+"""
+
+# Coarse tracks, maintained with every write: one TrackBucket per device,
+# resolution (TRACK_BUCKET_LEVELS_S) and time bucket, holding the bucket's
+# first point. "First" is a minimum, so replays and out-of-order arrivals
+# converge on the same node contents.
+TRACK_BUCKETS_CYPHER = """UNWIND $buckets AS b
+MERGE (t:TrackBucket {key: b.key})
+ON CREATE SET
+  t.device_id = b.device_id, t.user_id = b.user_id, t.res_s = b.res_s, t.bucket_ms = b.bucket_ms, t.day = b.day,
+  t.uid = b.uid, t.epoch_millis = b.epoch_millis, t.longitude = b.longitude, t.latitude = b.latitude
+WITH t, b
+WHERE b.epoch_millis < t.epoch_millis OR (b.epoch_millis = t.epoch_millis AND b.uid < t.uid)
+SET t.uid = b.uid, t.epoch_millis = b.epoch_millis, t.longitude = b.longitude, t.latitude = b.latitude
+"""
+
+# User/Device ids this process has already ensured; a handful of users and a
+# few hundred devices, so plain sets.
+_known_users: Set[str] = set()
+_known_devices: Set[str] = set()
+
+def _params(record: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: record.get(k) for k in PARAM_KEYS}
+
+def _chunks(rows: List[Dict[str, Any]], size: int) -> Iterable[List[Dict[str, Any]]]:
+    size = max(1, size)
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+def _dedupe_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # last write wins, as it would with one MERGE per row
+    return list({r["uid"]: r for r in rows}.values())
+
+def _new_owners(rows: List[Dict[str, Any]]) -> Tuple[List[str], List[str]]:
+    users = {r["user_id"] for r in rows if r["user_id"] is not None} - _known_users
+    devices = {r["device_id"] for r in rows if r["device_id"] is not None} - _known_devices
+    return sorted(users), sorted(devices)
+
+def _owners_known(users: List[str], devices: List[str]):
+    # only after commit, so a rolled back MERGE is retried next time
+    _known_users.update(users)
+    _known_devices.update(devices)
+
+def _write_rows(tx, rows: List[Dict[str, Any]], users: List[str], devices: List[str]) -> int:
+    if users or devices:
+        tx.run(ENSURE_OWNERS_CYPHER, users=users, devices=devices).consume()
+    n = tx.run(UPSERT_BATCH_CYPHER, rows=rows).single()["n"]
+    buckets = track_buckets(rows, settings.TRACK_BUCKET_LEVELS_S)
+    if buckets:
+        tx.run(TRACK_BUCKETS_CYPHER, buckets=buckets).consume()
+    return n
+
+async def _write_rows_async(tx, rows: List[Dict[str, Any]], users: List[str], devices: List[str]) -> int:
+    if users or devices:
+        await (await tx.run(ENSURE_OWNERS_CYPHER, users=users, devices=devices)).consume()
+    res = await tx.run(UPSERT_BATCH_CYPHER, rows=rows)
+    n = (await res.single())["n"]
+    buckets = track_buckets(rows, settings.TRACK_BUCKET_LEVELS_S)
+    if buckets:
+        await (await tx.run(TRACK_BUCKETS_CYPHER, buckets=buckets)).consume()
+    return n
+
 def upsert_phonelog(record: Dict[str, Any]) -> str:
-    params = {k: record.get(k) for k in [
-        "uid","user_id","device_id","geom_type","coordinates","longitude","latitude",
-        "timestamp","epoch_millis","speed","battery_state","motion","battery_level",
-        "vertical_accuracy","horizontal_accuracy","pauses","wifi","deferred",
-        "significant_change","locations_in_payload","activity","altitude","desired_accuracy"
-    ]}
+    params = _params(record)
     with get_driver().session(database=settings.NEO4J_DATABASE) as s:
         res = s.run(UPSERT_CYPHER, **params)
         return res.single()["uid"]
+
+def upsert_phonelog_batch(records: List[Dict[str, Any]], chunk_size: Optional[int] = None) -> List[str]:
+    """Upsert many normalized points with one UNWIND statement per chunk.
+
+    Each chunk is its own managed write transaction (retried by the driver on
+    transient errors); requests up to NEO4J_BATCH_SIZE points are one round trip.
+    """
+    if not records:
+        return []
+    rows = [_params(r) for r in records]
+    with get_driver().session(database=settings.NEO4J_DATABASE) as s:
+        for chunk in _chunks(_dedupe_rows(rows), chunk_size or settings.NEO4J_BATCH_SIZE):
+            users, devices = _new_owners(chunk)
+            s.execute_write(_write_rows, chunk, users, devices)
+            _owners_known(users, devices)
+    return [r["uid"] for r in rows]
+
+async def upsert_phonelog_batch_async(records: List[Dict[str, Any]], chunk_size: Optional[int] = None) -> List[str]:
+    """Async twin of `upsert_phonelog_batch` on the asyncio driver.
+
+    Points already written by this process with identical contents (see
+    `recent_uids`) are acknowledged without a round trip. Cached spatial
+    results covering written points are invalidated (see `spatial_cache`).
+    """
+    if not records:
+        return []
+    rows = [_params(r) for r in records]
+    fresh, hashes = recent_uids.split(_dedupe_rows(rows))
+    if fresh:
+        size = max(1, chunk_size or settings.NEO4J_BATCH_SIZE)
+        async with get_async_driver().session(database=settings.NEO4J_DATABASE) as s:
+            for i, chunk in enumerate(_chunks(fresh, size)):
+                users, devices = _new_owners(chunk)
+                with metrics.STAGE_LATENCY.labels(stage="db_write").time():
+                    await s.execute_write(_write_rows_async, chunk, users, devices)
+                _owners_known(users, devices)
+                recent_uids.remember(chunk, hashes[i * size:(i + 1) * size])
+                spatial_cache.invalidate(chunk)
+    return [r["uid"] for r in rows]
+
+# -- read side -------------------------------------------------------------------
+#
+# Points of one device or user in a time range, in (epoch_millis, uid) order,
+# one page per call. Pages are keyset-paginated: the next page starts after the
+# last (epoch_millis, uid) seen, so the composite (device_id|user_id,
+# epoch_millis) indexes seek straight to it instead of skipping rows.
+
+POINT_FIELDS = [
+    "uid","user_id","device_id","timestamp","epoch_millis","longitude","latitude",
+    "speed","battery_level","battery_state","motion","horizontal_accuracy","vertical_accuracy",
+    "altitude","activity","wifi",
+]
+
+_POINTS_CYPHER = """MATCH (p:PhoneLog)
+WHERE p.{key} = $owner AND p.epoch_millis >= $lo AND p.epoch_millis <= $hi
+  AND (p.epoch_millis > $after_ms OR p.uid > $after_uid)
+RETURN p {{{fields}}} AS point
+ORDER BY p.epoch_millis, p.uid
+LIMIT $limit
+"""
+
+POINTS_CYPHER = {
+    key: _POINTS_CYPHER.format(key=key, fields=", ".join("." + f for f in POINT_FIELDS))
+    for key in ("device_id", "user_id")
+}
+
+# the same page over a device's TrackBucket nodes of one resolution
+TRACK_CYPHER = """MATCH (t:TrackBucket)
+WHERE t.device_id = $owner AND t.res_s = $res_s AND t.epoch_millis >= $lo AND t.epoch_millis <= $hi
+  AND (t.epoch_millis > $after_ms OR t.uid > $after_uid)
+RETURN t {.uid, .user_id, .device_id, .epoch_millis, .longitude, .latitude} AS point
+ORDER BY t.epoch_millis, t.uid
+LIMIT $limit
+"""
+
+async def _read_points(tx, query: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    res = await tx.run(query, **params)
+    return [r["point"] async for r in res]
+
+async def read_points_page(key: str, owner: str, lo: int, hi: int, after_ms: int, after_uid: str,
+                           limit: int, res_s: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Up to `limit` points of owner (`key` is device_id or user_id) with lo <= epoch_millis <= hi,
+    after (after_ms, after_uid). With `res_s`, the device's TrackBucket points of that resolution."""
+    params = {"owner": owner, "lo": lo, "hi": hi, "after_ms": after_ms, "after_uid": after_uid, "limit": limit}
+    query = POINTS_CYPHER[key]
+    if res_s is not None:
+        query, params["res_s"] = TRACK_CYPHER, res_s
+    async with get_async_driver().session(database=settings.NEO4J_DATABASE) as s:
+        with metrics.STAGE_LATENCY.labels(stage="db_read").time():
+            return await s.execute_read(_read_points, query, params)
+
+# Points in an area, optionally within a time window and for one user/device,
+# in (epoch_millis, uid) order. The area predicates are served by the POINT
+# index on p.loc.
+
+_SPATIAL_CYPHER = """MATCH (p:PhoneLog)
+WHERE {area}
+  AND ($since IS NULL OR p.epoch_millis >= $since) AND ($until IS NULL OR p.epoch_millis <= $until)
+  AND ($user_id IS NULL OR p.user_id = $user_id) AND ($device_id IS NULL OR p.device_id = $device_id)
+RETURN p {{{fields}}} AS point
+ORDER BY p.epoch_millis, p.uid
+LIMIT $limit
+"""
+
+SPATIAL_CYPHER = {
+    kind: _SPATIAL_CYPHER.format(area=area, fields=", ".join("." + f for f in POINT_FIELDS))
+    for kind, area in (
+        ("bbox", "point.withinBBox(p.loc, point({longitude: $min_lon, latitude: $min_lat, crs: 'wgs-84'}), "
+                 "point({longitude: $max_lon, latitude: $max_lat, crs: 'wgs-84'}))"),
+        ("near", "point.distance(p.loc, point({longitude: $lon, latitude: $lat, crs: 'wgs-84'})) <= $radius_m"),
+    )
+}
+
+async def read_spatial(kind: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Points matching SPATIAL_CYPHER[kind] ("bbox" or "near")."""
+    async with get_async_driver().session(database=settings.NEO4J_DATABASE) as s:
+        with metrics.STAGE_LATENCY.labels(stage="db_read").time():
+            return await s.execute_read(_read_points, SPATIAL_CYPHER[kind], params)
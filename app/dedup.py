@@ -0,0 +1,68 @@
+import json, time, hashlib, threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from . import metrics
+
+def content_hash(row: Dict[str, Any]) -> bytes:
+    """Digest of every property written for a point; any change gives a new hash."""
+    return hashlib.blake2b(json.dumps(row, separators=(",", ":"), default=str).encode("utf-8"), digest_size=16).digest()
+
+class RecentUids:
+    """Bounded LRU of uids recently written to Neo4j, with the content hash they were written with.
+
+    A row is only skipped when its uid was written less than `ttl_s` seconds ago
+    with identical contents; anything else goes to the database. Rows are
+    remembered only after their transaction committed.
+    """
+    def __init__(self, capacity: int, ttl_s: float):
+        self.capacity = capacity
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def split(self, rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[bytes]]:
+        """(rows that must be written, content hashes of those rows)."""
+        if self.capacity <= 0:
+            return rows, []
+        now = time.monotonic()
+        fresh, hashes = [], []
+        hits = 0
+        with self._lock:
+            for row in rows:
+                h = content_hash(row)
+                seen = self._entries.get(row["uid"])
+                if seen is not None and seen[0] == h and now - seen[1] < self.ttl_s:
+                    self._entries.move_to_end(row["uid"])  # LRU: a resent point stays cached
+                    hits += 1
+                    continue
+                fresh.append(row)
+                hashes.append(h)
+        if hits:
+            metrics.DEDUP_HITS.inc(hits)
+        if fresh:
+            metrics.DEDUP_MISSES.inc(len(fresh))
+        return fresh, hashes
+
+    def remember(self, rows: List[Dict[str, Any]], hashes: List[bytes]):
+        if self.capacity <= 0:
+            return
+        now = time.monotonic()
+        evicted = 0
+        with self._lock:
+            entries = self._entries
+            for row, h in zip(rows, hashes):
+                uid = row["uid"]
+                entries[uid] = (h, now)
+                entries.move_to_end(uid)
+            while len(entries) > self.capacity:
+                entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            metrics.DEDUP_EVICTIONS.inc(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,71 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+try:  # optional C decoder; the stdlib parser gives identical results
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+class BodyError(ValueError):
+    """Raised with FastAPI/pydantic-style error entries ({"loc", "msg", "type"})."""
+    def __init__(self, errors: List[Dict[str, Any]]):
+        super().__init__(errors)
+        self.errors = errors
+
+def loads(body: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _as_str(data: Dict[str, Any], field: str, errors: List[Dict[str, Any]]) -> Optional[str]:
+    # pydantic v1 `Optional[str]`: str as is, numbers coerced, anything else rejected
+    v = data.get(field)
+    if v is None or isinstance(v, str):
+        return v
+    if isinstance(v, (int, float)):
+        return str(v)
+    errors.append({"loc": ["body", field], "msg": "str type expected", "type": "type_error.str"})
+    return None
+
+def parse_ingest_body(body: bytes) -> Tuple[Dict[str, Any], Optional[str], Optional[str], List[Dict[str, Any]]]:
+    """Decode an /api/v1/locations body once and check only its structure.
+
+    Returns (document, user_id, device_id, location items). Errors mirror what
+    IngestPayload validation reports, so clients see the same 422 contract.
+    Items are passed through untouched; normalize_one is already tolerant of
+    their contents.
+    """
+    if not body:
+        raise BodyError([{"loc": ["body"], "msg": "field required", "type": "value_error.missing"}])
+    try:
+        data = loads(body)
+    except ValueError as e:
+        # same shape FastAPI produces for an undecodable body
+        raise BodyError([{
+            "type": "json_invalid", "loc": ["body", getattr(e, "pos", 0)], "msg": "JSON decode error",
+            "input": {}, "ctx": {"error": getattr(e, "msg", str(e))},
+        }])
+    if not isinstance(data, dict):
+        raise BodyError([{"loc": ["body"], "msg": "value is not a valid dict", "type": "type_error.dict"}])
+
+    errors: List[Dict[str, Any]] = []
+    user_id = _as_str(data, "user_id", errors)
+    device_id = _as_str(data, "device_id", errors)
+    locations = data.get("locations", [])
+    if locations is None:
+        errors.append({"loc": ["body", "locations"], "msg": "none is not an allowed value", "type": "type_error.none.not_allowed"})
+        locations = []
+    elif not isinstance(locations, list):
+        errors.append({"loc": ["body", "locations"], "msg": "value is not a valid list", "type": "type_error.list"})
+        locations = []
+    for i, item in enumerate(locations):
+        if not isinstance(item, dict):
+            errors.append({"loc": ["body", "locations", i], "msg": "value is not a valid dict", "type": "type_error.dict"})
+    if errors:
+        raise BodyError(errors)
+    return data, user_id, device_id, locations
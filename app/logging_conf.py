@@ -1,5 +1,11 @@
-import json, logging, sys
+import atexit, json, logging, queue, sys
 from logging import LogRecord
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+from . import metrics
+
+# attributes every LogRecord has; anything else came in through `extra=` and is logged as a field
+_RESERVED = set(vars(LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
 
 class JsonFormatter(logging.Formatter):
     def format(self, record: LogRecord) -> str:
@@ -9,13 +15,69 @@ class JsonFormatter(logging.Formatter):
             "message": record.getMessage(),
             "time": self.formatTime(record, datefmt="%Y-%m-%dT%H:%M:%S%z"),
         }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                payload[key] = value
         if record.exc_info:
             payload["exc_info"] = self.formatException(record.exc_info)
-        return json.dumps(payload, ensure_ascii=False)
+        elif record.exc_text:
+            payload["exc_info"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class NonBlockingHandler(QueueHandler):
+    """Hands records to the listener thread instead of writing stdout on the caller.
+
+    Only the message and traceback are rendered here (their args and frames may
+    change once the caller moves on); the JSON is built on the listener thread.
+    When the queue is full, records below ERROR are dropped and counted in
+    app_log_dropped_total; errors wait briefly for room.
+    """
+    def prepare(self, record: LogRecord) -> LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: LogRecord):
+        try:
+            self.queue.put(record, block=record.levelno >= logging.ERROR, timeout=0.1)
+        except queue.Full:
+            metrics.LOG_DROPPED.inc()
 
-def configure_logging(level: str = "INFO"):
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(JsonFormatter())
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel, timeout=5)  # behind a full queue, wait for the drain
+
+_listener: Optional[QueueListener] = None
+_config = ("INFO", 10_000)
+
+def configure_logging(level: str = "INFO", queue_size: int = 10_000):
+    global _listener, _config
+    stop_logging()
+    _config = (level, queue_size)
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonFormatter())
+    q: "queue.Queue[LogRecord]" = queue.Queue(queue_size)
+    _listener = _Listener(q, out)
+    _listener.start()
     root = logging.getLogger()
-    root.handlers = [handler]
+    root.handlers = [NonBlockingHandler(q)]
     root.setLevel(level)
+
+def stop_logging():
+    """Write out what is queued and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def after_fork():
+    # the listener thread stayed in the parent and the queue's lock may have
+    # been held at fork time: start over with a fresh queue and thread
+    global _listener
+    _listener = None
+    configure_logging(*_config)
+
+atexit.register(stop_logging)
@@ -1,18 +1,27 @@
-import os, json, gzip, time, pathlib, logging, uuid
+import os, time, logging, asyncio
 from fastapi import FastAPI, Request, Response, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from .settings import settings
-from .logging_conf import configure_logging
+from .logging_conf import configure_logging, after_fork as logging_after_fork
+from .middleware import RequestMiddleware
 from .models import IngestPayload
-from .normalizer import normalize_one
-from .db import upsert_phonelog, get_driver
-from . import metrics
+from .fastpath import parse_ingest_body, loads, BodyError
+from .normalizer import normalize_items
+from .db import upsert_phonelog_batch_async, warm_async_pool, close_async_driver
+from .wal import WalWriter, Framed
+from .stream import NdjsonIngest
+from .writebehind import WriteBehind
+from .breaker import CircuitBreaker
+from .query import PointQuery, FORMATS, ndjson_body, geojson_body, linestring_body, parse_when, spatial_points, render
+from .simplify import TrackShaper
+from . import metrics, worker
 from prometheus_client import generate_latest
 
 app = FastAPI(title=settings.APP_NAME)
-configure_logging(settings.LOG_LEVEL)
+configure_logging(settings.LOG_LEVEL, settings.LOG_QUEUE_SIZE)
+worker.on_fork(logging_after_fork)
 log = logging.getLogger("app")
 
 app.add_middleware(
@@ -23,84 +32,140 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.middleware("http")
-async def add_request_id(request: Request, call_next):
-    req_id = request.headers.get("x-request-id") or str(uuid.uuid4())
-    start = time.time()
-    try:
-        response = await call_next(request)
-    except Exception:
-        log.exception("Unhandled error")
-        path = request.url.path
-        method = request.method
-        metrics.REQUESTS.labels(path=path, method=method, status="500").inc()
-        metrics.REQ_LATENCY.labels(path=path, method=method).observe(time.time()-start)
-        return JSONResponse(status_code=500, content={"result": "error", "reason": "internal"})
-    duration = time.time()-start
-    response.headers["x-request-id"] = req_id
-    path = request.url.path
-    method = request.method
-    metrics.REQUESTS.labels(path=path, method=method, status=str(response.status_code)).inc()
-    metrics.REQ_LATENCY.labels(path=path, method=method).observe(duration)
-    log.info(json.dumps({"event":"request","path":path,"status":response.status_code,"ms":int(duration*1000),"rid":req_id}))
-    return response
-
-class WalWriter:
-    def __init__(self, root: str, rotate_bytes: int):
-        self.root = pathlib.Path(root)
-        self.root.mkdir(parents=True, exist_ok=True)
-        self.rotate_bytes = rotate_bytes
-        self._cur = None
-    def _open(self):
-        ts = time.strftime("%Y%m%d-%H%M%S")
-        path = self.root / f"events-{ts}.ndjson.gz"
-        self._cur = (path, gzip.open(path, "at", encoding="utf-8"))
-        log.info(f"WAL opened {path}")
-    def write(self, obj: Dict[str, Any]):
-        if self._cur is None:
-            self._open()
-        path, fh = self._cur
-        line = json.dumps(obj, ensure_ascii=False)
-        fh.write(line + "\n")
-        fh.flush()
-        try:
-            if path.stat().st_size >= self.rotate_bytes:
-                fh.close()
-                log.info(f"WAL rotating {path}")
-                self._cur = None
-        except FileNotFoundError:
-            pass
+app.add_middleware(
+    RequestMiddleware,
+    sample_rate=settings.ACCESS_LOG_SAMPLE_RATE,
+    slow_ms=settings.ACCESS_LOG_SLOW_MS,
+)
+
+wal = WalWriter(
+    settings.WAL_DIR,
+    settings.WAL_ROTATE_BYTES,
+    durability=settings.WAL_DURABILITY,
+    queue_size=settings.WAL_QUEUE_SIZE,
+    max_latency_ms=settings.WAL_MAX_LATENCY_MS,
+    group_max=settings.WAL_GROUP_MAX_RECORDS,
+    block_records=settings.WAL_BLOCK_RECORDS,
+    block_bytes=settings.WAL_BLOCK_BYTES,
+)
+worker.on_fork(wal.after_fork)
+
+breaker = CircuitBreaker(
+    window_s=settings.BREAKER_WINDOW_S,
+    min_calls=settings.BREAKER_MIN_CALLS,
+    error_rate=settings.BREAKER_ERROR_RATE,
+    slow_call_s=settings.BREAKER_SLOW_CALL_S,
+    slow_rate=settings.BREAKER_SLOW_RATE,
+    open_s=settings.BREAKER_OPEN_S,
+)
+
+write_behind = WriteBehind(
+    upsert_phonelog_batch_async,
+    os.path.join(settings.WAL_DIR, "spill"),
+    queue_points=settings.WRITE_BEHIND_QUEUE_POINTS,
+    high_water=settings.WRITE_BEHIND_HIGH_WATER,
+    batch_size=settings.NEO4J_BATCH_SIZE,
+    max_backoff_s=settings.WRITE_BEHIND_MAX_BACKOFF_S,
+    breaker=breaker,
+) if settings.INGEST_ACK_MODE == "wal" else None
 
-wal = WalWriter(settings.WAL_DIR, settings.WAL_ROTATE_BYTES)
+# INGEST_ACK_MODE=db: points the breaker turns away (or whose write failed) wait
+# here and are drained, paced, once Neo4j takes writes again
+pending = write_behind or WriteBehind(
+    upsert_phonelog_batch_async,
+    os.path.join(settings.WAL_DIR, "pending"),
+    queue_points=settings.WRITE_BEHIND_QUEUE_POINTS,
+    high_water=settings.WRITE_BEHIND_HIGH_WATER,
+    batch_size=settings.NEO4J_BATCH_SIZE,
+    max_backoff_s=settings.WRITE_BEHIND_MAX_BACKOFF_S,
+    breaker=breaker,
+    pace_points_s=settings.PENDING_DRAIN_POINTS_S,
+)
 
 @app.on_event("startup")
-def _startup():
-    get_driver()
+async def _startup():
+    # runs before the worker accepts connections
+    warmed = await warm_async_pool(settings.NEO4J_WARM_CONNECTIONS, settings.NEO4J_WARM_TIMEOUT_S)
+    if warmed < settings.NEO4J_WARM_CONNECTIONS:
+        log.warning(f"Neo4j pool warmed with {warmed}/{settings.NEO4J_WARM_CONNECTIONS} connections")
+    pending.start()
+    worker.ready()
     log.info("Startup complete")
 
+@app.on_event("shutdown")
+async def _shutdown():
+    await pending.stop()
+    await close_async_driver()
+    wal.close()
+    log.info("Shutdown complete")
+
 @app.get("/healthz")
 def healthz():
-    return {"status": "ok"}
+    return {"status": "ok", "worker": worker.status()}
 
 @app.get("/metrics")
 def metrics_endpoint():
     return Response(generate_latest(metrics.registry), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-@app.post("/api/v1/locations")
-async def create_locations(payload: IngestPayload, request: Request):
-    wal.write({"received_at": int(time.time()*1000), "payload": payload.dict()})
-    default_user = payload.user_id or settings.DEFAULT_USER_ID
-    default_device = payload.device_id
-
-    normalized: List[Dict[str, Any]] = []
-    dropped = 0
-    for item in payload.locations:
-        raw_item = item if isinstance(item, dict) else item.dict(by_alias=True)
-        norm = normalize_one(raw_item, default_user=default_user, default_device=default_device)
-        if norm is None:
-            dropped += 1
-            continue
-        normalized.append(norm)
+def _shed() -> Optional[JSONResponse]:
+    """503 while the write-behind / pending backlog is above its high-water mark."""
+    if not pending.overloaded():
+        return None
+    metrics.WB_SHED.inc()
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "5"},
+                        content={"result": "error", "reason": "ingest backlog, retry later"})
+
+def _parsed(request: Request):
+    metrics.STAGE_LATENCY.labels(stage="parse").observe(time.perf_counter() - request.state.started)
+
+async def _wal_write(request: Request, api: str, records: Optional[List[Dict[str, Any]]] = None):
+    """Log the request body as received, framed with a small header (see app/wal.py).
+
+    `records` are its normalized points; their owners go into the block index.
+    """
+    header = {"received_at": int(time.time()*1000), "api": api,
+              "content_type": request.headers.get("content-type"), "rid": request.state.request_id}
+    users = devices = None
+    if records is not None:
+        users, devices = {r["user_id"] for r in records}, {r["device_id"] for r in records}
+    body = await request.body()  # read already, and kept by Starlette
+    with metrics.STAGE_LATENCY.labels(stage="wal_write").time():
+        await wal.write_async(Framed(header, body, users, devices))
+
+async def _store(records: List[Dict[str, Any]]) -> bool:
+    """Write points through the breaker; False when they went to the pending spool instead.
+
+    The points are in the WAL already, so a refused, slow (DB_CALL_TIMEOUT_S) or
+    failed write is acknowledged as pending rather than failing the request.
+    """
+    if breaker.allow():
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(upsert_phonelog_batch_async(records), settings.DB_CALL_TIMEOUT_S)
+        except Exception:
+            breaker.record(False, time.perf_counter() - start)
+            metrics.DB_FAILURES.inc()
+            log.exception("Neo4j upsert failed; points kept as pending")
+        else:
+            breaker.record(True, time.perf_counter() - start)
+            return True
+    pending.offer(records)
+    metrics.PENDING_POINTS.inc(len(records))
+    return False
+
+def _db_down() -> Optional[JSONResponse]:
+    """503 for reads while the breaker is open, instead of waiting on the driver."""
+    if not breaker.is_open():
+        return None
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={"Retry-After": str(max(1, int(breaker.retry_in() + 0.5)))},
+                        content={"result": "error", "reason": "database unavailable, retry later"})
+
+async def _ingest(request: Request, raw_items: List[Dict[str, Any]], default_user: str, default_device: Optional[str]):
+    with metrics.STAGE_LATENCY.labels(stage="normalize").time():
+        normalized, dropped = normalize_items(raw_items, default_user=default_user, default_device=default_device)
+    metrics.INGEST_BATCH_POINTS.observe(len(normalized))
+    await _wal_write(request, "v1", normalized)  # durable before acknowledging or touching Neo4j
 
     if not normalized:
         return JSONResponse(
@@ -108,23 +173,240 @@ async def create_locations(payload: IngestPayload, request: Request):
             content={"result": "error", "reason": "no valid points (need timestamp + coordinates)"}
         )
 
-    uids = []
-    for rec in normalized:
-        try:
-            uid = upsert_phonelog(rec)
-            uids.append(uid)
-        except Exception:
-            metrics.DB_FAILURES.inc()
-            log.exception("Neo4j upsert failed")
-            return JSONResponse(status_code=500, content={"result": "error", "reason": "db failure"})
+    if write_behind is not None:
+        write_behind.offer(normalized)
+        if dropped:
+            metrics.DROPPED_POINTS.inc(dropped)
+        uids = [r["uid"] for r in normalized]
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                            content={"result": "accepted", "accepted": len(uids), "dropped": dropped, "uids": uids})
 
-    metrics.INGESTED_POINTS.inc(len(uids))
     if dropped:
         metrics.DROPPED_POINTS.inc(dropped)
+    uids = [r["uid"] for r in normalized]
+    if not await _store(normalized):
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                            content={"result": "pending", "pending": len(uids), "dropped": dropped, "uids": uids})
+    metrics.INGESTED_POINTS.inc(len(uids))
     return {"result": "ok", "ingested": len(uids), "dropped": dropped, "uids": uids}
 
+async def create_locations(payload: IngestPayload, request: Request):
+    shed = _shed()
+    if shed is not None:
+        return shed
+    _parsed(request)  # FastAPI validated the body before calling us
+    raw_items = [item if isinstance(item, dict) else item.dict(by_alias=True) for item in payload.locations]
+    return await _ingest(request, raw_items, payload.user_id or settings.DEFAULT_USER_ID, payload.device_id)
+
+async def create_locations_raw(request: Request):
+    """Same contract as create_locations, without building and re-dumping IngestPayload models."""
+    shed = _shed()
+    if shed is not None:
+        return shed
+    try:
+        doc, user_id, device_id, raw_items = parse_ingest_body(await request.body())
+    except BodyError as e:
+        return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content={"detail": e.errors})
+    _parsed(request)
+    return await _ingest(request, raw_items, user_id or settings.DEFAULT_USER_ID, device_id)
+
+if settings.INGEST_PARSE_MODE == "raw":
+    app.add_api_route("/api/v1/locations", create_locations_raw, methods=["POST"])
+else:
+    app.add_api_route("/api/v1/locations", create_locations, methods=["POST"])
+
+@app.post("/api/v1/locations/stream")
+async def create_locations_stream(request: Request, user_id: Optional[str] = None, device_id: Optional[str] = None):
+    """Bulk ingest of application/x-ndjson, one feature or one v1 payload per line.
+
+    The body is never held in memory as a whole; see NdjsonIngest.
+    """
+    ctype = request.headers.get("content-type", "").split(";")[0].strip()
+    if ctype not in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        return JSONResponse(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            content={"result": "error", "reason": "expected application/x-ndjson"})
+    shed = _shed()
+    if shed is not None:
+        return shed
+    pended = 0
+
+    async def store(records: List[Dict[str, Any]]) -> List[str]:
+        nonlocal pended
+        if not await _store(records):
+            pended += len(records)
+        return [r["uid"] for r in records]
+
+    job = NdjsonIngest(
+        user_id or settings.DEFAULT_USER_ID, device_id,
+        wal_write=wal.write_async,
+        upsert=write_behind.put if write_behind is not None else store,
+        batch_points=settings.STREAM_BATCH_POINTS,
+        max_inflight=settings.STREAM_MAX_INFLIGHT,
+        max_line_bytes=settings.STREAM_MAX_LINE_BYTES,
+    )
+    try:
+        await job.run(request.stream())
+    except Exception:
+        metrics.DB_FAILURES.inc()
+        log.exception("NDJSON stream ingest failed")
+        if write_behind is None:
+            metrics.INGESTED_POINTS.inc(job.ingested)
+        return JSONResponse(status_code=500, content={"result": "error", "reason": "db failure", **job.summary()})
+    if job.dropped:
+        metrics.DROPPED_POINTS.inc(job.dropped)
+    if write_behind is not None:
+        # counted as ingested by the drainer; "ingested" here means accepted
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"result": "accepted", **job.summary()})
+    metrics.INGESTED_POINTS.inc(job.ingested - pended)
+    if pended:
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                            content={"result": "pending", **job.summary(), "pending": pended})
+    return {"result": "ok", **job.summary()}
+
+def _bad_request(reason: str) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"result": "error", "reason": reason})
+
+def _format(request: Request, format: Optional[str]) -> Optional[str]:
+    if format is None:
+        return "geojson" if "application/geo+json" in request.headers.get("accept", "") else "ndjson"
+    return format if format in FORMATS else None
+
+def _read_options(request: Request, limit: Optional[int], format: Optional[str]):
+    """(limit, format) of a read endpoint, or a 400 response."""
+    format = _format(request, format)
+    if format is None:
+        return _bad_request(f"format must be one of {sorted(FORMATS)}")
+    limit = settings.QUERY_DEFAULT_LIMIT if limit is None else limit
+    if not 1 <= limit <= settings.QUERY_MAX_LIMIT:
+        return _bad_request(f"limit must be 1..{settings.QUERY_MAX_LIMIT}")
+    return limit, format
+
+async def _points(request: Request, key: str, owner: str, since: Optional[str], until: Optional[str],
+                  cursor: Optional[str], limit: Optional[int], format: Optional[str]):
+    opts = _read_options(request, limit, format)
+    if isinstance(opts, JSONResponse):
+        return opts
+    limit, format = opts
+    down = _db_down()
+    if down is not None:
+        return down
+    try:
+        q = PointQuery(key, owner, since, until, cursor, limit, settings.QUERY_PAGE_SIZE)
+    except ValueError as e:
+        return _bad_request(str(e))
+    try:
+        # first page before the status line, so a failing database is still a 500
+        first = await q.page()
+    except Exception:
+        metrics.DB_FAILURES.inc()
+        log.exception("Neo4j point query failed")
+        return JSONResponse(status_code=500, content={"result": "error", "reason": "db failure"})
+    body = geojson_body(q, first) if format == "geojson" else ndjson_body(q, first)
+    return StreamingResponse(body, media_type=FORMATS[format])
+
+async def _spatial(request: Request, kind: str, area: Dict[str, float], since: Optional[str], until: Optional[str],
+                   user_id: Optional[str], device_id: Optional[str], limit: Optional[int], format: Optional[str]):
+    opts = _read_options(request, limit, format)
+    if isinstance(opts, JSONResponse):
+        return opts
+    limit, format = opts
+    down = _db_down()
+    if down is not None:
+        return down
+    try:
+        window = {"since": parse_when(since) if since else None, "until": parse_when(until) if until else None}
+    except ValueError:
+        return _bad_request("since/until must be epoch millis or ISO-8601")
+    try:
+        rows = await spatial_points(kind, dict(area, **window, user_id=user_id, device_id=device_id, limit=limit))
+    except Exception:
+        metrics.DB_FAILURES.inc()
+        log.exception("Neo4j spatial query failed")
+        return JSONResponse(status_code=500, content={"result": "error", "reason": "db failure"})
+    # results are bounded by `limit` and cached whole, so they are not streamed
+    headers = {"x-truncated": "true"} if len(rows) >= limit else None
+    return Response(render(rows, format), media_type=FORMATS[format], headers=headers)
+
+@app.get("/api/v1/devices/{device_id}/points")
+async def device_points(request: Request, device_id: str, since: Optional[str] = None, until: Optional[str] = None,
+                        cursor: Optional[str] = None, limit: Optional[int] = None, format: Optional[str] = None):
+    """Points of one device in time order, streamed as NDJSON (default) or GeoJSON.
+
+    since/until (epoch millis or ISO-8601) bound epoch_millis, inclusive; pass
+    the `next_cursor` of a truncated response as `cursor` to continue it.
+    """
+    return await _points(request, "device_id", device_id, since, until, cursor, limit, format)
+
+@app.get("/api/v1/users/{user_id}/points")
+async def user_points(request: Request, user_id: str, since: Optional[str] = None, until: Optional[str] = None,
+                      cursor: Optional[str] = None, limit: Optional[int] = None, format: Optional[str] = None):
+    """Points of one user across devices; same parameters as device_points."""
+    return await _points(request, "user_id", user_id, since, until, cursor, limit, format)
+
+@app.get("/api/v1/devices/{device_id}/track")
+async def device_track(request: Request, device_id: str, since: Optional[str] = None, until: Optional[str] = None,
+                       cursor: Optional[str] = None, zoom: Optional[float] = None, tolerance_m: Optional[float] = None,
+                       bucket_s: Optional[int] = None, format: Optional[str] = None):
+    """A device's track for drawing: points thinned to one per `bucket_s` seconds and/or
+    simplified (Douglas-Peucker) to `tolerance_m` metres or one pixel at map `zoom`.
+
+    NDJSON gives the kept points; GeoJSON one LineString Feature. When bucket_s
+    is a multiple of a TRACK_BUCKET_LEVELS_S resolution, the precomputed
+    TrackBucket points are read instead of every point.
+    """
+    format = _format(request, format)
+    if format is None:
+        return _bad_request(f"format must be one of {sorted(FORMATS)}")
+    if zoom is not None and not 0 <= zoom <= 24:
+        return _bad_request("zoom must be 0..24")
+    if (tolerance_m is not None and tolerance_m < 0) or (bucket_s is not None and bucket_s <= 0):
+        return _bad_request("tolerance_m must be >= 0 and bucket_s > 0")
+    res_s = max((l for l in settings.TRACK_BUCKET_LEVELS_S if bucket_s and l > 0 and bucket_s % l == 0), default=None)
+    try:
+        q = PointQuery("device_id", device_id, since, until, cursor, settings.TRACK_MAX_SOURCE_POINTS,
+                       settings.QUERY_PAGE_SIZE, res_s=res_s)
+    except ValueError as e:
+        return _bad_request(str(e))
+    shaper = TrackShaper(tolerance_m, zoom, bucket_s * 1000 if bucket_s else None, settings.TRACK_PIXEL_TOLERANCE)
+    down = _db_down()
+    if down is not None:
+        return down
+    try:
+        first = await q.page()
+    except Exception:
+        metrics.DB_FAILURES.inc()
+        log.exception("Neo4j track query failed")
+        return JSONResponse(status_code=500, content={"result": "error", "reason": "db failure"})
+    body = linestring_body(q, first, shaper) if format == "geojson" else ndjson_body(q, first, shaper)
+    return StreamingResponse(body, media_type=FORMATS[format])
+
+@app.get("/api/v1/points/bbox")
+async def points_in_bbox(request: Request, min_lon: float, min_lat: float, max_lon: float, max_lat: float,
+                         since: Optional[str] = None, until: Optional[str] = None, user_id: Optional[str] = None,
+                         device_id: Optional[str] = None, limit: Optional[int] = None, format: Optional[str] = None):
+    """Points inside a WGS-84 bounding box, optionally within since/until and for one user/device."""
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        return _bad_request("need -180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90")
+    area = {"min_lon": min_lon, "min_lat": min_lat, "max_lon": max_lon, "max_lat": max_lat}
+    return await _spatial(request, "bbox", area, since, until, user_id, device_id, limit, format)
+
+@app.get("/api/v1/points/near")
+async def points_near(request: Request, lon: float, lat: float, radius_m: float,
+                      since: Optional[str] = None, until: Optional[str] = None, user_id: Optional[str] = None,
+                      device_id: Optional[str] = None, limit: Optional[int] = None, format: Optional[str] = None):
+    """Points within radius_m metres of (lon, lat); same filters as points_in_bbox."""
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        return _bad_request("lon/lat out of range")
+    if not 0 < radius_m <= settings.QUERY_MAX_RADIUS_M:
+        return _bad_request(f"radius_m must be in (0, {settings.QUERY_MAX_RADIUS_M:g}]")
+    area = {"lon": lon, "lat": lat, "radius_m": radius_m}
+    return await _spatial(request, "near", area, since, until, user_id, device_id, limit, format)
+
 @app.post("/api/v0")
 async def handle_location_data_compat(req: Request):
-    data = await req.json()
-    wal.write({"received_at": int(time.time()*1000), "payload": data, "api": "v0"})
+    try:
+        loads(await req.body())
+    except ValueError:
+        return _bad_request("body is not JSON")
+    await _wal_write(req, "v0")
     return {"result": "ok"}
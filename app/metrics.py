@@ -1,5 +1,5 @@
 import os, glob
-from prometheus_client import CollectorRegistry, Counter, Histogram
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
 from prometheus_client.multiprocess import MultiProcessCollector
 
 MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
@@ -13,8 +13,61 @@ if MULTIPROC_DIR:
             except FileNotFoundError: pass
     MultiProcessCollector(registry)
 
+# `path` is the route template (e.g. /api/v1/devices/{device_id}/points), never the raw URL
 REQUESTS = Counter("app_requests_total","Total HTTP requests",["path","method","status"], registry=registry)
 REQ_LATENCY = Histogram("app_request_latency_seconds","HTTP request latency (s)",["path","method"], registry=registry)
+LOG_DROPPED = Counter("app_log_dropped_total","Log records dropped because the log queue was full", registry=registry)
 INGESTED_POINTS = Counter("app_ingested_points_total","Total ingested phonelog points", registry=registry)
 DROPPED_POINTS  = Counter("app_dropped_points_total","Total dropped phonelog points (invalid)", registry=registry)
 DB_FAILURES     = Counter("app_db_failures_total","DB upsert failures", registry=registry)
+QUERY_POINTS    = Counter("app_query_points_total","Points returned by read endpoints", registry=registry)
+QUERY_CACHE_HITS          = Counter("app_query_cache_hits_total","Spatial queries answered from the tile cache", registry=registry)
+QUERY_CACHE_MISSES        = Counter("app_query_cache_misses_total","Spatial queries not in the tile cache", registry=registry)
+QUERY_CACHE_INVALIDATIONS = Counter("app_query_cache_invalidations_total","Cached results dropped because points were written in their tiles", registry=registry)
+QUERY_CACHE_EVICTIONS     = Counter("app_query_cache_evictions_total","Cached results evicted to stay within QUERY_CACHE_SIZE / QUERY_CACHE_MAX_ROWS", registry=registry)
+
+# hot path stages: parse (request start until the body is decoded/validated),
+# normalize, wal_write (until durable per WAL_DURABILITY), db_write (one UNWIND transaction);
+# db_read is one page of a read endpoint
+STAGE_LATENCY = Histogram("app_stage_latency_seconds","Ingest stage latency (s)",["stage"], registry=registry,
+                          buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+INGEST_BATCH_POINTS = Histogram("app_ingest_batch_points","Valid points per ingest request / stream batch", registry=registry,
+                                buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+WAL_GROUP_RECORDS = Histogram("app_wal_group_records","Records per WAL group commit", registry=registry,
+                              buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+WAL_GROUP_BYTES = Histogram("app_wal_group_bytes","Uncompressed bytes per WAL group commit", registry=registry,
+                            buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+WAL_SEGMENT_BYTES = Histogram("app_wal_segment_bytes","Compressed size of sealed WAL segments", registry=registry,
+                              buckets=(1e5, 1e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8))
+WAL_ROTATIONS = Counter("app_wal_rotations_total","WAL segments sealed", registry=registry)
+
+DEDUP_HITS      = Counter("app_dedup_hits_total","Resent points acknowledged from the recent-uid cache", registry=registry)
+DEDUP_MISSES    = Counter("app_dedup_misses_total","Points not in the recent-uid cache (written to Neo4j)", registry=registry)
+DEDUP_EVICTIONS = Counter("app_dedup_evictions_total","Entries evicted from the recent-uid cache", registry=registry)
+
+# write-behind mode (INGEST_ACK_MODE=wal); gauges are per worker, summed/maxed across workers
+WB_QUEUE_POINTS   = Gauge("app_writebehind_queue_points","Points held in memory waiting for Neo4j", registry=registry, multiprocess_mode="livesum")
+WB_PENDING_POINTS = Gauge("app_writebehind_pending_points","Points waiting for Neo4j, in memory or spilled", registry=registry, multiprocess_mode="livesum")
+WB_LAG_SECONDS    = Gauge("app_writebehind_lag_seconds","Age of the last batch written by the drainer", registry=registry, multiprocess_mode="livemax")
+WB_BATCH_POINTS   = Histogram("app_writebehind_batch_points","Points per drained batch", registry=registry,
+                              buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+WB_BATCH_SECONDS  = Histogram("app_writebehind_batch_seconds","Neo4j write time per drained batch (s)", registry=registry)
+WB_RETRIES        = Counter("app_writebehind_retries_total","Drained batches retried after a failure", registry=registry)
+WB_SPILLED_POINTS = Counter("app_writebehind_spilled_points_total","Points spilled to disk because the queue was full", registry=registry)
+WB_SHED           = Counter("app_writebehind_shed_total","Requests refused with 503 above the high-water mark", registry=registry)
+
+# per worker: boot time (fork or process start until ready to serve) and memory after boot
+WORKER_STARTUP_SECONDS = Gauge("app_worker_startup_seconds","Worker boot time until ready to serve (s)", registry=registry, multiprocess_mode="liveall")
+WORKER_RSS_BYTES       = Gauge("app_worker_rss_bytes","Worker resident memory after boot", registry=registry, multiprocess_mode="liveall")
+WORKER_PRIVATE_BYTES   = Gauge("app_worker_private_bytes","Worker memory not shared with the master / other workers, after boot", registry=registry, multiprocess_mode="liveall")
+
+# circuit breaker around Neo4j writes; points it turns away wait in the pending spool
+# (a WriteBehind, so its backlog is app_writebehind_pending_points)
+BREAKER_STATE       = Gauge("app_breaker_state","Neo4j circuit breaker: 0 closed, 1 half-open, 2 open", registry=registry, multiprocess_mode="livemax")
+BREAKER_TRANSITIONS = Counter("app_breaker_transitions_total","Circuit breaker state changes, by new state",["state"], registry=registry)
+BREAKER_REJECTED    = Counter("app_breaker_rejected_total","Neo4j calls not attempted because the breaker was open", registry=registry)
+PENDING_POINTS      = Counter("app_pending_points_total","Points acknowledged as pending instead of written", registry=registry)
+
+# scripts/run_normalize.py (served with --metrics-port)
+NORMALIZE_NODES    = Counter("app_normalize_nodes_total","Legacy PhoneLog nodes re-normalized, by outcome (normalized, unparsed, duplicates)",["outcome"], registry=registry)
+NORMALIZE_PROGRESS = Gauge("app_normalize_progress_ratio","Share of the PhoneLog id range the re-normalization job has covered", registry=registry, multiprocess_mode="livemax")
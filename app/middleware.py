@@ -0,0 +1,64 @@
+"""Request id, HTTP metrics and the access log, as a plain ASGI middleware.
+
+Unlike `@app.middleware("http")` (Starlette's BaseHTTPMiddleware) it does not
+run the endpoint in a second task or copy the response body through a memory
+stream: it only wraps `send` to see the status and add the x-request-id
+header, so streamed responses go out as the endpoint yields them.
+"""
+import time, uuid, random, logging
+from fastapi.responses import JSONResponse
+from . import metrics
+
+log = logging.getLogger("app.access")
+
+def route_label(scope) -> str:
+    # route template keeps label cardinality bounded; unmatched URLs share one series
+    route = scope.get("route")
+    return getattr(route, "path", None) or "<unmatched>"
+
+class RequestMiddleware:
+    """Successful requests faster than `slow_ms` are logged at `sample_rate`
+    (0..1); errors (status >= 400) and slow requests always are. Metrics count
+    every request."""
+    def __init__(self, app, sample_rate: float = 1.0, slow_ms: float = 1000.0):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        req_id = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"x-request-id"), None) or str(uuid.uuid4())
+        state = scope.setdefault("state", {})  # request.state
+        state["started"], state["request_id"] = start, req_id
+        header = (b"x-request-id", req_id.encode("latin-1"))
+        status, started = 500, False
+
+        async def send_with_id(message):
+            nonlocal status, started
+            if message["type"] == "http.response.start":
+                status, started = message["status"], True
+                message["headers"] = [*message.get("headers", ()), header]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        except Exception:
+            status = 500
+            log.exception("Unhandled error", extra={"rid": req_id})
+            if started:
+                raise  # too late for a response; the server closes the connection
+            await JSONResponse(status_code=500, content={"result": "error", "reason": "internal"})(scope, receive, send_with_id)
+        finally:
+            self._done(scope, status, time.perf_counter() - start, req_id)
+
+    def _done(self, scope, status: int, seconds: float, req_id: str):
+        path, method = route_label(scope), scope["method"]
+        metrics.REQUESTS.labels(path=path, method=method, status=str(status)).inc()
+        metrics.REQ_LATENCY.labels(path=path, method=method).observe(seconds)
+        ms = seconds * 1000
+        if status >= 400 or ms >= self.slow_ms or random.random() < self.sample_rate:
+            log.info("request", extra={"event": "request", "path": scope["path"], "route": path, "method": method,
+                                       "status": status, "ms": int(ms), "rid": req_id})
@@ -1,16 +1,33 @@
-import json, re, hashlib
+import json, hashlib
+from functools import lru_cache
 from datetime import datetime, timezone
-from typing import Any, Dict, Optional, Tuple, Union
-
-JSON_TRUE_FALSE_NONE = (
-    ("'", '"'),
-    (" True", " true"),
-    (" False", " false"),
-    (" None", " null"),
-    (": True", ": true"),
-    (": False", ": false"),
-    (": None", ": null"),
-)
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from . import pyrepr
+
+# Stringified geometry/properties repeat whenever a phone re-sends a batch or
+# sits still; parse results are memoized per distinct string. Longer strings are
+# parsed every time so the cache stays bounded in bytes, not just entries.
+COERCE_CACHE_SIZE = 4096
+COERCE_CACHE_MAX_LEN = 4096
+
+def _parse(s: str) -> Any:
+    # Already valid JSON: one C-level parse.
+    if "'" not in s:
+        try:
+            return json.loads(s)
+        except json.JSONDecodeError:
+            pass
+    # Python repr (or JSON with True/None, trailing commas): one pass of the tolerant parser.
+    try:
+        return pyrepr.loads(s)
+    except ValueError:
+        return None
+
+_parse_cached = lru_cache(maxsize=COERCE_CACHE_SIZE)(_parse)
+
+def _parse_str(s: str) -> Any:
+    return _parse_cached(s) if len(s) <= COERCE_CACHE_MAX_LEN else _parse(s)
 
 def _coerce_to_dict(v: Union[str, Dict[str, Any], None]) -> Optional[Dict[str, Any]]:
     if v is None:
@@ -18,15 +35,9 @@ def _coerce_to_dict(v: Union[str, Dict[str, Any], None]) -> Optional[Dict[str, A
     if isinstance(v, dict):
         return v
     if isinstance(v, str):
-        s = v
-        for a, b in JSON_TRUE_FALSE_NONE:
-            s = s.replace(a, b)
-        s = re.sub(r",\s*}", "}", s)
-        s = re.sub(r",\s*]", "]", s)
-        try:
-            return json.loads(s)
-        except json.JSONDecodeError:
-            return None
+        parsed = _parse_str(v)
+        # shallow copy: the memoized object is shared between calls
+        return dict(parsed) if isinstance(parsed, dict) else None
     return None
 
 def _parse_timestamp(ts: Union[str, int, float, None]) -> Tuple[Optional[str], Optional[int]]:
@@ -95,3 +106,229 @@ def normalize_one(raw_item: Dict[str, Any], default_user: str, default_device: O
     if epoch_millis is None or lon is None or lat is None:
         return None
     return out
+
+# -- columnar batch normalization ---------------------------------------------
+
+PROP_KEYS = (
+    "speed", "battery_state", "motion", "battery_level", "vertical_accuracy",
+    "horizontal_accuracy", "pauses", "wifi", "deferred", "significant_change",
+    "locations_in_payload", "activity", "device_id_prop", "altitude", "desired_accuracy",
+)
+NUMERIC_KEYS = ("speed", "battery_level", "vertical_accuracy", "horizontal_accuracy", "altitude")
+
+# datetime.fromtimestamp() accepts years 1..9999; inside +-2**33 s a float
+# seconds value still resolves to the exact millisecond, so the vectorized ISO
+# formatting below agrees with _parse_timestamp.
+_MIN_MILLIS, _MAX_MILLIS = -62_135_596_800_000, 253_402_300_800_000
+_EXACT_MILLIS = 2 ** 33 * 1000
+
+class NormalizedBatch:
+    """Columnar output of `normalize_batch`, holding only the kept points.
+
+    `longitude`, `latitude` (float64), `epoch_millis` (int64) and the float64
+    `NUMERIC_KEYS` arrays (NaN where missing or non-numeric) are for vectorized
+    consumers. `columns` holds every field exactly as `normalize_one` returns
+    it (object arrays), which is what `records()` emits.
+    """
+    def __init__(self, columns: Dict[str, np.ndarray], longitude: np.ndarray, latitude: np.ndarray,
+                 epoch_millis: np.ndarray, numeric: Dict[str, np.ndarray], dropped: int):
+        self.columns = columns
+        self.longitude = longitude
+        self.latitude = latitude
+        self.epoch_millis = epoch_millis
+        self.numeric = numeric
+        self.dropped = dropped
+
+    def __len__(self) -> int:
+        return len(self.epoch_millis)
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        numeric = self.__dict__.get("numeric", {})
+        if name in numeric:
+            return numeric[name]
+        raise AttributeError(name)
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Row dicts identical to what normalize_one produces for the kept items."""
+        keys = list(self.columns)
+        cols = [self.columns[k].tolist() for k in keys]
+        return [dict(zip(keys, row)) for row in zip(*cols)]
+
+def _objcol(values: List[Any]) -> np.ndarray:
+    return np.fromiter(values, dtype=object, count=len(values))
+
+def _floatcol(values: List[Any]) -> np.ndarray:
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        out = np.full(len(values), np.nan)
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except Exception:
+                pass
+        return out
+
+def _coords(geoms: List[Optional[Dict[str, Any]]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n = len(geoms)
+    shaped = np.zeros(n, dtype=bool)
+    xs: List[Any] = [None] * n
+    ys: List[Any] = [None] * n
+    for i, g in enumerate(geoms):
+        c = g.get("coordinates") if g else None
+        if isinstance(c, (list, tuple)) and len(c) >= 2:
+            shaped[i] = True
+            xs[i], ys[i] = c[0], c[1]
+    lon = np.full(n, np.nan)
+    lat = np.full(n, np.nan)
+    try:
+        lon[shaped] = np.array([x for x, ok in zip(xs, shaped) if ok], dtype=np.float64)
+        lat[shaped] = np.array([y for y, ok in zip(ys, shaped) if ok], dtype=np.float64)
+        recheck = shaped & (np.isnan(lon) | np.isnan(lat))
+    except (TypeError, ValueError):
+        recheck = shaped
+    valid = shaped.copy()
+    # Rows numpy could not convert (or that came out NaN, which may be a None
+    # element or a genuine "nan"): apply normalize_one's exact rule.
+    for i in np.flatnonzero(recheck):
+        try:
+            lon[i], lat[i] = float(xs[i]), float(ys[i])
+        except Exception:
+            valid[i] = False
+    return lon, lat, valid
+
+def _timestamps(raw_ts: List[Any]) -> Tuple[np.ndarray, np.ndarray, List[Optional[str]]]:
+    n = len(raw_ts)
+    millis = np.zeros(n, dtype=np.int64)
+    valid = np.zeros(n, dtype=bool)
+    iso: List[Optional[str]] = [None] * n
+
+    int_idx, int_val, float_idx, float_val, slow = [], [], [], [], []
+    for i, ts in enumerate(raw_ts):
+        if ts is None:
+            continue
+        if isinstance(ts, int):
+            if -2 ** 62 < ts < 2 ** 62:
+                int_idx.append(i); int_val.append(int(ts))
+            else:
+                slow.append(i)
+        elif isinstance(ts, float):
+            float_idx.append(i); float_val.append(ts)
+        else:
+            slow.append(i)
+
+    # numeric epochs: seconds are scaled to millis, values above 1e10 are millis already
+    if int_idx:
+        v = np.array(int_val, dtype=np.int64)
+        scale = v <= 10_000_000_000
+        ok = ~scale | (v > -2 ** 52)  # v * 1000 stays inside int64
+        m = np.where(scale & ok, v * 1000, v)
+        idx = np.array(int_idx)
+        millis[idx] = m
+        valid[idx] = ok
+    if float_idx:
+        v = np.array(float_val, dtype=np.float64)
+        scaled = np.where(v > 10_000_000_000, v, v * 1000)
+        ok = np.isfinite(scaled) & (np.abs(scaled) < 2 ** 62)
+        idx = np.array(float_idx)
+        millis[idx] = np.trunc(np.where(ok, scaled, 0)).astype(np.int64)
+        valid[idx] = ok
+    numeric = valid.copy()
+    valid &= (millis >= _MIN_MILLIS) & (millis < _MAX_MILLIS)
+
+    fast = numeric & valid & (np.abs(millis) < _EXACT_MILLIS)
+    whole = fast & (millis % 1000 == 0)
+    frac = fast & ~whole
+    for mask, unit in ((whole, "s"), (frac, "us")):
+        idx = np.flatnonzero(mask)
+        if len(idx):
+            strings = np.datetime_as_string(millis[idx].astype("datetime64[ms]").astype(f"datetime64[{unit}]"))
+            for i, s in zip(idx.tolist(), strings.tolist()):
+                iso[i] = s + "+00:00"
+    # edge-of-range numerics and all strings: the scalar path, once per distinct value
+    cache: Dict[Any, Tuple[Optional[str], Optional[int]]] = {}
+    for i in slow + np.flatnonzero(numeric & valid & ~fast).tolist():
+        ts = raw_ts[i]
+        try:
+            parsed = cache[ts] if ts in cache else cache.setdefault(ts, _parse_timestamp(ts))
+        except TypeError:  # unhashable
+            parsed = _parse_timestamp(ts)
+        if parsed[1] is not None:
+            iso[i], millis[i], valid[i] = parsed[0], parsed[1], True
+        else:
+            valid[i] = False
+    return millis, valid, iso
+
+def normalize_batch(raw_items: List[Dict[str, Any]],
+                    default_user: Union[str, Sequence[str]],
+                    default_device: Union[Optional[str], Sequence[Optional[str]]]) -> NormalizedBatch:
+    """Normalize many items at once; same results as calling normalize_one per item.
+
+    `default_user` / `default_device` may be one value or one per item (WAL
+    replay mixes requests from several phones in a batch).
+    """
+    n = len(raw_items)
+    geoms = [_coerce_to_dict(it.get("geometry")) for it in raw_items]
+    props = [_coerce_to_dict(it.get("properties")) for it in raw_items]
+
+    lon, lat, has_coord = _coords(geoms)
+    millis, has_ts, ts_iso = _timestamps([p.get("timestamp") if p else None for p in props])
+    keep = np.flatnonzero(has_coord & has_ts)
+    keep_list = keep.tolist()
+
+    users = default_user if isinstance(default_user, (list, tuple)) else [default_user] * n
+    devices = default_device if isinstance(default_device, (list, tuple)) else [default_device] * n
+
+    lon_k, lat_k, millis_k = lon[keep], lat[keep], millis[keep]
+    user_ids, device_ids, uids = [], [], []
+    for i, x, y, ms in zip(keep_list, lon_k.tolist(), lat_k.tolist(), millis_k.tolist()):
+        it, p = raw_items[i], props[i]
+        user_id = it.get("user_id") or (p.get("user_id") if p else None) or users[i]
+        device_id = it.get("device_id") or (p.get("device_id") if p else None) or devices[i]
+        user_ids.append(user_id)
+        device_ids.append(device_id)
+        uid_source = f"{user_id}|{device_id}|{ms or ''}|{x or ''}|{y or ''}"
+        uids.append(hashlib.sha1(uid_source.encode("utf-8")).hexdigest())
+
+    kept_geoms = [geoms[i] or {} for i in keep_list]
+    kept_props = [props[i] or {} for i in keep_list]
+    columns = {
+        "uid": _objcol(uids),
+        "user_id": _objcol(user_ids),
+        "device_id": _objcol(device_ids),
+        "geom_type": _objcol([g.get("type") for g in kept_geoms]),
+        "coordinates": _objcol([g.get("coordinates") for g in kept_geoms]),
+        "longitude": _objcol(lon_k.tolist()),
+        "latitude": _objcol(lat_k.tolist()),
+        "timestamp": _objcol([ts_iso[i] for i in keep_list]),
+        "epoch_millis": _objcol(millis_k.tolist()),
+    }
+    for k in PROP_KEYS:
+        src = "device_id" if k == "device_id_prop" else k
+        columns[k] = _objcol([p.get(src) for p in kept_props])
+    columns["raw_item"] = _objcol([raw_items[i] for i in keep_list])
+
+    numeric = {k: _floatcol(columns[k].tolist()) for k in NUMERIC_KEYS}
+    return NormalizedBatch(columns, lon_k, lat_k, millis_k, numeric, dropped=n - len(keep_list))
+
+# Below this many items the per-item path is cheaper than building columns.
+BATCH_MIN_ITEMS = 64
+
+def normalize_items(raw_items: List[Dict[str, Any]],
+                    default_user: Union[str, Sequence[str]],
+                    default_device: Union[Optional[str], Sequence[Optional[str]]]) -> Tuple[List[Dict[str, Any]], int]:
+    """(normalized records, dropped count), via normalize_batch for large inputs."""
+    if len(raw_items) >= BATCH_MIN_ITEMS:
+        batch = normalize_batch(raw_items, default_user, default_device)
+        return batch.records(), batch.dropped
+    normalized: List[Dict[str, Any]] = []
+    dropped = 0
+    for i, item in enumerate(raw_items):
+        user = default_user[i] if isinstance(default_user, (list, tuple)) else default_user
+        device = default_device[i] if isinstance(default_device, (list, tuple)) else default_device
+        norm = normalize_one(item, default_user=user, default_device=device)
+        if norm is None:
+            dropped += 1
+            continue
+        normalized.append(norm)
+    return normalized, dropped
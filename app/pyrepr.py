@@ -0,0 +1,135 @@
+import re, ast, json
+from typing import Any
+
+# One token per match; the common cases (plain quoted strings without escapes)
+# are captured without the quotes so no further copying is needed.
+_TOKEN = re.compile(r"""\s*(?:
+    '(?P<sq>[^'\\]*)'
+  | "(?P<dq>[^"\\]*)"
+  | (?P<num>[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)(?![\w.])
+  | (?P<open>[{\[(])
+  | (?P<close>[}\])])
+  | (?P<colon>:)
+  | (?P<comma>,)
+  | (?P<word>-?[A-Za-z]+)
+  | (?P<esc>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+)""", re.VERBOSE | re.DOTALL)
+
+_WORDS = {
+    "True": True, "true": True,
+    "False": False, "false": False,
+    "None": None, "null": None,
+    "NaN": float("nan"), "nan": float("nan"),
+    "Infinity": float("inf"), "inf": float("inf"),
+    "-Infinity": float("-inf"), "-inf": float("-inf"),
+}
+_CLOSERS = {"{": "}", "[": "]", "(": ")"}
+
+# container states
+_KEY, _COLON, _VALUE, _NEXT = range(4)
+
+def _unescape(t: str) -> str:
+    if t[0] == '"':
+        try:
+            return json.loads(t)
+        except ValueError:
+            pass  # Python-only escapes such as \x41
+    try:
+        return ast.literal_eval(t)
+    except (SyntaxError, ValueError):
+        raise ValueError(f"bad string literal {t[:20]!r}")
+
+def loads(s: str) -> Any:
+    """Parse JSON or a Python-repr literal (as str(dict) produces) in one pass.
+
+    Accepts single or double quoted strings, True/False/None next to
+    true/false/null, tuples (as lists) and trailing commas. Raises ValueError on
+    anything else.
+    """
+    match = _TOKEN.match
+    pos = 0
+    stack = []  # (container, closer, state, pending_key)
+    cur = None
+    closer = None
+    state = _VALUE
+    key = None
+    result = None
+    have_result = False
+
+    while True:
+        m = match(s, pos)
+        if m is None:
+            if s[pos:].strip():
+                raise ValueError(f"unexpected character at {pos}")
+            break
+        pos = m.end()
+        kind = m.lastgroup
+        if have_result:
+            raise ValueError(f"trailing data at {m.start(kind)}")
+
+        if kind == "comma":
+            if cur is None or state != _NEXT:
+                raise ValueError(f"unexpected ',' at {pos - 1}")
+            state = _KEY if closer == "}" else _VALUE
+            continue
+        if kind == "colon":
+            if state != _COLON:
+                raise ValueError(f"unexpected ':' at {pos - 1}")
+            state = _VALUE
+            continue
+        if kind == "close":
+            c = m.group(kind)
+            # trailing comma: a closer is fine where a key/value was expected
+            if cur is None or c != closer or state == _COLON or (state == _VALUE and key is not None):
+                raise ValueError(f"unexpected {c!r} at {pos - 1}")
+            value = cur
+            if stack:
+                cur, closer, state, key = stack.pop()
+            else:
+                cur = None
+        elif kind == "open":
+            o = m.group(kind)
+            if state != _VALUE:
+                raise ValueError(f"unexpected {o!r} at {pos - 1}")
+            if cur is not None:
+                stack.append((cur, closer, state, key))
+            cur, closer = ({} if o == "{" else []), _CLOSERS[o]
+            state, key = (_KEY if o == "{" else _VALUE), None
+            continue
+        elif kind == "sq" or kind == "dq":
+            value = m.group(kind)
+        elif kind == "num":
+            t = m.group(kind)
+            value = float(t) if ("." in t or "e" in t or "E" in t) else int(t)
+        elif kind == "word":
+            t = m.group(kind)
+            if t not in _WORDS:
+                raise ValueError(f"unknown literal {t!r} at {m.start(kind)}")
+            value = _WORDS[t]
+        else:  # quoted string with escapes
+            value = _unescape(m.group(kind))
+
+        # place the completed value
+        if cur is None:
+            result, have_result = value, True
+        elif closer == "}":
+            if state == _KEY:
+                try:
+                    hash(value)
+                except TypeError:
+                    raise ValueError(f"unhashable key at {pos}")
+                key, state = value, _COLON
+            elif state == _VALUE:
+                cur[key] = value
+                key, state = None, _NEXT
+            else:
+                raise ValueError(f"unexpected value at {pos}")
+        else:
+            if state != _VALUE:
+                raise ValueError(f"unexpected value at {pos}")
+            cur.append(value)
+            state = _NEXT
+
+    if cur is not None or not have_result:
+        raise ValueError("unexpected end of input")
+    return result
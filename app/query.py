@@ -0,0 +1,161 @@
+import base64, json, logging
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from .db import read_points_page, read_spatial, spatial_cache
+from .tilecache import bbox_tiles, radius_bbox
+from .simplify import TrackShaper
+from .fastpath import dumps
+from . import metrics
+
+log = logging.getLogger("app.query")
+
+EPOCH_MAX = 2**62
+FORMATS = {"ndjson": "application/x-ndjson", "geojson": "application/geo+json"}
+TRACK_FIELDS = ("uid", "epoch_millis", "longitude", "latitude")
+
+def parse_when(value: str) -> int:
+    """Epoch millis from epoch millis or an ISO-8601 timestamp (UTC unless it says otherwise)."""
+    if value.isdigit():
+        return int(value)
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def encode_cursor(epoch_millis: int, uid: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([epoch_millis, uid]).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        ms, uid = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("bad cursor")
+    if not isinstance(ms, int) or not isinstance(uid, str):
+        raise ValueError("bad cursor")
+    return ms, uid
+
+class PointQuery:
+    """Points of one device or user, read page by page in (epoch_millis, uid) order.
+
+    With `res_s` (devices only) the points are the device's TrackBucket
+    representatives of that resolution instead of every PhoneLog.
+
+    At most `limit` points are returned; when the limit cuts the range short,
+    `next_cursor` continues it. Raises ValueError for a bad since/until/cursor.
+    """
+    def __init__(self, key: str, owner: str, since: Optional[str] = None, until: Optional[str] = None,
+                 cursor: Optional[str] = None, limit: int = 10_000, page_size: int = 1000, res_s: Optional[int] = None):
+        self.key, self.owner, self.res_s = key, owner, res_s
+        try:
+            self.lo = parse_when(since) if since else 0
+            self.hi = parse_when(until) if until else EPOCH_MAX
+        except ValueError:
+            raise ValueError("since/until must be epoch millis or ISO-8601")
+        self.after: Optional[Tuple[int, str]] = decode_cursor(cursor) if cursor else (self.lo - 1, "")
+        self.remaining = limit
+        self.page_size = max(1, page_size)
+        self.next_cursor: Optional[str] = None
+
+    async def page(self) -> List[Dict[str, Any]]:
+        if self.after is None or self.remaining <= 0:
+            return []
+        n = min(self.page_size, self.remaining)
+        after_ms, after_uid = self.after
+        rows = await read_points_page(self.key, self.owner, max(self.lo, after_ms), self.hi, after_ms, after_uid, n,
+                                      self.res_s)
+        self.remaining -= len(rows)
+        metrics.QUERY_POINTS.inc(len(rows))
+        if len(rows) < n:
+            self.after = None  # range exhausted
+        else:
+            self.after = (rows[-1]["epoch_millis"], rows[-1]["uid"])
+            if self.remaining <= 0:
+                self.next_cursor = encode_cursor(*self.after)
+        return rows
+
+def _feature(r: Dict[str, Any]) -> Dict[str, Any]:
+    props = {k: v for k, v in r.items() if k not in ("longitude", "latitude")}
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [r["longitude"], r["latitude"]]},
+            "properties": props}
+
+async def ndjson_body(q: PointQuery, first: List[Dict[str, Any]],
+                      shaper: Optional[TrackShaper] = None) -> AsyncIterator[bytes]:
+    """One point per line; a last {"next_cursor"} line when the limit was hit.
+
+    With a `shaper`, each page is simplified and points carry only TRACK_FIELDS.
+    """
+    page = first
+    try:
+        while page:
+            if shaper is not None:
+                page = [{k: r.get(k) for k in TRACK_FIELDS} for r in shaper.feed(page)]
+            yield b"".join(dumps(r) + b"\n" for r in page)
+            page = await q.page()
+    except Exception:
+        log.exception("point query failed mid-stream")
+        yield dumps({"error": "db failure"}) + b"\n"
+        return
+    if q.next_cursor:
+        yield dumps({"next_cursor": q.next_cursor}) + b"\n"
+
+async def geojson_body(q: PointQuery, first: List[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """A FeatureCollection, with a top-level "next_cursor" member when the limit was hit."""
+    yield b'{"type":"FeatureCollection","features":['
+    sep, page = b"", first
+    tail = b"]"
+    try:
+        while page:
+            yield sep + b",".join(dumps(_feature(r)) for r in page)
+            sep = b","
+            page = await q.page()
+    except Exception:
+        log.exception("point query failed mid-stream")
+        tail += b',"error":"db failure"'
+    else:
+        if q.next_cursor:
+            tail += b',"next_cursor":' + dumps(q.next_cursor)
+    yield tail + b"}"
+
+async def linestring_body(q: PointQuery, first: List[Dict[str, Any]], shaper: TrackShaper) -> AsyncIterator[bytes]:
+    """A GeoJSON LineString Feature of the simplified track; per-vertex times in properties.epoch_millis."""
+    yield b'{"type":"Feature","geometry":{"type":"LineString","coordinates":['
+    sep, page = b"", first
+    times: List[int] = []
+    props: Dict[str, Any] = {"device_id": q.owner}
+    try:
+        while page:
+            kept = shaper.feed(page)
+            if kept:
+                yield sep + b",".join(dumps([r["longitude"], r["latitude"]]) for r in kept)
+                sep = b","
+                times.extend(r["epoch_millis"] for r in kept)
+            page = await q.page()
+    except Exception:
+        log.exception("track query failed mid-stream")
+        props["error"] = "db failure"
+    else:
+        if q.next_cursor:
+            props["next_cursor"] = q.next_cursor
+    props.update(epoch_millis=times, source_points=shaper.points_in)
+    yield b']},"properties":' + dumps(props) + b"}"
+
+async def spatial_points(kind: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Points in a bbox ("bbox": min/max lon/lat) or circle ("near": lon, lat, radius_m),
+    served from `spatial_cache` when the same query was answered recently."""
+    key = (kind,) + tuple(sorted(params.items()))
+    rows = spatial_cache.get(key)
+    if rows is not None:
+        return rows
+    area = radius_bbox(params["lon"], params["lat"], params["radius_m"]) if kind == "near" else \
+        (params["min_lon"], params["min_lat"], params["max_lon"], params["max_lat"])
+    tiles = bbox_tiles(*area, spatial_cache.zoom, spatial_cache.max_tiles)
+    token = spatial_cache.token()
+    rows = await read_spatial(kind, params)
+    metrics.QUERY_POINTS.inc(len(rows))
+    spatial_cache.put(key, tiles, rows, token)
+    return rows
+
+def render(rows: List[Dict[str, Any]], format: str) -> bytes:
+    if format == "geojson":
+        return dumps({"type": "FeatureCollection", "features": [_feature(r) for r in rows]})
+    return b"".join(dumps(r) + b"\n" for r in rows)
@@ -1,19 +1,65 @@
 from pydantic import BaseSettings, Field
-from typing import Optional
+from typing import List, Optional
 
 class Settings(BaseSettings):
     # API
     APP_NAME: str = "phone-log-ingestion"
     ENV: str = "dev"
     LOG_LEVEL: str = "INFO"
+    LOG_QUEUE_SIZE: int = 10_000  # records waiting for the log writer thread; beyond this INFO/WARNING are dropped
+    ACCESS_LOG_SAMPLE_RATE: float = 1.0  # share of fast successful requests logged; errors and slow ones always are
+    ACCESS_LOG_SLOW_MS: float = 1000.0  # requests at least this slow are always logged
+    INGEST_PARSE_MODE: str = "model"  # "raw": decode the body once, skip IngestPayload models
+    INGEST_ACK_MODE: str = "db"  # "wal": answer 202 once in the WAL, write Neo4j in the background
+    WRITE_BEHIND_QUEUE_POINTS: int = 100_000  # in memory per worker; more is spilled to WAL_DIR/spill
+    WRITE_BEHIND_HIGH_WATER: int = 1_000_000  # pending points per worker before answering 503
+    WRITE_BEHIND_MAX_BACKOFF_S: float = 30.0  # retry delay cap while Neo4j is failing
+    DB_CALL_TIMEOUT_S: float = 10.0  # request-path Neo4j write; slower ones are answered as pending
+    BREAKER_WINDOW_S: float = 30.0  # circuit breaker: outcomes counted over this window
+    BREAKER_MIN_CALLS: int = 20  # ... once there were at least this many calls
+    BREAKER_ERROR_RATE: float = 0.5  # opens at this share of failed calls
+    BREAKER_SLOW_CALL_S: float = 2.0  # calls this slow count as slow
+    BREAKER_SLOW_RATE: float = 0.8  # opens at this share of slow calls
+    BREAKER_OPEN_S: float = 15.0  # open this long before a probe call is let through
+    PENDING_DRAIN_POINTS_S: float = 2000.0  # pace of the pending drain per worker once Neo4j is back; 0 = unpaced
+    STREAM_BATCH_POINTS: int = 1000  # NDJSON stream: points per WAL/DB batch
+    STREAM_MAX_INFLIGHT: int = 2  # NDJSON stream: DB batches in flight before reading pauses
+    STREAM_MAX_LINE_BYTES: int = 1_000_000  # longer NDJSON lines are rejected
+    QUERY_PAGE_SIZE: int = 1000  # read endpoints: points per DB round trip
+    QUERY_DEFAULT_LIMIT: int = 10_000  # read endpoints: points per response unless ?limit=
+    QUERY_MAX_LIMIT: int = 100_000
+    QUERY_MAX_RADIUS_M: float = 50_000.0  # radius queries
+    QUERY_CACHE_SIZE: int = 1000  # cached spatial query results per worker; 0 disables
+    QUERY_CACHE_TTL_S: float = 30.0  # bounds staleness from writes by other workers / replay
+    QUERY_CACHE_TILE_ZOOM: int = 14  # map tiles (~2.4 km at the equator) used to invalidate on ingest
+    QUERY_CACHE_MAX_TILES: int = 256  # larger query areas are not cached
+    QUERY_CACHE_MAX_ROWS: int = 200_000  # result rows cached per worker, over all entries; 0: no budget
+    QUERY_CACHE_MAX_RESULT_ROWS: int = 20_000  # larger results are not cached; 0: no limit
+    TRACK_BUCKET_LEVELS_S: List[int] = [60, 900]  # TrackBucket resolutions kept up to date on write; [] disables
+    TRACK_PIXEL_TOLERANCE: float = 1.0  # track ?zoom=: simplification tolerance in screen pixels
+    TRACK_MAX_SOURCE_POINTS: int = 2_000_000  # points read per track response before it ends with a cursor
     WAL_DIR: str = "/data/wal"
     WAL_ROTATE_BYTES: int = 100_000_000  # ~100MB
+    WAL_DURABILITY: str = "flush"  # ack after: buffer | flush | fsync
+    WAL_QUEUE_SIZE: int = 10_000  # records waiting for the writer thread
+    WAL_MAX_LATENCY_MS: float = 5.0  # group-commit window
+    WAL_GROUP_MAX_RECORDS: int = 1000
+    WAL_BLOCK_RECORDS: int = 1000  # records per independently readable gzip block
+    WAL_BLOCK_BYTES: int = 1_000_000  # uncompressed bytes per block
 
     # Neo4j
     NEO4J_URI: str = Field(..., env="NEO4J_URI")
     NEO4J_USER: str = Field(..., env="NEO4J_USER")
     NEO4J_PASSWORD: str = Field(..., env="NEO4J_PASSWORD")
     NEO4J_DATABASE: Optional[str] = Field(default=None, env="NEO4J_DATABASE")
+    NEO4J_BATCH_SIZE: int = 1000  # max rows per UNWIND upsert transaction
+    NEO4J_MAX_POOL_SIZE: int = 100  # connections per driver (per worker process)
+    NEO4J_ACQUISITION_TIMEOUT: float = 60.0  # seconds to wait for a pooled connection
+    NEO4J_MAX_CONNECTION_LIFETIME: float = 3600.0  # seconds before a connection is recycled
+    NEO4J_WARM_CONNECTIONS: int = 4  # connections each worker opens before it takes traffic; 0 = lazy
+    NEO4J_WARM_TIMEOUT_S: float = 5.0  # give up warming after this (Neo4j down at boot)
+    DEDUP_CACHE_SIZE: int = 100_000  # recently written uids kept per worker; 0 disables
+    DEDUP_CACHE_TTL_S: float = 900.0  # after this a resent point is written again
 
     # Defaults / compatibility
     DEFAULT_USER_ID: str = "kipnerter"
@@ -0,0 +1,147 @@
+import math, time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+EARTH_RADIUS_M = 6_371_008.8
+WEB_MERCATOR_M_PER_PX = 156_543.03392  # metres per 256px tile pixel at zoom 0, equator
+
+def tolerance_for_zoom(zoom: float, lat: float, pixels: float = 1.0) -> float:
+    """Ground distance of `pixels` screen pixels at a web-map zoom level and latitude."""
+    return pixels * WEB_MERCATOR_M_PER_PX * math.cos(math.radians(lat)) / (2.0 ** zoom)
+
+def douglas_peucker(lon: np.ndarray, lat: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """Keep-mask of a Douglas-Peucker simplification; first and last points are always kept.
+
+    Coordinates are projected to local metres (equirectangular around the mean
+    latitude). All open segments of one recursion level are split in a single
+    numpy pass, so the Python loop runs once per level, not once per segment.
+    """
+    n = len(lon)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    if tolerance_m <= 0:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+    k = math.cos(math.radians(float(np.mean(lat)))) * math.pi / 180.0 * EARTH_RADIUS_M
+    x = np.asarray(lon, dtype=np.float64) * k
+    y = np.asarray(lat, dtype=np.float64) * (math.pi / 180.0 * EARTH_RADIUS_M)
+    tol2 = tolerance_m * tolerance_m
+    starts, ends = np.array([0]), np.array([n - 1])
+    while True:
+        open_ = ends - starts >= 2
+        starts, ends = starts[open_], ends[open_]
+        if not len(starts):
+            return keep
+        counts = ends - starts - 1
+        seg = np.repeat(np.arange(len(starts)), counts)
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        idx = np.arange(len(seg)) - offsets[seg] + starts[seg] + 1
+        a, b = starts[seg], ends[seg]
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[idx] - x[a], y[idx] - y[a]
+        seg2 = dx * dx + dy * dy
+        # distance to the segment (not the infinite line), so back-tracking is kept
+        t = np.clip(np.divide(px * dx + py * dy, seg2, out=np.zeros_like(seg2), where=seg2 > 0), 0.0, 1.0)
+        ex, ey = px - t * dx, py - t * dy
+        d2 = ex * ex + ey * ey
+        worst = np.maximum.reduceat(d2, offsets)
+        split = worst > tol2
+        # farthest point of each segment that is split (first one on ties)
+        cand = np.flatnonzero(split[seg] & (d2 == worst[seg]))
+        _, first = np.unique(seg[cand], return_index=True)
+        mids = idx[cand[first]]
+        keep[mids] = True
+        s_split, e_split = starts[split], ends[split]
+        starts = np.concatenate((s_split, mids))
+        ends = np.concatenate((mids, e_split))
+
+def first_per_bucket(epoch_millis: np.ndarray, bucket_ms: int, after_bucket: Optional[int] = None) -> np.ndarray:
+    """Keep-mask of the first point of each `bucket_ms` time bucket (input in time order).
+
+    `after_bucket` is the last bucket already emitted (by a previous page).
+    """
+    buckets = np.asarray(epoch_millis, dtype=np.int64) // bucket_ms
+    keep = np.ones(len(buckets), dtype=bool)
+    keep[1:] = buckets[1:] != buckets[:-1]
+    if after_bucket is not None and len(buckets):
+        keep[0] = buckets[0] != after_bucket
+    return keep
+
+class TrackShaper:
+    """Simplifies a track delivered page by page (time order), without holding it whole.
+
+    Time bucketing (`bucket_ms`) runs first, then Douglas-Peucker with
+    `tolerance_m` (or, given `zoom`, the tolerance of `pixels` at that zoom and
+    the track's latitude). Each page is simplified together with the last point
+    kept so far, so page boundaries never move the line by more than the
+    tolerance.
+    """
+    def __init__(self, tolerance_m: Optional[float] = None, zoom: Optional[float] = None,
+                 bucket_ms: Optional[int] = None, pixels: float = 1.0):
+        self.tolerance_m = tolerance_m
+        self.zoom = zoom
+        self.pixels = pixels
+        self.bucket_ms = bucket_ms
+        self._last_bucket: Optional[int] = None
+        self._anchor: Optional[Dict[str, Any]] = None
+        self.points_in = self.points_out = 0
+
+    def feed(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        self.points_in += len(rows)
+        rows = [r for r in rows if r.get("longitude") is not None and r.get("latitude") is not None]
+        if self.bucket_ms and rows:
+            ms = np.fromiter((r["epoch_millis"] for r in rows), dtype=np.int64, count=len(rows))
+            keep = first_per_bucket(ms, self.bucket_ms, self._last_bucket)
+            self._last_bucket = int(ms[-1] // self.bucket_ms)
+            rows = [r for r, k in zip(rows, keep) if k]
+        if self.tolerance_m is None and self.zoom is not None and rows:
+            self.tolerance_m = tolerance_for_zoom(self.zoom, rows[0]["latitude"], self.pixels)
+        if self.tolerance_m and rows:
+            chunk = rows if self._anchor is None else [self._anchor] + rows
+            lon = np.fromiter((r["longitude"] for r in chunk), dtype=np.float64, count=len(chunk))
+            lat = np.fromiter((r["latitude"] for r in chunk), dtype=np.float64, count=len(chunk))
+            keep = douglas_peucker(lon, lat, self.tolerance_m)
+            if self._anchor is not None:
+                keep[0] = False  # emitted with the previous page
+            self._anchor = chunk[-1]
+            rows = [r for r, k in zip(chunk, keep) if k]
+        self.points_out += len(rows)
+        return rows
+
+def _bucket_row(r: Dict[str, Any], device: str, ms: int, level: int, start: int) -> Dict[str, Any]:
+    return {"key": f"{device}|{level}|{start}", "device_id": device, "user_id": r.get("user_id"), "res_s": level,
+            "bucket_ms": start, "day": time.strftime("%Y-%m-%d", time.gmtime(start / 1000)),
+            "uid": r["uid"], "epoch_millis": ms, "longitude": r["longitude"], "latitude": r["latitude"]}
+
+def track_buckets(rows: Iterable[Dict[str, Any]], levels_s: Iterable[int]) -> List[Dict[str, Any]]:
+    """TrackBucket rows for written points: per device and level, the first point of each bucket."""
+    firsts: Dict[str, Dict[str, Any]] = {}
+    levels = [int(l) for l in levels_s if l > 0]
+    for r in rows:
+        device, ms = r.get("device_id"), r.get("epoch_millis")
+        if device is None or ms is None or r.get("longitude") is None or r.get("latitude") is None:
+            continue
+        for level in levels:
+            start = ms - ms % (level * 1000)
+            key = f"{device}|{level}|{start}"
+            cur = firsts.get(key)
+            if cur is None or (ms, r["uid"]) < (cur["epoch_millis"], cur["uid"]):
+                firsts[key] = _bucket_row(r, device, ms, level, start)
+    return [firsts[k] for k in sorted(firsts)]
+
+def iter_track_buckets(rows: Iterable[Dict[str, Any]], levels_s: Iterable[int]) -> Iterator[Dict[str, Any]]:
+    """The rows of track_buckets, streamed, for points ordered by device, time and uid:
+    the first point seen in a bucket is its first point."""
+    levels = [int(l) for l in levels_s if l > 0]
+    current: Dict[int, Tuple[str, int]] = {}  # level -> (device, bucket start) being read
+    for r in rows:
+        device, ms = r.get("device_id"), r.get("epoch_millis")
+        if device is None or ms is None or r.get("longitude") is None or r.get("latitude") is None:
+            continue
+        for level in levels:
+            start = ms - ms % (level * 1000)
+            if current.get(level) != (device, start):
+                current[level] = (device, start)
+                yield _bucket_row(r, device, ms, level, start)
@@ -0,0 +1,187 @@
+import time, asyncio
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from .fastpath import loads
+from .normalizer import normalize_items
+from . import metrics
+
+class NdjsonIngest:
+    """Incremental ingest of an NDJSON upload in bounded batches.
+
+    Every line is either one feature (`{"geometry": ..., "properties": ...}`)
+    or one v1 payload (`{"user_id", "device_id", "locations": [...]}`). Items
+    are buffered until `batch_points`, then normalized, written to the WAL and
+    handed to `upsert`. At most `max_inflight` upserts run concurrently; when
+    that many are pending, reading the request stalls until the oldest one
+    commits, which pushes back on the client through the socket.
+
+    Memory is bounded by batch_points * (max_inflight + 1) items plus one line
+    of at most `max_line_bytes`.
+    """
+    def __init__(self, default_user: str, default_device: Optional[str],
+                 wal_write: Callable[[Dict[str, Any]], Awaitable[None]],
+                 upsert: Callable[[List[Dict[str, Any]]], Awaitable[List[str]]],
+                 batch_points: int = 1000, max_inflight: int = 2,
+                 max_line_bytes: int = 1_000_000, max_rejected_reported: int = 100):
+        self.default_user = default_user
+        self.default_device = default_device
+        self.wal_write = wal_write
+        self.upsert = upsert
+        self.batch_points = max(1, batch_points)
+        self.max_inflight = max(1, max_inflight)
+        self.max_line_bytes = max_line_bytes
+        self.max_rejected_reported = max_rejected_reported
+
+        self.lines = 0
+        self.ingested = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.rejected_lines: List[int] = []
+        self.committed_lines = 0  # every line up to here is in Neo4j
+        self.min_millis: Optional[int] = None
+        self.max_millis: Optional[int] = None
+
+        self._items: List[Dict[str, Any]] = []
+        self._users: List[str] = []
+        self._devices: List[Optional[str]] = []
+        self._inflight: Deque[Tuple[asyncio.Task, int]] = deque()
+
+    # -- parsing ---------------------------------------------------------------
+
+    def _reject(self, line_no: int):
+        self.rejected += 1
+        if len(self.rejected_lines) < self.max_rejected_reported:
+            self.rejected_lines.append(line_no)
+
+    def _line(self, line_no: int, line: bytes):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            doc = loads(line)
+        except ValueError:
+            self._reject(line_no)
+            return
+        if not isinstance(doc, dict):
+            self._reject(line_no)
+            return
+        if "locations" in doc:
+            locations = doc["locations"]
+            user, device = doc.get("user_id"), doc.get("device_id")
+            if not isinstance(locations, list) or not all(isinstance(i, dict) for i in locations) \
+                    or not isinstance(user, (str, type(None))) or not isinstance(device, (str, type(None))):
+                self._reject(line_no)
+                return
+            user = user or self.default_user
+            device = device or self.default_device
+        else:
+            locations, user, device = [doc], self.default_user, self.default_device
+        self._items.extend(locations)
+        self._users.extend([user] * len(locations))
+        self._devices.extend([device] * len(locations))
+
+    async def _lines(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, bytes]]:
+        buf = b""
+        skipping = False  # inside an oversized line; discard until its newline
+        line_no = 0
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            buf += chunk
+            start = 0
+            while True:
+                nl = buf.find(b"\n", start)
+                if nl < 0:
+                    break
+                line_no = self.lines = line_no + 1
+                if skipping:
+                    skipping = False
+                    self._reject(line_no)
+                else:
+                    yield line_no, buf[start:nl]
+                start = nl + 1
+            buf = buf[start:]
+            if len(buf) > self.max_line_bytes:
+                skipping, buf = True, b""
+        if buf.strip() or skipping:
+            line_no = self.lines = line_no + 1
+            if skipping:
+                self._reject(line_no)
+            else:
+                yield line_no, buf
+
+    # -- batching --------------------------------------------------------------
+
+    async def _commit(self, normalized: List[Dict[str, Any]]) -> int:
+        return len(await self.upsert(normalized))
+
+    async def _wait_oldest(self):
+        task, upto_line = self._inflight.popleft()
+        self.ingested += await task
+        self.committed_lines = upto_line
+
+    async def _flush(self, upto_line: int):
+        if not self._items:
+            return
+        items, users, devices = self._items, self._users, self._devices
+        self._items, self._users, self._devices = [], [], []
+
+        # WAL first, one v1-shaped record per (user, device) so replay reads it as usual
+        groups: Dict[Tuple[str, Optional[str]], List[Dict[str, Any]]] = {}
+        for item, u, d in zip(items, users, devices):
+            groups.setdefault((u, d), []).append(item)
+        received_at = int(time.time() * 1000)
+        with metrics.STAGE_LATENCY.labels(stage="wal_write").time():
+            for (u, d), group in groups.items():
+                await self.wal_write({"received_at": received_at, "api": "stream",
+                                      "payload": {"user_id": u, "device_id": d, "locations": group}})
+
+        with metrics.STAGE_LATENCY.labels(stage="normalize").time():
+            normalized, dropped = normalize_items(items, default_user=users, default_device=devices)
+        metrics.INGEST_BATCH_POINTS.observe(len(normalized))
+        self.dropped += dropped
+        for rec in normalized:
+            ms = rec["epoch_millis"]
+            if self.min_millis is None or ms < self.min_millis:
+                self.min_millis = ms
+            if self.max_millis is None or ms > self.max_millis:
+                self.max_millis = ms
+        if not normalized:
+            return
+        while len(self._inflight) >= self.max_inflight:
+            await self._wait_oldest()
+        self._inflight.append((asyncio.ensure_future(self._commit(normalized)), upto_line))
+
+    async def run(self, chunks: AsyncIterator[bytes]):
+        """Consume the upload. Raises whatever the WAL or the DB raised, after
+        cancelling outstanding writes; `committed_lines` tells the client where
+        to resume."""
+        try:
+            async for line_no, line in self._lines(chunks):
+                self._line(line_no, line)
+                if len(self._items) >= self.batch_points:
+                    await self._flush(line_no)
+            await self._flush(self.lines)
+            while self._inflight:
+                await self._wait_oldest()
+            self.committed_lines = self.lines
+        except BaseException:
+            for task, _ in self._inflight:
+                task.cancel()
+            self._inflight.clear()
+            raise
+
+    def summary(self) -> Dict[str, Any]:
+        def iso(ms: Optional[int]) -> Optional[str]:
+            return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).isoformat() if ms is not None else None
+        return {
+            "lines": self.lines,
+            "ingested": self.ingested,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "rejected_lines": self.rejected_lines,
+            "committed_lines": self.committed_lines,
+            "first_timestamp": iso(self.min_millis),
+            "last_timestamp": iso(self.max_millis),
+        }
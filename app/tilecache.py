@@ -0,0 +1,154 @@
+import math, time, threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Hashable, Iterable, Optional, Set, Tuple
+from . import metrics
+
+Tile = Tuple[int, int]
+
+MAX_LAT = 85.05112878  # web mercator
+CHANGED_TILES_MAX = 100_000  # invalidation generations remembered per tile
+
+def tile_of(lon: float, lat: float, zoom: int) -> Tile:
+    """Slippy-map (x, y) tile of a point at `zoom`."""
+    n = 1 << zoom
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    r = math.radians(lat)
+    y = int((1.0 - math.log(math.tan(r) + 1.0 / math.cos(r)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def bbox_tiles(min_lon: float, min_lat: float, max_lon: float, max_lat: float, zoom: int,
+               max_tiles: int) -> Optional[FrozenSet[Tile]]:
+    """Tiles covering a bbox, or None when there are more than `max_tiles` or it crosses the antimeridian."""
+    if min_lon < -180.0 or max_lon > 180.0:
+        return None
+    x0, y1 = tile_of(min_lon, min_lat, zoom)
+    x1, y0 = tile_of(max_lon, max_lat, zoom)
+    if (x1 - x0 + 1) * (y1 - y0 + 1) > max_tiles:
+        return None
+    return frozenset((x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+
+def radius_bbox(lon: float, lat: float, radius_m: float) -> Tuple[float, float, float, float]:
+    """A bbox containing the circle (slightly larger); longitudes may run past +/-180."""
+    dlat = radius_m / 111_000.0
+    dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 90.0))), 1e-6)
+    return lon - dlon, max(-90.0, lat - dlat), lon + dlon, min(90.0, lat + dlat)
+
+class TileCache:
+    """Bounded LRU of query results, each registered under the map tiles its area covers.
+
+    The cache holds at most `capacity` entries and, when `max_rows` is set, at
+    most `max_rows` result rows in total (least recently used entries go first);
+    a single result of more than `max_result_rows` rows is not cached at all.
+
+    Writes invalidate by tile: `invalidate(rows)` drops every entry whose area
+    holds one of the written points. Entries also expire after `ttl_s`, which
+    bounds staleness from writes this process does not see (other workers,
+    replay). `token()` / `put(..., token)` keep a result read before a write
+    from being cached after that write invalidated its tiles.
+    """
+    def __init__(self, capacity: int, ttl_s: float, zoom: int = 14, max_tiles: int = 256,
+                 max_rows: int = 0, max_result_rows: int = 0):
+        self.capacity = capacity
+        self.ttl_s = ttl_s
+        self.zoom = zoom
+        self.max_tiles = max_tiles
+        self.max_rows = max_rows  # 0: no row budget
+        self.max_result_rows = max_result_rows  # 0: no per-result limit
+        self._entries: "OrderedDict[Hashable, Tuple[FrozenSet[Tile], Any, float, int]]" = OrderedDict()
+        self._rows = 0  # result rows held, summed over entries
+        self._by_tile: Dict[Tile, Set[Hashable]] = {}
+        self._changed: Dict[Tile, int] = {}  # tile -> generation of its last invalidation
+        self._gen = 0
+        self._floor = 0  # tokens older than this are refused (after _changed was pruned)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def rows(self) -> int:
+        return self._rows
+
+    def token(self) -> int:
+        return self._gen
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if self.capacity <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            metrics.QUERY_CACHE_MISSES.inc()
+            return None
+        metrics.QUERY_CACHE_HITS.inc()
+        return entry[1]
+
+    def put(self, key: Hashable, tiles: Optional[FrozenSet[Tile]], value: Any, token: int):
+        """Cache `value`, read after `token()` returned `token`; areas of too many tiles (None)
+        and results of more than `max_result_rows` rows are not cached."""
+        if self.capacity <= 0 or tiles is None:
+            return
+        rows = len(value) if hasattr(value, "__len__") else 1
+        if 0 < self.max_result_rows < rows or 0 < self.max_rows < rows:
+            return
+        evicted = 0
+        with self._lock:
+            if token < self._floor or any(self._changed.get(t, -1) > token for t in tiles):
+                return  # written to while the query ran
+            self._drop(key)
+            self._entries[key] = (tiles, value, time.monotonic() + self.ttl_s, rows)
+            self._rows += rows
+            for t in tiles:
+                self._by_tile.setdefault(t, set()).add(key)
+            while len(self._entries) > self.capacity or 0 < self.max_rows < self._rows:
+                self._drop(next(iter(self._entries)))
+                evicted += 1
+        if evicted:
+            metrics.QUERY_CACHE_EVICTIONS.inc(evicted)
+
+    def invalidate(self, rows: Iterable[Dict[str, Any]]):
+        """Drop entries covering any row's longitude/latitude."""
+        if self.capacity <= 0:
+            return
+        tiles = {tile_of(r["longitude"], r["latitude"], self.zoom) for r in rows
+                 if r.get("longitude") is not None and r.get("latitude") is not None}
+        if not tiles:
+            return
+        dropped = 0
+        with self._lock:
+            self._gen += 1
+            for t in tiles:
+                self._changed[t] = self._gen
+                for key in list(self._by_tile.get(t, ())):
+                    self._drop(key)
+                    dropped += 1
+            if len(self._changed) > CHANGED_TILES_MAX:
+                self._changed.clear()
+                self._gen += 1
+                self._floor = self._gen
+        if dropped:
+            metrics.QUERY_CACHE_INVALIDATIONS.inc(dropped)
+
+    def _drop(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._rows -= entry[3]
+        for t in entry[0]:
+            keys = self._by_tile.get(t)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tile[t]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_tile.clear()
+            self._rows = 0
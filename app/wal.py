@@ -0,0 +1,515 @@
+import os, json, gzip, zlib, time, queue, fcntl, pathlib, logging, threading, asyncio
+from contextlib import contextmanager
+from concurrent.futures import Future
+from typing import BinaryIO, Callable, Dict, Any, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from . import metrics
+from .fastpath import loads
+
+log = logging.getLogger("app.wal")
+
+DURABILITY_MODES = ("buffer", "flush", "fsync")
+SEGMENT_GLOB = "events-*.ndjson.gz"
+MANIFEST_NAME = "manifest.jsonl"
+INDEX_SUFFIX = ".idx.json"
+FRAME_MAGIC = b"\x1e"
+_STOP = object()
+
+# -- records -------------------------------------------------------------------
+#
+# A segment's (decompressed) contents are a series of records of two kinds:
+# - a JSON object on one line (records written before framing, NDJSON stream
+#   batches, compacted records);
+# - a framed request body: 0x1e, a one-line JSON header
+#   {"received_at", "api", "content_type", "rid", "len"}, then `len` bytes of
+#   body exactly as the client sent it and a newline. The body may contain
+#   newlines of its own, so readers go by `len`, not by line.
+# Either way a record counts as one "line" for checkpoints and the block index.
+
+class Framed(NamedTuple):
+    """A request body to log as received. `users`/`devices` (the owners of its
+    points) only feed the block index; None means unknown."""
+    header: Dict[str, Any]
+    body: bytes
+    users: Optional[Iterable[Any]] = None
+    devices: Optional[Iterable[Any]] = None
+
+def encode_record(obj: Union[Dict[str, Any], Framed]) -> bytes:
+    if isinstance(obj, Framed):
+        header = json.dumps(dict(obj.header, len=len(obj.body)), ensure_ascii=False, separators=(",", ":"))
+        return b"".join((FRAME_MAGIC, header.encode("utf-8"), b"\n", obj.body, b"\n"))
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+def iter_records(fh: BinaryIO) -> Iterator[Tuple[Optional[Dict[str, Any]], bytes]]:
+    """(frame header, body) or (None, line) for each record of a decompressed stream.
+
+    Stops at a truncated frame (the unsealed tail of a crashed writer).
+    """
+    while True:
+        line = fh.readline()
+        if not line:
+            return
+        if line[:1] != FRAME_MAGIC:
+            yield None, line
+            continue
+        try:
+            header = json.loads(line[1:])
+            n = int(header["len"])
+        except (ValueError, KeyError, TypeError):
+            yield None, b""  # damaged header: counted, skipped
+            continue
+        body = fh.read(n + 1)
+        if len(body) < n + 1:
+            return
+        yield header, body[:n]
+
+def decode_record(header: Optional[Dict[str, Any]], data: bytes) -> Optional[Dict[str, Any]]:
+    """The event a record stands for ({"received_at", ..., "payload"} for frames); None when undecodable."""
+    try:
+        if header is None:
+            return json.loads(data) if data.strip() else None
+        ev = {k: v for k, v in header.items() if k != "len"}
+        ev["payload"] = loads(data)
+        return ev
+    except ValueError:
+        return None
+
+def read_events(fh: BinaryIO, start_line: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """(line, event) for the records of a decompressed stream after `start_line`;
+    earlier records are read but not decoded."""
+    line_no = 0
+    for header, data in iter_records(fh):
+        line_no += 1
+        if line_no <= start_line:
+            continue
+        ev = decode_record(header, data)
+        if isinstance(ev, dict):
+            yield line_no, ev
+
+# -- segment manifest --------------------------------------------------------
+#
+# manifest.jsonl lists every sealed segment, one JSON object per line:
+#   {"segment", "worker", "seq", "first_received_at", "last_received_at",
+#    "records", "bytes", "sealed_at"}
+# Writers append under an flock on manifest.lock; maintenance rewrites it
+# atomically under the same lock.
+
+@contextmanager
+def _manifest_lock(root: pathlib.Path) -> Iterator[None]:
+    with open(root / "manifest.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _read_manifest_file(root: pathlib.Path) -> List[Dict[str, Any]]:
+    entries = []
+    try:
+        with open(root / MANIFEST_NAME, "r", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+def read_manifest(wal_dir: str) -> List[Dict[str, Any]]:
+    root = pathlib.Path(wal_dir)
+    if not root.exists():
+        return []
+    with _manifest_lock(root):
+        return _read_manifest_file(root)
+
+def append_manifest(wal_dir: str, entry: Dict[str, Any]):
+    root = pathlib.Path(wal_dir)
+    with _manifest_lock(root):
+        with open(root / MANIFEST_NAME, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(entry) + "\n")
+
+def update_manifest(wal_dir: str, fn: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]):
+    """Replace the manifest with fn(current entries), atomically and under the lock."""
+    root = pathlib.Path(wal_dir)
+    with _manifest_lock(root):
+        entries = fn(_read_manifest_file(root))
+        tmp = root / f"{MANIFEST_NAME}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            for e in entries:
+                fh.write(json.dumps(e) + "\n")
+        os.replace(tmp, root / MANIFEST_NAME)
+
+def scan_segment(path: pathlib.Path) -> Dict[str, Any]:
+    """Build a manifest entry by reading a segment (recovery / legacy files only)."""
+    first = last = None
+    records = 0
+    try:
+        with gzip.open(path, "rb") as fh:
+            for header, data in iter_records(fh):
+                if header is None and not data.strip():
+                    continue
+                records += 1
+                if header is None:
+                    try:
+                        header = json.loads(data)
+                    except ValueError:
+                        continue
+                ra = header.get("received_at") if isinstance(header, dict) else None
+                if ra is not None:
+                    lo = header.get("first_received_at", ra)
+                    first = lo if first is None else min(first, lo)
+                    last = ra if last is None else max(last, ra)
+    except (EOFError, OSError):
+        pass  # truncated tail of a segment that was never sealed
+    st = path.stat()
+    return {
+        "segment": path.name, "worker": None, "seq": None,
+        "first_received_at": first, "last_received_at": last,
+        "records": records, "bytes": st.st_size, "sealed_at": int(st.st_mtime * 1000),
+    }
+
+# -- block index ---------------------------------------------------------------
+#
+# A segment is a series of gzip members ("blocks"), each decompressible on its
+# own. `<segment>.idx.json` is written when the segment is sealed:
+#   {"version": 1, "blocks": [{"offset", "size", "first_line", "records",
+#    "min_received_at", "max_received_at", "users", "devices", "opaque"}]}
+# `first_line` is the 1-based line number of the block's first record in the
+# segment. users/devices are the ids named by the records (payload level and
+# item level); `opaque` means some item carried stringified properties that
+# might name other ids, so the block cannot be skipped by owner.
+
+def index_path(segment: pathlib.Path) -> pathlib.Path:
+    return segment.with_name(segment.name + INDEX_SUFFIX)
+
+def read_index(segment: pathlib.Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(index_path(segment), "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def write_index(segment: pathlib.Path, blocks: List[Dict[str, Any]]):
+    path = index_path(segment)
+    tmp = path.with_name(path.name + f".tmp{os.getpid()}")
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump({"version": 1, "blocks": blocks}, fh)
+    os.replace(tmp, path)
+
+def read_block(raw, offset: int, size: int) -> bytes:
+    """Decompressed contents of `size` bytes at `offset`: one or more whole gzip members."""
+    raw.seek(offset)
+    data = raw.read(size)
+    out = []
+    while data:
+        d = zlib.decompressobj(wbits=31)
+        out.append(d.decompress(data))
+        data = d.unused_data
+    return b"".join(out)
+
+def record_owners(obj: Any) -> Tuple[List[Any], List[Any], bool]:
+    """(user ids, device ids, opaque) named by one WAL record; see the block index."""
+    if isinstance(obj, dict) and isinstance(obj.get("records"), list):  # compacted, already normalized
+        recs = [r for r in obj["records"] if isinstance(r, dict)]
+        return [r.get("user_id") for r in recs], [r.get("device_id") for r in recs], False
+    payload = obj.get("payload") if isinstance(obj, dict) else None
+    if not isinstance(payload, dict):
+        return [], [], False
+    users, devices, opaque = [payload.get("user_id")], [payload.get("device_id")], False
+    items = payload.get("locations") if "locations" in payload else [payload]
+    for item in items if isinstance(items, list) else ():
+        if not isinstance(item, dict):
+            continue
+        for src in (item, item.get("properties")):
+            if isinstance(src, dict):
+                if src.get("user_id") is not None:
+                    users.append(src["user_id"])
+                if src.get("device_id") is not None:
+                    devices.append(src["device_id"])
+            elif isinstance(src, str) and ("user_id" in src or "device_id" in src):
+                opaque = True
+    return users, devices, opaque
+
+def segments(wal_dir: str, include_open: bool = False) -> List[Dict[str, Any]]:
+    """Manifest entries for the segments present in wal_dir, oldest first.
+
+    Without a manifest (a directory written before it existed) every segment is
+    scanned once. `include_open` adds segments that are not sealed yet, i.e. being
+    written by a live worker or left behind by one that crashed.
+    """
+    root = pathlib.Path(wal_dir)
+    if not root.exists():
+        return []
+    if not (root / MANIFEST_NAME).exists():
+        entries = [scan_segment(f) for f in sorted(root.glob(SEGMENT_GLOB))]
+    else:
+        entries = [e for e in read_manifest(wal_dir) if (root / e["segment"]).exists()]
+        if include_open:
+            known = {e["segment"] for e in entries}
+            entries += [scan_segment(f) for f in sorted(root.glob(SEGMENT_GLOB)) if f.name not in known]
+    entries.sort(key=lambda e: (e.get("first_received_at") or 0, e["segment"]))
+    return entries
+
+class WalWriter:
+    """Append-only gzip log fed by a bounded queue and one writer thread.
+
+    Records are dicts (one JSON line each) or `Framed` request bodies.
+
+    Each writer owns its segments: `events-<opened>-<worker>-<seq>.ndjson.gz`,
+    so several gunicorn workers never append to the same file. Sealed segments
+    are listed in the directory manifest (see `segments`).
+
+    Records are grouped: the thread takes whatever is queued (up to
+    `group_max` records, waiting at most `max_latency_ms` for stragglers),
+    writes the group, then makes it durable once according to `durability`:
+
+    - "buffer": acknowledged once compressed into the in-process gzip buffer;
+      flushed when the writer goes idle, on rotation and on close.
+    - "flush":  acknowledged after the group is flushed to the OS.
+    - "fsync":  acknowledged after the group is flushed and fsync'ed.
+
+    Within a segment a new gzip member (block) starts every `block_records`
+    records or `block_bytes` uncompressed bytes; sealing writes the block index.
+    """
+    def __init__(self, root: str, rotate_bytes: int, durability: str = "flush",
+                 queue_size: int = 10_000, max_latency_ms: float = 5.0, group_max: int = 1000,
+                 worker_id: Optional[str] = None, block_records: int = 1000, block_bytes: int = 1_000_000):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"WAL durability must be one of {DURABILITY_MODES}, got {durability!r}")
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.rotate_bytes = rotate_bytes
+        self.durability = durability
+        self.max_latency = max_latency_ms / 1000.0
+        self.group_max = max(1, group_max)
+        self._q: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+        self.block_records = max(1, block_records)
+        self.block_bytes = max(1, block_bytes)
+        self._cur: Optional[Tuple[pathlib.Path, Any, Optional[gzip.GzipFile]]] = None
+        self._dirty = False
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._auto_id = worker_id is None
+        self.worker_id = worker_id or f"p{os.getpid()}"
+        self._seq = 0
+        self._seg: Dict[str, Any] = {}
+        self._blocks: List[Dict[str, Any]] = []
+        self._block: Dict[str, Any] = {}
+
+    def after_fork(self):
+        """In a forked child: forget the parent's queue, thread and open segment
+        (the parent seals its own) and take this process's worker id."""
+        if self._cur is not None:
+            # our copy of the parent's descriptor now points at /dev/null, so the
+            # inherited buffers, flushed when collected, cannot write into its segment
+            null = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(null, self._cur[1].fileno())
+            os.close(null)
+        self._q = queue.Queue(maxsize=self._q.maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cur = None
+        self._dirty = False
+        self._closed = False
+        if self._auto_id:
+            self.worker_id = f"p{os.getpid()}"
+        self._seq = 0
+
+    # -- producer side -------------------------------------------------------
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="wal-writer", daemon=True)
+                    self._thread.start()
+
+    def submit(self, obj: Union[Dict[str, Any], Framed], block: bool = True) -> Future:
+        """Queue a record; the returned future resolves once it is durable per policy.
+
+        Blocks while the queue is full unless `block` is False, in which case
+        `queue.Full` is raised.
+        """
+        if self._closed:
+            raise RuntimeError("WAL writer is closed")
+        self._ensure_thread()
+        fut: Future = Future()
+        self._q.put((obj, fut), block=block)
+        return fut
+
+    def write(self, obj: Union[Dict[str, Any], Framed]):
+        """Synchronous write: returns once the record is durable per policy."""
+        self.submit(obj).result()
+
+    async def write_async(self, obj: Union[Dict[str, Any], Framed]):
+        """Await durability without blocking the event loop (also while the queue is full)."""
+        try:
+            fut = self.submit(obj, block=False)
+        except queue.Full:
+            loop = asyncio.get_running_loop()
+            fut = await loop.run_in_executor(None, self.submit, obj)
+        await asyncio.wrap_future(fut)
+
+    def close(self, timeout: Optional[float] = None):
+        """Drain everything queued so far, seal the current segment and stop the thread."""
+        self._closed = True
+        if self._thread is not None:
+            self._q.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    # -- writer thread -------------------------------------------------------
+
+    def _open(self):
+        ts = time.strftime("%Y%m%d-%H%M%S")
+        self._seq += 1
+        path = self.root / f"events-{ts}-{self.worker_id}-{self._seq:06d}.ndjson.gz"
+        raw = open(path, "xb")
+        self._cur = (path, raw, None)
+        self._seg = {"first_received_at": None, "last_received_at": None, "records": 0}
+        self._blocks = []
+        self._block = {}
+        log.info(f"WAL opened {path}")
+
+    def _start_block(self):
+        path, raw, _ = self._cur
+        offset = raw.tell()  # before GzipFile writes the member header
+        self._cur = (path, raw, gzip.GzipFile(fileobj=raw, mode="wb"))
+        self._block = {
+            "offset": offset, "size": 0, "first_line": self._seg["records"] + 1, "records": 0, "bytes": 0,
+            "min_received_at": None, "max_received_at": None, "users": set(), "devices": set(), "opaque": False,
+        }
+
+    def _end_block(self):
+        path, raw, gz = self._cur
+        if gz is None:
+            return
+        gz.close()  # ends the gzip member; raw stays open
+        self._cur = (path, raw, None)
+        b = self._block
+        b["size"] = raw.tell() - b["offset"]
+        b["users"] = sorted(b["users"], key=str)
+        b["devices"] = sorted(b["devices"], key=str)
+        del b["bytes"]
+        self._blocks.append(b)
+        self._block = {}
+
+    def _seal(self):
+        if self._cur is None:
+            return
+        self._end_block()
+        path, raw, _ = self._cur
+        if self.durability == "fsync":
+            raw.flush()
+            os.fsync(raw.fileno())
+        size = raw.tell()
+        raw.close()
+        self._cur = None
+        self._dirty = False
+        write_index(path, self._blocks)
+        append_manifest(str(self.root), dict(
+            self._seg, segment=path.name, worker=self.worker_id, seq=self._seq,
+            bytes=size, sealed_at=int(time.time() * 1000),
+        ))
+        metrics.WAL_ROTATIONS.inc()
+        metrics.WAL_SEGMENT_BYTES.observe(size)
+        log.info(f"WAL sealed {path}")
+
+    def _sync(self):
+        if self._cur is None or not self._dirty:
+            return
+        _, raw, gz = self._cur
+        if gz is not None:
+            gz.flush()
+        else:
+            raw.flush()
+        if self.durability == "fsync":
+            os.fsync(raw.fileno())
+        self._dirty = False
+
+    def _track(self, obj: Any):
+        seg, blk = self._seg, self._block
+        seg["records"] += 1
+        blk["records"] += 1
+        if isinstance(obj, Framed):
+            users, devices, opaque = obj.users or (), obj.devices or (), obj.users is None
+            obj = obj.header
+        else:
+            users, devices, opaque = record_owners(obj)
+        blk["users"].update(users)
+        blk["devices"].update(devices)
+        blk["opaque"] = blk["opaque"] or opaque
+        ra = obj.get("received_at") if isinstance(obj, dict) else None
+        if ra is None:
+            return
+        first = obj.get("first_received_at", ra)  # compacted records span a range
+        for d, lo, hi in ((seg, "first_received_at", "last_received_at"), (blk, "min_received_at", "max_received_at")):
+            if d[lo] is None or first < d[lo]:
+                d[lo] = first
+            if d[hi] is None or ra > d[hi]:
+                d[hi] = ra
+
+    def _commit(self, group: List[Tuple[Dict[str, Any], Future]]):
+        futures = [f for _, f in group if f.set_running_or_notify_cancel()]
+        try:
+            if self._cur is None:
+                self._open()
+            pending: List[bytes] = []
+            total = 0
+            for obj, _ in group:
+                if self._cur[2] is None:
+                    self._start_block()
+                line = encode_record(obj)
+                pending.append(line)
+                total += len(line)
+                self._block["bytes"] += len(line)
+                self._track(obj)
+                if self._block["records"] >= self.block_records or self._block["bytes"] >= self.block_bytes:
+                    self._cur[2].write(b"".join(pending))
+                    pending = []
+                    self._end_block()
+            if pending:
+                self._cur[2].write(b"".join(pending))
+            self._dirty = True
+            metrics.WAL_GROUP_RECORDS.observe(len(group))
+            metrics.WAL_GROUP_BYTES.observe(total)
+            if self.durability != "buffer":
+                self._sync()
+            if self._cur[1].tell() >= self.rotate_bytes:
+                self._seal()
+        except Exception as e:
+            log.exception("WAL write failed")
+            for f in futures:
+                f.set_exception(e)
+            return
+        for f in futures:
+            f.set_result(None)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            try:
+                item = self._q.get(timeout=self.max_latency or 0.05)
+            except queue.Empty:
+                self._sync()  # idle: make buffered records durable
+                continue
+            if item is _STOP:
+                break
+            group = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(group) < self.group_max:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                group.append(item)
+            self._commit(group)
+        self._seal()
@@ -0,0 +1,70 @@
+"""Per-process state of an API worker, for servers that fork a preloaded app.
+
+With gunicorn `preload_app`, app.main is imported once in the master and the
+workers are forked from it: the imports and settings are shared copy-on-write,
+but anything bound to a process (driver sockets, WAL file names and writer
+thread) must be made again in each worker. Modules register that with
+`on_fork`; gunicorn.conf.py calls `post_fork()` in every new worker.
+
+Kept free of heavy imports: the gunicorn hook imports it in the master.
+"""
+import os, time, logging
+from typing import Any, Callable, Dict, List, Optional
+
+log = logging.getLogger("app.worker")
+
+_hooks: List[Callable[[], None]] = []
+_imported_in = os.getpid()
+_started = time.time()  # this module's import, or the fork (post_fork)
+_ready: Optional[float] = None
+
+def on_fork(fn: Callable[[], None]) -> Callable[[], None]:
+    """Run `fn` in every worker forked after this call, before it serves."""
+    _hooks.append(fn)
+    return fn
+
+def post_fork():
+    global _started, _ready
+    _started, _ready = time.time(), None
+    for fn in _hooks:
+        fn()
+
+def preloaded() -> bool:
+    return os.getpid() != _imported_in
+
+def ready():
+    """Mark the worker ready to serve; records its boot time and memory."""
+    global _ready
+    from . import metrics
+    _ready = time.time()
+    mem = memory()
+    metrics.WORKER_STARTUP_SECONDS.set(_ready - _started)
+    if mem.get("rss_bytes"):
+        metrics.WORKER_RSS_BYTES.set(mem["rss_bytes"])
+    if mem.get("private_bytes"):
+        metrics.WORKER_PRIVATE_BYTES.set(mem["private_bytes"])
+    log.info(f"worker {os.getpid()} ready in {_ready - _started:.3f}s "
+             f"(preloaded={preloaded()}, rss={mem.get('rss_bytes', 0) >> 20}MB, private={mem.get('private_bytes', 0) >> 20}MB)")
+
+def memory() -> Dict[str, int]:
+    """Resident and private (not shared with the master or other workers) bytes; Linux only."""
+    out: Dict[str, int] = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as fh:
+            for line in fh:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Private_Clean", "Private_Dirty"):
+                    out[key] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError):
+        return out
+    return {"rss_bytes": out.get("Rss", 0), "private_bytes": out.get("Private_Clean", 0) + out.get("Private_Dirty", 0)}
+
+def status() -> Dict[str, Any]:
+    mem = memory()
+    return {
+        "pid": os.getpid(),
+        "preloaded": preloaded(),
+        "startup_s": round(_ready - _started, 3) if _ready is not None else None,
+        "rss_mb": round(mem["rss_bytes"] / 2**20, 1) if mem else None,
+        "private_mb": round(mem["private_bytes"] / 2**20, 1) if mem else None,
+    }
@@ -0,0 +1,227 @@
+import os, json, time, random, pathlib, logging, asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from .breaker import CircuitBreaker
+from . import metrics
+
+log = logging.getLogger("app.writebehind")
+
+SPILL_GLOB = "spill-*.ndjson"
+
+class WriteBehind:
+    """Drains normalized points into Neo4j after the request has been acknowledged.
+
+    Points arrive through `offer` (already durable in the WAL). Up to
+    `queue_points` are held in memory; beyond that whole batches are spilled to
+    NDJSON files under `spill_dir` and picked up again once the queue is empty.
+    Spill files are shared by all workers of a deployment: a drainer claims one
+    by renaming it, and files claimed by a dead process are taken back.
+
+    Failed writes are retried with exponential backoff (capped at
+    `max_backoff_s`); a batch is never dropped. `overloaded()` turns true at
+    `high_water` pending points, which is where the API starts answering 503.
+    Points still in memory at `stop()` are spilled, so a restart picks them up;
+    after a crash the WAL still holds them (scripts.replay_wal).
+
+    With a `breaker`, nothing is attempted while it refuses calls and every
+    write is recorded with it. `pace_points_s` caps the drain rate, so a
+    backlog does not hit a database that has just recovered at full speed.
+    """
+    def __init__(self, upsert: Callable[[List[Dict[str, Any]]], Awaitable[Any]], spill_dir: str,
+                 queue_points: int = 100_000, high_water: int = 1_000_000, batch_size: int = 1000,
+                 base_backoff_s: float = 0.5, max_backoff_s: float = 30.0,
+                 breaker: Optional[CircuitBreaker] = None, pace_points_s: float = 0.0):
+        self.upsert = upsert
+        self.spill_dir = pathlib.Path(spill_dir)
+        self.queue_points = queue_points
+        self.high_water = high_water
+        self.batch_size = max(1, batch_size)
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.breaker = breaker
+        self.pace_points_s = pace_points_s
+        self._q: Deque[Tuple[float, List[Dict[str, Any]]]] = deque()  # (enqueued at, records)
+        self._queued = 0
+        self._inflight = 0  # taken from the queue, not written yet
+        self._spilled: Dict[str, int] = {}  # this process's spill files not yet written: name -> points
+        self._spill_seq = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    # -- producer side ---------------------------------------------------------
+
+    def pending(self) -> int:
+        return self._queued + self._inflight + sum(self._spilled.values())
+
+    def overloaded(self) -> bool:
+        return self.pending() >= self.high_water
+
+    def offer(self, records: List[Dict[str, Any]]):
+        if not records:
+            return
+        if self._queued + len(records) <= self.queue_points:
+            self._q.append((time.time(), records))
+            self._queued += len(records)
+        else:
+            self._spill(records)
+        self._gauges()
+        self._wake.set()
+
+    async def put(self, records: List[Dict[str, Any]]) -> List[str]:
+        """`offer`, waiting first while over the high-water mark (for streaming uploads)."""
+        while self.overloaded():
+            await asyncio.sleep(0.05)
+        self.offer(records)
+        return [r["uid"] for r in records]
+
+    # -- spill files -----------------------------------------------------------
+
+    def _spill(self, records: List[Dict[str, Any]]):
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self._spill_seq += 1
+        name = f"spill-{int(time.time() * 1000)}-p{os.getpid()}-{self._spill_seq:06d}.ndjson"
+        tmp = self.spill_dir / (name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            for r in records:
+                fh.write(json.dumps(r, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.spill_dir / name)  # never visible half written
+        self._spilled[name] = len(records)
+        metrics.WB_SPILLED_POINTS.inc(len(records))
+
+    def _claim(self) -> Optional[pathlib.Path]:
+        if not self.spill_dir.exists():
+            return None
+        mine = f".claimed-p{os.getpid()}"
+        candidates = sorted(self.spill_dir.glob(SPILL_GLOB))
+        for f in sorted(self.spill_dir.glob(SPILL_GLOB.replace(".ndjson", ".ndjson.claimed-p*"))):
+            pid = int(f.name.rsplit("-p", 1)[1])
+            if pid == os.getpid():
+                return f
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                candidates.insert(0, f)  # its drainer died
+            except PermissionError:
+                pass
+        for f in candidates:
+            target = f.with_name(f.name.split(".claimed-", 1)[0] + mine)
+            try:
+                os.rename(f, target)
+            except FileNotFoundError:
+                continue  # another worker was faster
+            return target
+        return None
+
+    def _reconcile(self):
+        """Forget own spill files that are gone (written by this or another worker)."""
+        if not self._spilled:
+            return
+        on_disk = {f.name.split(".claimed-", 1)[0] for f in self.spill_dir.iterdir()} if self.spill_dir.exists() else set()
+        for name in [n for n in self._spilled if n not in on_disk]:
+            del self._spilled[name]
+
+    def _load(self, path: pathlib.Path) -> List[Dict[str, Any]]:
+        with open(path, "r", encoding="utf-8") as fh:
+            return [json.loads(line) for line in fh if line.strip()]
+
+    # -- drainer ---------------------------------------------------------------
+
+    def _gauges(self):
+        metrics.WB_QUEUE_POINTS.set(self._queued)
+        metrics.WB_PENDING_POINTS.set(self.pending())
+
+    def _take(self) -> Tuple[float, List[Dict[str, Any]]]:
+        enqueued_at, batch = self._q[0][0], []
+        while self._q and len(batch) + len(self._q[0][1]) <= self.batch_size:
+            batch.extend(self._q.popleft()[1])
+        if not batch:  # one oversized request
+            batch = self._q.popleft()[1]
+        self._queued -= len(batch)
+        return enqueued_at, batch
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        """Write `batch` in chunks of `batch_size`; each chunk is one breaker-allowed attempt."""
+        delay = self.base_backoff_s
+        done = 0  # points of `batch` already written
+        while done < len(batch):
+            if self.breaker is not None and not self.breaker.allow():
+                await asyncio.sleep(max(self.breaker.retry_in(), self.base_backoff_s))
+                continue
+            chunk = batch[done:done + self.batch_size]
+            start = time.time()
+            try:
+                await self.upsert(chunk)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if self.breaker is not None:
+                    self.breaker.record(False, time.time() - start)
+                metrics.DB_FAILURES.inc()
+                metrics.WB_RETRIES.inc()
+                log.exception(f"write-behind batch of {len(chunk)} failed; retrying in {delay:.1f}s")
+                await asyncio.sleep(delay * (0.5 + random.random()))
+                delay = min(delay * 2, self.max_backoff_s)
+                continue
+            elapsed = time.time() - start
+            if self.breaker is not None:
+                self.breaker.record(True, elapsed)
+            done += len(chunk)
+            metrics.WB_BATCH_POINTS.observe(len(chunk))
+            metrics.WB_BATCH_SECONDS.observe(elapsed)
+            if self.pace_points_s > 0:
+                await asyncio.sleep(len(chunk) / self.pace_points_s)
+
+    async def _run(self):
+        while True:
+            if self._q:
+                enqueued_at, batch = self._take()
+                self._inflight = len(batch)
+                try:
+                    await self._write(batch)
+                except asyncio.CancelledError:
+                    self._q.appendleft((enqueued_at, batch))
+                    self._queued += len(batch)
+                    raise
+                finally:
+                    self._inflight = 0
+                metrics.WB_LAG_SECONDS.set(time.time() - enqueued_at)
+                metrics.INGESTED_POINTS.inc(len(batch))
+                self._gauges()
+                continue
+            path = self._claim()
+            if path is not None:
+                batch = self._load(path)
+                mtime = path.stat().st_mtime
+                await self._write(batch)
+                path.unlink(missing_ok=True)
+                self._reconcile()
+                metrics.WB_LAG_SECONDS.set(time.time() - mtime)
+                metrics.INGESTED_POINTS.inc(len(batch))
+                self._gauges()
+                continue
+            metrics.WB_LAG_SECONDS.set(0)
+            self._reconcile()
+            self._gauges()
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=1.0)  # also polls for others' spill files
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop draining and spill whatever is still in memory."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._q:
+            self._spill(self._q.popleft()[1])
+        self._queued = 0
+        self._gauges()
@@ -0,0 +1,80 @@
+"""Microbenchmark: parsing stringified geometry/properties (app.normalizer._coerce_to_dict).
+
+Corpus: every stringified geometry/properties in tests/payloads, plus the dict
+ones rendered with str() the way older iOS clients send them.
+
+    python3 -m bench.coerce [--rounds 200]
+"""
+import argparse, json, pathlib, re, time
+from app import pyrepr
+from app.normalizer import _coerce_to_dict, _parse_cached
+
+PAYLOADS = pathlib.Path(__file__).resolve().parent.parent / "tests" / "payloads"
+
+# The implementation _coerce_to_dict replaced, kept verbatim for comparison.
+_LEGACY_TOKENS = (
+    ("'", '"'), (" True", " true"), (" False", " false"), (" None", " null"),
+    (": True", ": true"), (": False", ": false"), (": None", ": null"),
+)
+
+def legacy_coerce(v):
+    s = v
+    for a, b in _LEGACY_TOKENS:
+        s = s.replace(a, b)
+    s = re.sub(r",\s*}", "}", s)
+    s = re.sub(r",\s*]", "]", s)
+    try:
+        return json.loads(s)
+    except json.JSONDecodeError:
+        return None
+
+def corpus():
+    out = []
+    for f in sorted(PAYLOADS.glob("*.json")):
+        doc = json.loads(f.read_text(encoding="utf-8"))
+        items = doc.get("locations", [doc]) if isinstance(doc, dict) else []
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            for key in ("geometry", "properties"):
+                v = item.get(key)
+                if isinstance(v, str):
+                    out.append(v)
+                elif isinstance(v, dict):
+                    out.append(str(v))
+                    out.append(json.dumps(v))
+    return out
+
+def per_call_us(fn, strings, rounds, before_round=None):
+    best = float("inf")
+    for _ in range(rounds):
+        if before_round:
+            before_round()
+        t0 = time.perf_counter()
+        for s in strings:
+            fn(s)
+        best = min(best, time.perf_counter() - t0)
+    return round(best / len(strings) * 1e6, 3)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rounds", type=int, default=200)
+    args = ap.parse_args()
+
+    strings = corpus()
+    reprs = [s for s in strings if "'" in s]
+    agree = sum(1 for s in strings if legacy_coerce(s) == _coerce_to_dict(s))
+    print(json.dumps({
+        "strings": len(strings),
+        "python_repr": len(reprs),
+        "same_result_as_legacy": agree,
+        "us_per_call": {
+            "legacy": per_call_us(legacy_coerce, strings, args.rounds),
+            "pyrepr_parser": per_call_us(pyrepr.loads, strings, args.rounds),
+            "coerce_cold": per_call_us(_coerce_to_dict, strings, args.rounds, _parse_cached.cache_clear),
+            "coerce_memoized": per_call_us(_coerce_to_dict, strings, args.rounds),
+        },
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Stand-in for the Neo4j drivers, for benchmarks that must not need a database.
+
+`RecordingDriver` / `RecordingAsyncDriver` implement the part of the driver API
+app.db uses (session(), execute_write/execute_read, tx.run, result.single/
+consume/data). Every transaction sleeps `latency_s` (simulated round trip) and
+is recorded: statements, rows written and per-transaction wall time.
+
+    from bench import fakedb
+    sync_drv, async_drv = fakedb.install(latency_s=0.002)
+"""
+import time, asyncio
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Responder = Callable[[str, Dict[str, Any]], List[Dict[str, Any]]]
+
+class Recorder:
+    def __init__(self, latency_s: float = 0.0, responder: Optional[Responder] = None):
+        self.latency_s = latency_s
+        self.responder = responder
+        self.transactions = 0
+        self.rows = 0
+        self.statements: Counter = Counter()
+        self.tx_seconds: List[float] = []
+
+    def _records(self, query: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        self.statements[query.split("\n", 1)[0]] += 1
+        rows = params.get("rows")
+        if rows is not None:
+            self.rows += len(rows)
+        if self.responder is not None:
+            return self.responder(query, params)
+        return [{"n": len(rows) if rows is not None else 1, "uid": params.get("uid")}]
+
+class _Result:
+    def __init__(self, records: List[Dict[str, Any]]):
+        self._records = records
+
+    def single(self):
+        return self._records[0] if self._records else None
+
+    def data(self):
+        return list(self._records)
+
+    def consume(self):
+        return None
+
+    def __iter__(self):
+        return iter(self._records)
+
+class _Tx:
+    def __init__(self, rec: Recorder):
+        self.rec = rec
+
+    def run(self, query: str, **params) -> _Result:
+        return _Result(self.rec._records(query, params))
+
+class _Session:
+    def __init__(self, rec: Recorder):
+        self.rec = rec
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _tx(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        if self.rec.latency_s:
+            time.sleep(self.rec.latency_s)
+        out = fn(_Tx(self.rec), *args, **kwargs)
+        self.rec.transactions += 1
+        self.rec.tx_seconds.append(time.perf_counter() - start)
+        return out
+
+    execute_write = execute_read = _tx
+
+    def run(self, query: str, **params) -> _Result:
+        return self._tx(lambda tx: tx.run(query, **params))
+
+class RecordingDriver(Recorder):
+    def session(self, database=None, **kwargs) -> _Session:
+        return _Session(self)
+
+    def close(self):
+        pass
+
+class _AsyncResult(_Result):
+    async def single(self):
+        return _Result.single(self)
+
+    async def data(self):
+        return _Result.data(self)
+
+    async def consume(self):
+        return None
+
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        for r in self._records:
+            yield r
+
+class _AsyncTx(_Tx):
+    async def run(self, query: str, **params) -> _AsyncResult:
+        return _AsyncResult(self.rec._records(query, params))
+
+class _AsyncSession(_Session):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def _atx(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        if self.rec.latency_s:
+            await asyncio.sleep(self.rec.latency_s)
+        out = await fn(_AsyncTx(self.rec), *args, **kwargs)
+        self.rec.transactions += 1
+        self.rec.tx_seconds.append(time.perf_counter() - start)
+        return out
+
+    execute_write = execute_read = _atx
+
+    async def run(self, query: str, **params) -> _AsyncResult:
+        return _AsyncResult(self.rec._records(query, params))
+
+class RecordingAsyncDriver(Recorder):
+    def session(self, database=None, **kwargs) -> _AsyncSession:
+        return _AsyncSession(self)
+
+    async def close(self):
+        pass
+
+def install(latency_s: float = 0.0, responder: Optional[Responder] = None) -> Tuple[RecordingDriver, RecordingAsyncDriver]:
+    """Make app.db hand out recording drivers instead of connecting to Neo4j."""
+    from app import db
+    sync_drv = RecordingDriver(latency_s, responder)
+    async_drv = RecordingAsyncDriver(latency_s, responder)
+    db._driver, db._async_driver = sync_drv, async_drv
+    return sync_drv, async_drv
@@ -0,0 +1,62 @@
+"""Benchmark: request-body handling before normalization, model vs raw parse mode.
+
+"model" is what INGEST_PARSE_MODE=model does per request: json decode,
+IngestPayload validation, item.dict(by_alias=True) per location and
+payload.dict() for the WAL. "raw" is app.fastpath.parse_ingest_body.
+
+    python3 -m bench.ingest_parse [--rounds 30]
+"""
+import argparse, json, pathlib, time
+from app.models import IngestPayload
+from app.fastpath import parse_ingest_body
+
+PAYLOADS = pathlib.Path(__file__).resolve().parent.parent / "tests" / "payloads"
+
+def model_path(body: bytes):
+    payload = IngestPayload(**json.loads(body))
+    items = [item if isinstance(item, dict) else item.dict(by_alias=True) for item in payload.locations]
+    return payload.dict(), items
+
+def raw_path(body: bytes):
+    return parse_ingest_body(body)
+
+def bodies():
+    large = json.loads((PAYLOADS / "v1_large_batch.json").read_text())
+    strs = json.loads((PAYLOADS / "v1_stringified_props_geom.json").read_text())
+    mixed = json.loads((PAYLOADS / "v1_mixed_types.json").read_text())
+    out = {}
+    for n in (1, 10, 100, 1000):
+        locs = (large["locations"] * (n // len(large["locations"]) + 1))[:n]
+        out[f"dict_items_{n}"] = dict(large, locations=locs)
+        if n <= 100:
+            pool = strs["locations"] + mixed["locations"]
+            out[f"mixed_items_{n}"] = dict(large, locations=(pool * n)[:n])
+    return {k: (json.dumps(v).encode("utf-8"), len(v["locations"])) for k, v in out.items()}
+
+def best_seconds(fn, body, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        fn(body)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rounds", type=int, default=30)
+    args = ap.parse_args()
+
+    report = {}
+    for name, (body, points) in bodies().items():
+        m = best_seconds(model_path, body, args.rounds)
+        r = best_seconds(raw_path, body, args.rounds)
+        report[name] = {
+            "points": points,
+            "model_us_per_point": round(m / points * 1e6, 2),
+            "raw_us_per_point": round(r / points * 1e6, 2),
+            "speedup": round(m / r, 1) if r else None,
+        }
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
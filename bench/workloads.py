@@ -0,0 +1,98 @@
+"""Synthetic phone workloads, shaped like tests/payloads.
+
+Each device walks from a start point with one fix per `interval_s`; properties
+carry the fields phones actually send. A share of items is rendered the way
+older clients send them (geometry/properties as Python-repr strings) or with
+loosely typed values (string coordinates, epoch-second timestamps, boolish
+strings), in proportions set by `mix`.
+"""
+import random
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# share of items per shape: plain dicts, stringified (tests/payloads/v1_stringified_props_geom.json),
+# mixed types (v1_mixed_types.json / v1_strings_boolish.json)
+MIXES = {
+    "dict": (1.0, 0.0, 0.0),
+    "stringified": (0.0, 1.0, 0.0),
+    "mixed": (0.0, 0.0, 1.0),
+    "realistic": (0.7, 0.2, 0.1),
+}
+
+BATTERY_STATES = ("unplugged", "charging", "full")
+MOTIONS = (["stationary"], ["walking"], ["driving"], ["walking", "unknown"], [])
+START_MILLIS = 1_704_067_200_000  # 2024-01-01T00:00:00Z
+
+class Device:
+    def __init__(self, rng: random.Random, user_id: str, device_id: str, interval_s: float = 5.0):
+        self.rng = rng
+        self.user_id = user_id
+        self.device_id = device_id
+        self.interval_ms = int(interval_s * 1000)
+        self.millis = START_MILLIS + rng.randrange(0, 3_600_000)
+        self.lon = -80.8 + rng.uniform(-0.5, 0.5)
+        self.lat = 35.2 + rng.uniform(-0.5, 0.5)
+        self.battery = rng.uniform(0.3, 1.0)
+
+    def step(self) -> Tuple[int, float, float, Dict[str, Any]]:
+        rng = self.rng
+        self.millis += self.interval_ms + rng.randrange(-500, 500)
+        self.lon += rng.gauss(0, 2e-4)
+        self.lat += rng.gauss(0, 2e-4)
+        self.battery = max(0.05, self.battery - rng.uniform(0, 2e-4))
+        props = {
+            "speed": round(max(0.0, rng.gauss(3, 4)), 2),
+            "battery_level": round(self.battery, 3),
+            "battery_state": rng.choice(BATTERY_STATES),
+            "horizontal_accuracy": rng.choice((5, 10, 35, 65)),
+            "vertical_accuracy": round(rng.uniform(2, 12), 1),
+            "altitude": round(rng.uniform(180, 260), 1),
+            "motion": rng.choice(MOTIONS),
+            "wifi": rng.choice(("", "home", "office", None)),
+            "deferred": 0,
+            "significant_change": "0",
+            "locations_in_payload": 1,
+            "pauses": False,
+            "activity": "other",
+            "desired_accuracy": 100,
+        }
+        return self.millis, round(self.lon, 6), round(self.lat, 6), props
+
+def _iso(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def render(ms: int, lon: float, lat: float, props: Dict[str, Any], shape: str) -> Dict[str, Any]:
+    if shape == "stringified":
+        props = dict(props, timestamp=_iso(ms))
+        return {"type": "Feature",
+                "geometry": str({"type": "Point", "coordinates": [lon, lat]}),
+                "properties": str(props)}
+    if shape == "mixed":
+        props = dict(props, timestamp=ms // 1000, battery_level=str(props["battery_level"]),
+                     deferred="False", significant_change="True")
+        return {"type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [f" {lon} ", str(lat)]},
+                "properties": props}
+    return {"type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": dict(props, timestamp=_iso(ms))}
+
+class Workload:
+    """Endless stream of v1 payloads from `devices` devices spread over `users` users."""
+    def __init__(self, mix: str = "realistic", users: int = 3, devices: int = 20, seed: int = 1):
+        self.rng = random.Random(seed)
+        self.weights = MIXES[mix]
+        self.devices = [Device(self.rng, f"user-{i % users}", f"device-{i}") for i in range(devices)]
+
+    def items(self, n: int, device: Optional[Device] = None) -> List[Dict[str, Any]]:
+        dev = device or self.rng.choice(self.devices)
+        shapes = self.rng.choices(("dict", "stringified", "mixed"), weights=self.weights, k=n)
+        return [render(*dev.step(), shape) for shape in shapes]
+
+    def payload(self, n: int) -> Dict[str, Any]:
+        dev = self.rng.choice(self.devices)
+        return {"user_id": dev.user_id, "device_id": dev.device_id, "locations": self.items(n, dev)}
+
+    def payloads(self, count: int, points_per_payload: int) -> Iterator[Dict[str, Any]]:
+        for _ in range(count):
+            yield self.payload(points_per_payload)
@@ -6,3 +6,8 @@ CREATE INDEX phone_epoch IF NOT EXISTS FOR (p:PhoneLog) ON (p.epoch_millis);
 CREATE INDEX phone_user IF NOT EXISTS FOR (p:PhoneLog) ON (p.user_id);
 CREATE INDEX phone_device IF NOT EXISTS FOR (p:PhoneLog) ON (p.device_id);
 CREATE INDEX phone_loc IF NOT EXISTS FOR (p:PhoneLog) ON (p.loc);
+CREATE INDEX phone_device_time IF NOT EXISTS FOR (p:PhoneLog) ON (p.device_id, p.epoch_millis);
+CREATE INDEX phone_user_time IF NOT EXISTS FOR (p:PhoneLog) ON (p.user_id, p.epoch_millis);
+CREATE POINT INDEX phone_loc_point IF NOT EXISTS FOR (p:PhoneLog) ON (p.loc);
+CREATE CONSTRAINT track_bucket_key IF NOT EXISTS FOR (t:TrackBucket) REQUIRE t.key IS UNIQUE;
+CREATE INDEX track_bucket_device_time IF NOT EXISTS FOR (t:TrackBucket) ON (t.device_id, t.res_s, t.epoch_millis);
@@ -1,76 +1,350 @@
-import argparse, os, json, gzip, pathlib, sys
-from typing import Iterator, Dict, Any, List
+import argparse, os, io, json, gzip, pathlib, sys, time, queue
+import multiprocessing as mp
+from typing import Iterator, Dict, Any, List, Optional, Tuple
 from app.settings import settings
-from app.normalizer import normalize_one
-from app.db import upsert_phonelog
+from app.normalizer import normalize_items
+from app.db import upsert_phonelog_batch
+from app.query import parse_when
+from app.wal import segments, read_index, read_block, read_events
 
-def iter_events(wal_dir: str) -> Iterator[Dict[str, Any]]:
-    p = pathlib.Path(wal_dir)
-    if not p.exists():
+def list_segments(wal_dir: str, include_open: bool = False) -> List[pathlib.Path]:
+    root = pathlib.Path(wal_dir)
+    return [root / e["segment"] for e in segments(wal_dir, include_open=include_open)]
+
+def iter_events(wal_dir: str, include_open: bool = False) -> Iterator[Dict[str, Any]]:
+    for f in list_segments(wal_dir, include_open=include_open):
+        for _, _, ev in iter_file_events(f):
+            yield ev
+
+def _iter_block_events(path: pathlib.Path, blocks: List[Dict[str, Any]], start_line: int) -> Iterator[Tuple[int, int, Dict[str, Any]]]:
+    with open(path, "rb") as raw:
+        for b in blocks:
+            if b["first_line"] + b["records"] - 1 <= start_line:
+                continue
+            data = read_block(raw, b["offset"], b["size"])
+            end = b["offset"] + b["size"]
+            skip = max(0, start_line - b["first_line"] + 1)
+            for i, ev in read_events(io.BytesIO(data), skip):
+                yield b["first_line"] + i - 1, end, ev
+
+def iter_file_events(path: pathlib.Path, start_line: int = 0,
+                     blocks: Optional[List[Dict[str, Any]]] = None) -> Iterator[Tuple[int, int, Dict[str, Any]]]:
+    """Yield (line_no, compressed_offset, event) for one segment.
+
+    A line is a record (see app/wal.py), one JSON line or one framed request
+    body. Records before `start_line` are decompressed but not decoded. The
+    compressed offset is how far into the file the reader has got, used for
+    progress. With `blocks` (entries of the segment's block index) only those
+    blocks are read, each by seeking to it.
+    """
+    if blocks is not None:
+        yield from _iter_block_events(path, blocks, start_line)
         return
-    for f in sorted(p.glob("events-*.ndjson.gz")):
-        with gzip.open(f, "rt", encoding="utf-8") as fh:
-            for line in fh:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    yield json.loads(line)
-                except json.JSONDecodeError:
-                    continue
+    with open(path, "rb") as raw, gzip.GzipFile(fileobj=raw) as gz:
+        for line_no, ev in read_events(gz, start_line):
+            yield line_no, raw.tell(), ev
+
+def event_items(ev: Dict[str, Any], only_v1: bool = False) -> Tuple[List[Dict[str, Any]], str, Any]:
+    """(raw location items, default user, default device) of one WAL event."""
+    payload = ev.get("payload")
+    if payload is None:
+        return [], settings.DEFAULT_USER_ID, None
+
+    default_user = payload.get("user_id") or settings.DEFAULT_USER_ID
+    default_device = payload.get("device_id")
+
+    if "locations" in payload:
+        locations = payload["locations"]
+    else:
+        if only_v1:
+            return [], default_user, default_device
+        locations = [payload]
+    return [item for item in locations if isinstance(item, dict)], default_user, default_device
+
+def normalize_event(ev: Dict[str, Any], only_v1: bool = False) -> Tuple[List[Dict[str, Any]], int]:
+    items, default_user, default_device = event_items(ev, only_v1)
+    return normalize_items(items, default_user=default_user, default_device=default_device)
+
+class Filter:
+    """--since/--until (WAL receive time, inclusive) and --user/--device selection.
+
+    Segments and blocks are skipped using the manifest and block indexes;
+    events are then checked by received_at and points by owner (and, for
+    compacted segments, by their own received_at).
+    """
+    def __init__(self, since: Optional[int] = None, until: Optional[int] = None,
+                 users: Optional[List[str]] = None, devices: Optional[List[str]] = None):
+        self.since, self.until = since, until
+        self.users = set(users) if users else None
+        self.devices = set(devices) if devices else None
+
+    def __bool__(self):
+        return any(v is not None for v in (self.since, self.until, self.users, self.devices))
+
+    def _overlaps(self, lo, hi) -> bool:
+        if lo is None or hi is None:
+            return True  # unknown range: cannot skip
+        return not ((self.since is not None and hi < self.since) or (self.until is not None and lo > self.until))
+
+    def segment(self, entry: Dict[str, Any]) -> bool:
+        return self._overlaps(entry.get("first_received_at"), entry.get("last_received_at"))
+
+    def block(self, b: Dict[str, Any]) -> bool:
+        if not self._overlaps(b.get("min_received_at"), b.get("max_received_at")):
+            return False
+        if b.get("opaque"):
+            return True
+        if self.users is not None and not self.users & {u or settings.DEFAULT_USER_ID for u in b.get("users", [])}:
+            return False
+        if self.devices is not None and not self.devices & set(b.get("devices", [])):
+            return False
+        return True
+
+    def _within(self, ra) -> bool:
+        if ra is None:
+            return self.since is None and self.until is None
+        return (self.since is None or ra >= self.since) and (self.until is None or ra <= self.until)
+
+    def event(self, ev: Dict[str, Any]) -> bool:
+        if "first_received_at" in ev:  # compacted: its records are checked one by one
+            return self._overlaps(ev["first_received_at"], ev.get("received_at"))
+        return self._within(ev.get("received_at"))
+
+    def record(self, r: Dict[str, Any]) -> bool:
+        if "received_at" in r and not self._within(r["received_at"]):
+            return False
+        return (self.users is None or r.get("user_id") in self.users) and \
+               (self.devices is None or r.get("device_id") in self.devices)
+
+class Checkpoints:
+    """One small JSON file per segment: {"line": n, "offset": bytes, "done": bool}.
+
+    `line` is the last WAL line whose points are known to be in Neo4j; files are
+    replaced atomically so a killed run never leaves a torn checkpoint.
+    """
+    def __init__(self, root: str):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, segment: str) -> pathlib.Path:
+        return self.root / f"{segment}.ckpt"
+
+    def get(self, segment: str) -> Dict[str, Any]:
+        try:
+            return json.loads(self._path(segment).read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"line": 0, "offset": 0, "done": False}
+
+    def save(self, segment: str, line: int, offset: int, done: bool = False):
+        path = self._path(segment)
+        tmp = path.with_suffix(f".tmp{os.getpid()}")
+        tmp.write_text(json.dumps({"line": line, "offset": offset, "done": done}), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def clear(self):
+        for f in self.root.glob("*.ckpt"):
+            f.unlink(missing_ok=True)
+
+def replay_file(path: pathlib.Path, opts: Dict[str, Any], report=None, size: int = 0) -> Dict[str, Any]:
+    """Replay one segment in batches, checkpointing after every committed batch.
+
+    `size` is the segment's byte size from the manifest (progress accounting).
+    """
+    ckpt = Checkpoints(opts["checkpoint_dir"]) if opts.get("checkpoint_dir") else None
+    state = ckpt.get(path.name) if ckpt and opts.get("resume") else {"line": 0, "offset": 0, "done": False}
+    stats = {"file": path.name, "processed": 0, "ingested": 0, "dropped": 0, "error": None}
+    if state.get("done"):
+        return stats
+    flt: Filter = opts.get("filter") or Filter()
+    blocks = None
+    if flt:
+        index = read_index(path)
+        if index is not None:
+            blocks = [b for b in index["blocks"] if flt.block(b)]
+
+    batch_size = opts.get("batch_size") or settings.NEO4J_BATCH_SIZE
+    limit = opts.get("limit") or 0
+    # raw items from consecutive events are normalized together (columnar path)
+    items: List[Dict[str, Any]] = []
+    users: List[str] = []
+    devices: List[Any] = []
+    ready: List[Dict[str, Any]] = []  # records of compacted events, already normalized
+    line, offset = state.get("line", 0), state.get("offset", 0)
+    reported_offset = offset
+    events_since = 0
+
+    def flush(done: bool = False):
+        nonlocal reported_offset, events_since
+        normalized, dropped = normalize_items(items, default_user=users, default_device=devices)
+        normalized += ready
+        if flt:
+            normalized = [r for r in normalized if flt.record(r)]
+        n = len(normalized)
+        if n and not opts.get("dry_run"):
+            upsert_phonelog_batch(normalized, chunk_size=batch_size)
+        stats["ingested"] += n
+        stats["dropped"] += dropped
+        items.clear(); users.clear(); devices.clear(); ready.clear()
+        if ckpt:
+            ckpt.save(path.name, line, offset, done=done)
+        if report:
+            report(events_since, n, offset - reported_offset)
+        reported_offset, events_since = offset, 0
+
+    try:
+        finished = True
+        for ev_line, ev_offset, ev in iter_file_events(path, start_line=line, blocks=blocks):
+            if limit and stats["processed"] >= limit:
+                finished = False
+                break
+            if flt and not flt.event(ev):
+                line, offset = ev_line, ev_offset
+                continue
+            stats["processed"] += 1
+            events_since += 1
+            if isinstance(ev.get("records"), list):
+                ready.extend(ev["records"])
+            else:
+                ev_items, default_user, default_device = event_items(ev, only_v1=opts.get("only_v1", False))
+                items.extend(ev_items)
+                users.extend([default_user] * len(ev_items))
+                devices.extend([default_device] * len(ev_items))
+            line, offset = ev_line, ev_offset
+            if len(items) + len(ready) >= batch_size:
+                flush()
+        if finished:
+            offset = max(size, offset)
+        flush(done=finished)
+    except Exception as e:
+        stats["error"] = f"{type(e).__name__}: {e}"
+    return stats
+
+_progress_q = None
+
+def _init_worker(q):
+    global _progress_q
+    _progress_q = q
+
+def _worker(path: pathlib.Path, opts: Dict[str, Any], size: int) -> Dict[str, Any]:
+    return replay_file(path, opts, report=lambda e, p, b: _progress_q.put((e, p, b)), size=size)
+
+class Progress:
+    def __init__(self, total_bytes: int, interval: float):
+        self.total_bytes = max(total_bytes, 1)
+        self.interval = interval
+        self.events = self.points = self.bytes = 0
+        self.start = self._last = time.time()
+
+    def add(self, events: int, points: int, nbytes: int):
+        self.events += events
+        self.points += points
+        self.bytes += nbytes
+        if self.interval and time.time() - self._last >= self.interval:
+            self.emit()
+
+    def emit(self):
+        self._last = now = time.time()
+        elapsed = max(now - self.start, 1e-9)
+        rate = self.bytes / elapsed
+        eta = (self.total_bytes - self.bytes) / rate if rate > 0 else None
+        print(json.dumps({
+            "progress": round(100.0 * self.bytes / self.total_bytes, 1),
+            "events_per_s": round(self.events / elapsed, 1),
+            "points_per_s": round(self.points / elapsed, 1),
+            "eta_s": int(eta) if eta is not None else None,
+        }), file=sys.stderr)
 
 def main():
     ap = argparse.ArgumentParser(description="Replay WAL to Neo4j (idempotent).")
     ap.add_argument("--wal-dir", default=settings.WAL_DIR)
     ap.add_argument("--dry-run", action="store_true")
-    ap.add_argument("--limit", type=int, default=0, help="max events to process (0 = all)")
+    ap.add_argument("--limit", type=int, default=0, help="max events to process (0 = all; requires --workers 1)")
     ap.add_argument("--only-v1", action="store_true", help="ignore /api/v0 legacy entries")
+    ap.add_argument("--workers", type=int, default=1, help="segments replayed in parallel (processes)")
+    ap.add_argument("--batch-size", type=int, default=settings.NEO4J_BATCH_SIZE, help="points per bulk write")
+    ap.add_argument("--checkpoint-dir", default=None, help="default: <wal-dir>/.replay")
+    ap.add_argument("--resume", action="store_true", help="continue from existing checkpoints")
+    ap.add_argument("--include-open", action="store_true", help="also replay segments not sealed in the manifest yet")
+    ap.add_argument("--progress-interval", type=float, default=5.0, help="seconds between progress lines (0 = off)")
+    ap.add_argument("--since", default=None, help="only events received at/after this (ISO-8601 or epoch ms)")
+    ap.add_argument("--until", default=None, help="only events received at/before this (ISO-8601 or epoch ms)")
+    ap.add_argument("--user", action="append", default=None, help="only points of this user (repeatable)")
+    ap.add_argument("--device", action="append", default=None, help="only points of this device (repeatable)")
     args = ap.parse_args()
 
-    processed = ingested = dropped = 0
-
-    for ev in iter_events(args.wal_dir):
-        if args.limit and processed >= args.limit:
-            break
-        processed += 1
+    if args.limit and args.workers > 1:
+        ap.error("--limit requires --workers 1")
+    try:
+        flt = Filter(parse_when(args.since) if args.since else None, parse_when(args.until) if args.until else None,
+                     args.user, args.device)
+    except ValueError as e:
+        ap.error(f"bad --since/--until: {e}")
 
-        payload = ev.get("payload")
-        if payload is None:
-            continue
+    root = pathlib.Path(args.wal_dir)
+    entries = [e for e in segments(args.wal_dir, include_open=args.include_open) if flt.segment(e)]
+    checkpoint_dir = None
+    # a filtered run only checkpoints where asked to, so it cannot mark segments
+    # done for a later full replay
+    if not args.dry_run and (args.checkpoint_dir or not flt):
+        checkpoint_dir = args.checkpoint_dir or os.path.join(args.wal_dir, ".replay")
+        if not args.resume:
+            Checkpoints(checkpoint_dir).clear()
 
-        locations = []
-        default_user = payload.get("user_id") or settings.DEFAULT_USER_ID
-        default_device = payload.get("device_id")
+    opts = {
+        "dry_run": args.dry_run, "only_v1": args.only_v1, "limit": args.limit,
+        "batch_size": args.batch_size, "checkpoint_dir": checkpoint_dir, "resume": args.resume,
+        "filter": flt,
+    }
+    total_bytes = sum(e["bytes"] for e in entries)
+    if checkpoint_dir and args.resume:
+        ck = Checkpoints(checkpoint_dir)
+        total_bytes -= sum(ck.get(e["segment"]).get("offset", 0) for e in entries)
+    progress = Progress(total_bytes, args.progress_interval)
 
-        if "locations" in payload:
-            locations = payload["locations"]
-        else:
-            if args.only_v1:
-                continue
-            locations = [payload]
-
-        normalized: List[Dict[str, Any]] = []
-        for item in locations:
-            if not isinstance(item, dict):
-                continue
-            norm = normalize_one(item, default_user=default_user, default_device=default_device)
-            if norm is None:
-                dropped += 1
-                continue
-            normalized.append(norm)
-
-        if args.dry_run:
-            ingested += len(normalized)
-            continue
-
-        for rec in normalized:
-            try:
-                upsert_phonelog(rec)
-                ingested += 1
-            except Exception as e:
-                print(f"Upsert failed: {e}", file=sys.stderr)
+    results: List[Dict[str, Any]] = []
+    if args.workers <= 1:
+        remaining = args.limit
+        for e in entries:
+            if args.limit and remaining <= 0:
+                break
+            res = replay_file(root / e["segment"], dict(opts, limit=remaining), report=progress.add, size=e["bytes"])
+            results.append(res)
+            if args.limit:
+                remaining -= res["processed"]
+    else:
+        q = mp.Queue()
+        with mp.Pool(args.workers, initializer=_init_worker, initargs=(q,)) as pool:
+            pending = [pool.apply_async(_worker, (root / e["segment"], opts, e["bytes"])) for e in entries]
+            while pending:
+                try:
+                    progress.add(*q.get(timeout=0.5))
+                except queue.Empty:
+                    pass
+                done = [r for r in pending if r.ready()]
+                for r in done:
+                    results.append(r.get())
+                    pending.remove(r)
+            while True:
+                try:
+                    progress.add(*q.get_nowait())
+                except queue.Empty:
+                    break
 
-    print(json.dumps({"processed": processed, "ingested": ingested, "dropped": dropped}))
+    if args.progress_interval:
+        progress.emit()
+    errors = {r["file"]: r["error"] for r in results if r["error"]}
+    for name, err in errors.items():
+        print(f"Replay of {name} stopped: {err}", file=sys.stderr)
+    print(json.dumps({
+        "processed": sum(r["processed"] for r in results),
+        "ingested": sum(r["ingested"] for r in results),
+        "dropped": sum(r["dropped"] for r in results),
+        "files": len(results),
+        "failed_files": len(errors),
+        "elapsed_s": round(time.time() - progress.start, 1),
+    }))
+    if errors:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
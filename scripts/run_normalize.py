@@ -1,29 +1,260 @@
-import argparse, pathlib
-from neo4j import GraphDatabase
-import sys
+import argparse, json, os, pathlib, signal, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from app.settings import settings
+from app.normalizer import normalize_one
+from app.simplify import track_buckets
+from app import db, metrics
+
+# Legacy PhoneLog nodes: written before the API normalized on ingest (stringified
+# `geometry` / `properties`, normalized unset) or by an older normalizer
+# (schema_version below the current one). The job walks internal node ids in
+# windows; `UNWIND range(..)` + `id(n) = i` is a node-by-id seek, so a window
+# costs its width, never a label scan.
+WINDOW_CYPHER = """UNWIND range($lo, $hi - 1) AS i
+MATCH (n) WHERE id(n) = i AND n:PhoneLog
+  AND (coalesce(n.normalized, false) = false OR coalesce(n.schema_version, 0) < $version)
+RETURN id(n) AS id, properties(n) AS p
+"""
+
+FIELDS = [k for k in db.PARAM_KEYS if k != "uid"]
+
+# A legacy node only takes the computed uid when it has none and no other
+# PhoneLog holds it (the same point ingested again through the API); such
+# duplicates are normalized but keep their null uid and are reported.
+WRITE_CYPHER = """UNWIND $rows AS row
+MATCH (n) WHERE id(n) = row.id
+OPTIONAL MATCH (o:PhoneLog {uid: row.uid}) WHERE id(o) <> row.id
+SET
+  n.uid = CASE WHEN n.uid IS NULL AND o IS NULL AND row.claim THEN row.uid ELSE n.uid END,
+  """ + ",\n  ".join(f"n.{k} = row.{k}" for k in FIELDS) + """,
+  n.loc = CASE
+            WHEN row.latitude IS NOT NULL AND row.longitude IS NOT NULL
+            THEN point({latitude: toFloat(row.latitude), longitude: toFloat(row.longitude), crs: 'wgs-84'})
+            ELSE n.loc
+          END,
+  n.ts = CASE WHEN row.timestamp IS NOT NULL THEN datetime(row.timestamp) ELSE n.ts END,
+  n.schema_version = $version,
+  n.normalized = true,
+  n.updated_at = timestamp()
+WITH n, row, o
+FOREACH (_ IN CASE WHEN row.user_id IS NOT NULL THEN [1] ELSE [] END |
+  MERGE (u:User {id: row.user_id})
+  MERGE (n)-[:BY_USER]->(u)
+)
+FOREACH (_ IN CASE WHEN row.device_id IS NOT NULL THEN [1] ELSE [] END |
+  MERGE (d:Device {id: row.device_id})
+  MERGE (n)-[:FROM_DEVICE]->(d)
+)
+RETURN count(*) AS n, sum(CASE WHEN o IS NOT NULL OR NOT row.claim THEN 1 ELSE 0 END) AS duplicates
+"""
+
+# Nodes normalize_one rejects (no coordinates or timestamp) are marked so they
+# are not picked up again; their properties are left as they are.
+UNPARSED_CYPHER = """UNWIND $ids AS i
+MATCH (n) WHERE id(n) = i
+SET n.schema_version = $version, n.normalized = true, n.normalize_error = 'unparsed'
+"""
+
+MAX_ID_CYPHER = "MATCH (n:PhoneLog) RETURN max(id(n)) AS max_id"
+
+# top-level fields of a node written by an older normalizer, rebuilt into a raw item
+PROP_FIELDS = ("timestamp", "speed", "battery_state", "motion", "battery_level", "vertical_accuracy",
+               "horizontal_accuracy", "pauses", "wifi", "deferred", "significant_change",
+               "locations_in_payload", "activity", "altitude", "desired_accuracy")
+
+def legacy_item(p: Dict[str, Any]) -> Dict[str, Any]:
+    """The raw item a stored node came from, in the shape the ingest API receives."""
+    geometry = p.get("geometry")
+    if geometry is None and p.get("coordinates") is not None:
+        geometry = {"type": p.get("geom_type") or "Point", "coordinates": p["coordinates"]}
+    properties = p.get("properties")
+    if properties is None:
+        properties = {k: p[k] for k in PROP_FIELDS if p.get(k) is not None}
+    return {"geometry": geometry, "properties": properties, "user_id": p.get("user_id"), "device_id": p.get("device_id")}
+
+def normalize_window(tx, lo: int, hi: int, version: int, dry_run: bool = False) -> Dict[str, int]:
+    """Re-normalize the legacy nodes with internal ids in [lo, hi), in one transaction."""
+    rows: List[Dict[str, Any]] = []
+    unparsed: List[int] = []
+    claimed = set()
+    for rec in tx.run(WINDOW_CYPHER, lo=lo, hi=hi, version=version):
+        norm = normalize_one(legacy_item(rec["p"]), default_user=settings.DEFAULT_USER_ID, default_device=None)
+        if norm is None:
+            unparsed.append(rec["id"])
+            continue
+        row = db._params(norm)
+        row.update(id=rec["id"], claim=row["uid"] not in claimed)
+        claimed.add(row["uid"])
+        rows.append(row)
+    stats = {"normalized": len(rows), "unparsed": len(unparsed), "duplicates": 0}
+    if dry_run:
+        return stats
+    if rows:
+        stats["duplicates"] = tx.run(WRITE_CYPHER, rows=rows, version=version).single()["duplicates"]
+        buckets = track_buckets(rows, settings.TRACK_BUCKET_LEVELS_S)
+        if buckets:
+            tx.run(db.TRACK_BUCKETS_CYPHER, buckets=buckets).consume()
+    if unparsed:
+        tx.run(UNPARSED_CYPHER, ids=unparsed, version=version).consume()
+    return stats
+
+def plan(max_id: int, partitions: int) -> List[Dict[str, Any]]:
+    """Split internal ids [0, max_id] into contiguous partitions."""
+    total = max_id + 1
+    partitions = max(1, min(partitions, total))
+    step = -(-total // partitions)
+    return [{"lo": lo, "hi": min(lo + step, total), "next": lo} for lo in range(0, total, step)]
+
+class Checkpoint:
+    """The job's state in one JSON file, replaced atomically after every committed window."""
+    def __init__(self, path: str):
+        self.path = pathlib.Path(path)
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, state: Dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".tmp{os.getpid()}")
+        tmp.write_text(json.dumps(state), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+class Job:
+    """Runs partitions concurrently, one thread and session each.
+
+    Every window is its own write transaction; its partition's `next` id is
+    checkpointed only after the commit, so a paused (`stop`) or killed job
+    resumes at the first window not yet written. Windows already written are
+    not selected again anyway (they are normalized at the current version).
+    """
+    def __init__(self, state: Dict[str, Any], window: int, workers: int, checkpoint: Optional[Checkpoint] = None,
+                 dry_run: bool = False, sleep_s: float = 0.0, progress_interval: float = 0.0):
+        self.state = state
+        self.window = max(1, window)
+        self.workers = max(1, workers)
+        self.checkpoint = checkpoint
+        self.dry_run = dry_run
+        self.sleep_s = sleep_s
+        self.progress_interval = progress_interval
+        self.stop = threading.Event()
+        self.errors: Dict[int, str] = {}
+        self.run_stats = {"windows": 0, "normalized": 0, "unparsed": 0, "duplicates": 0}
+        self._lock = threading.Lock()
+        self._start = self._last = time.time()
+        self._covered_at_start = self._covered()
+
+    def _covered(self) -> int:
+        return sum(p["next"] - p["lo"] for p in self.state["partitions"])
+
+    def _total(self) -> int:
+        return max(1, sum(p["hi"] - p["lo"] for p in self.state["partitions"]))
+
+    def _done(self, part: Dict[str, Any], hi: int, stats: Dict[str, int]):
+        with self._lock:
+            part["next"] = hi
+            self.run_stats["windows"] += 1
+            for k in ("normalized", "unparsed", "duplicates"):
+                self.run_stats[k] += stats[k]
+                self.state["totals"][k] = self.state["totals"].get(k, 0) + stats[k]
+                if stats[k] and not self.dry_run:
+                    metrics.NORMALIZE_NODES.labels(outcome=k).inc(stats[k])
+            metrics.NORMALIZE_PROGRESS.set(self._covered() / self._total())
+            if self.checkpoint:
+                self.checkpoint.save(self.state)
+            if self.progress_interval and time.time() - self._last >= self.progress_interval:
+                self.emit()
+
+    def _partition(self, i: int):
+        part = self.state["partitions"][i]
+        version = self.state["schema_version"]
+        try:
+            with db.get_driver().session(database=settings.NEO4J_DATABASE) as s:
+                run = s.execute_read if self.dry_run else s.execute_write
+                while part["next"] < part["hi"] and not self.stop.is_set():
+                    hi = min(part["next"] + self.window, part["hi"])
+                    stats = run(normalize_window, part["next"], hi, version, self.dry_run)
+                    self._done(part, hi, stats)
+                    if self.sleep_s:
+                        self.stop.wait(self.sleep_s)
+        except Exception as e:
+            self.errors[i] = f"{type(e).__name__}: {e}"
+
+    def run(self) -> Dict[str, Any]:
+        todo = [i for i, p in enumerate(self.state["partitions"]) if p["next"] < p["hi"]]
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(self._partition, todo))
+        left = sum(1 for p in self.state["partitions"] if p["next"] < p["hi"])
+        return dict(self.run_stats, partitions=len(self.state["partitions"]), partitions_left=left,
+                    complete=left == 0, paused=self.stop.is_set() and left > 0, failed_partitions=len(self.errors),
+                    totals=self.state["totals"], elapsed_s=round(time.time() - self._start, 1))
+
+    def emit(self):
+        self._last = now = time.time()
+        elapsed = max(now - self._start, 1e-9)
+        done = self._covered()
+        rate = (done - self._covered_at_start) / elapsed
+        print(json.dumps({
+            "progress": round(100.0 * done / self._total(), 1),
+            "nodes_per_s": round(sum(self.run_stats[k] for k in ("normalized", "unparsed")) / elapsed, 1),
+            "eta_s": int((self._total() - done) / rate) if rate > 0 else None,
+        }), file=sys.stderr)
 
 def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--uri", required=True)
-    ap.add_argument("--user", required=True)
-    ap.add_argument("--password", required=True)
-    ap.add_argument("--database", default=None)
-    ap.add_argument("--cypher-file", default="db/phlog_normalize.cypher")
+    ap = argparse.ArgumentParser(description="Re-normalize legacy PhoneLog nodes with the ingest normalizer "
+                                             "(partitioned, resumable).")
+    ap.add_argument("--uri", default=None, help="default: NEO4J_URI")
+    ap.add_argument("--user", default=None, help="default: NEO4J_USER")
+    ap.add_argument("--password", default=None, help="default: NEO4J_PASSWORD")
+    ap.add_argument("--database", default=None, help="default: NEO4J_DATABASE")
+    ap.add_argument("--schema-version", type=int, default=1, help="nodes below this version are re-normalized")
+    ap.add_argument("--workers", type=int, default=4, help="partitions processed concurrently")
+    ap.add_argument("--partitions", type=int, default=0, help="id-range partitions (default: 4 per worker)")
+    ap.add_argument("--window", type=int, default=5000, help="internal ids per transaction")
+    ap.add_argument("--sleep", type=float, default=0.0, help="pause between a partition's windows (s), to go easy on a live DB")
+    ap.add_argument("--checkpoint", default=".normalize.ckpt.json")
+    ap.add_argument("--resume", action="store_true", help="continue from the checkpoint")
+    ap.add_argument("--dry-run", action="store_true", help="read and normalize, write nothing")
+    ap.add_argument("--progress-interval", type=float, default=5.0, help="seconds between progress lines (0 = off)")
+    ap.add_argument("--metrics-port", type=int, default=0, help="serve app_normalize_* metrics on this port")
     args = ap.parse_args()
 
-    cypher_path = pathlib.Path(args.cypher_file)
-    if not cypher_path.exists():
-        print(f"Missing {cypher_path}", file=sys.stderr)
-        sys.exit(1)
+    for flag, name in (("uri", "NEO4J_URI"), ("user", "NEO4J_USER"), ("password", "NEO4J_PASSWORD"),
+                       ("database", "NEO4J_DATABASE")):
+        if getattr(args, flag) is not None:
+            setattr(settings, name, getattr(args, flag))
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+        start_http_server(args.metrics_port, registry=metrics.registry)
 
-    with open(cypher_path, "r", encoding="utf-8") as f:
-        cypher = f.read()
+    ckpt = None if args.dry_run else Checkpoint(args.checkpoint)
+    state = ckpt.load() if ckpt and args.resume else None
+    if state is not None and state.get("schema_version") != args.schema_version:
+        ap.error(f"checkpoint is for schema version {state.get('schema_version')}")
+    if state is None:
+        with db.get_driver().session(database=settings.NEO4J_DATABASE) as s:
+            max_id = s.run(MAX_ID_CYPHER).single()["max_id"]
+        state = {"schema_version": args.schema_version, "max_id": max_id, "totals": {},
+                 "partitions": plan(max_id, args.partitions or 4 * args.workers) if max_id is not None else []}
+        if ckpt:
+            ckpt.save(state)
 
-    driver = GraphDatabase.driver(args.uri, auth=(args.user, args.password))
-    with driver.session(database=args.database) as s:
-        res = s.run(cypher)
-        list(res)
-    print("Normalization job executed.")
+    job = Job(state, args.window, args.workers, ckpt, args.dry_run, args.sleep, args.progress_interval)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: job.stop.set())
+    report = job.run()
+    if args.progress_interval:
+        job.emit()
+    for i, err in sorted(job.errors.items()):
+        p = state["partitions"][i]
+        print(f"Partition {p['lo']}-{p['hi']} stopped at id {p['next']}: {err}", file=sys.stderr)
+    print(json.dumps(report))
+    db.close_driver()
+    if job.errors:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
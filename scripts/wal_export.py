@@ -0,0 +1,258 @@
+import argparse, json, os, pathlib, shutil, sys, time, zlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from app.settings import settings
+from app.db import PARAM_KEYS
+from app.simplify import iter_track_buckets
+from app.wal import segments
+from scripts.wal_prune import _partition_segment, _latest_by_uid
+
+# Offline rebuild: every WAL point, deduplicated by uid (the last written copy
+# wins, as with replay), as CSV files for `neo4j-admin database import full`.
+# Points go through the same on-disk device partitions and external sort as deep
+# compaction, so memory is bounded by the sort's run size, not by the WAL or by
+# one device's history.
+
+# (property, neo4j-admin type) for what UPSERT_CYPHER sets from PARAM_KEYS.
+# Every value keeps its own type, as UPSERT_CYPHER stores it unchanged: a row
+# with a value of another type (65 for speed, "high" for battery_level,
+# "walking" for motion) goes to a PhoneLog file group whose header types that
+# column as the value is. Those rows are counted per property in the report.
+PHONELOG_COLUMNS: List[Tuple[str, str]] = [
+    ("user_id", "string"), ("device_id", "string"), ("geom_type", "string"), ("coordinates", "double[]"),
+    ("longitude", "double"), ("latitude", "double"), ("timestamp", "string"), ("epoch_millis", "long"),
+    ("speed", "double"), ("battery_state", "string"), ("motion", "string[]"), ("battery_level", "double"),
+    ("vertical_accuracy", "double"), ("horizontal_accuracy", "double"), ("pauses", "boolean"), ("wifi", "string"),
+    ("deferred", "long"), ("significant_change", "string"), ("locations_in_payload", "long"),
+    ("activity", "string"), ("altitude", "double"), ("desired_accuracy", "long"),
+]
+# set by UPSERT_CYPHER itself; created_at/updated_at become the point's WAL received_at
+EXTRA_COLUMNS = ["loc:point{crs:WGS-84}", "created_at:long", "updated_at:long", "schema_version:long", "normalized:boolean"]
+BUCKET_COLUMNS: List[Tuple[str, str]] = [
+    ("device_id", "string"), ("user_id", "string"), ("res_s", "long"), ("bucket_ms", "long"), ("day", "string"),
+    ("uid", "string"), ("epoch_millis", "long"), ("longitude", "double"), ("latitude", "double"),
+]
+
+def phonelog_header(overrides: Optional[List[Tuple[str, str]]] = None) -> List[str]:
+    """The PhoneLog header, with (property, type) overrides for a fallback file group."""
+    kinds = dict(PHONELOG_COLUMNS, **dict(overrides or ()))
+    return ["uid:ID(PhoneLog)"] + [f"{n}:{kinds[n]}" for n, _ in PHONELOG_COLUMNS] + EXTRA_COLUMNS
+
+def group_id(overrides: List[Tuple[str, str]]) -> str:
+    return "t%08x" % zlib.crc32(json.dumps(overrides).encode("utf-8"))
+
+HEADERS = {
+    "phonelog": phonelog_header(),
+    "by_user": [":START_ID(PhoneLog)", ":END_ID(User)"],
+    "from_device": [":START_ID(PhoneLog)", ":END_ID(Device)"],
+    "trackbucket": ["key:ID(TrackBucket)"] + [f"{n}:{t}" for n, t in BUCKET_COLUMNS],
+    "user": ["id:ID(User)"],
+    "device": ["id:ID(Device)"],
+}
+FIELDS = PARAM_KEYS + ["received_at"]
+# about 2 MB of gzipped WAL per partition: small units of work to spread over the workers
+PARTITION_INPUT_BYTES = 2_000_000
+
+def _row(cells: List[Optional[str]]) -> str:
+    # every value quoted, so "" stays an empty string; an empty field is no property
+    return ",".join("" if c is None else '"' + c.replace('"', '""') + '"' for c in cells) + "\n"
+
+# values already of the column's type, checked and formatted inline (the bulk of them)
+_NATIVE = {"string": (str, str), "double": (float, repr), "long": (int, str),
+           "boolean": (bool, lambda v: "true" if v else "false")}
+
+def _cell(value: Any) -> Optional[str]:
+    """Field text for `value` in the type `_value_kind(value)` gives it."""
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return ";".join(_cell(v) for v in value if v is not None)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _count(d: Dict[str, int], key: str):
+    d[key] = d.get(key, 0) + 1
+
+def _value_kind(value: Any) -> Optional[str]:
+    """The neo4j-admin type Neo4j would store `value` as; None when it cannot be a property."""
+    if isinstance(value, bool):
+        return "boolean"
+    for t, kind in ((int, "long"), (float, "double"), (str, "string")):
+        if isinstance(value, t):
+            return kind
+    if isinstance(value, list):
+        kinds = {_value_kind(v) for v in value if v is not None}
+        if not kinds:
+            return "string[]"
+        if len(kinds) == 1 and not next(iter(kinds)).endswith("[]"):
+            return kinds.pop() + "[]"
+    return None
+
+def _export_partition(k: int, files: List[str], out_dir: str, levels: List[int]) -> Dict[str, Any]:
+    out = pathlib.Path(out_dir)
+    stats: Dict[str, Any] = {"points": 0, "users": set(), "devices": set(), "track_buckets": 0,
+                             "fallback": {}, "groups": {}}
+    # device/time order from the partition sort: buckets are found while streaming
+    records = _latest_by_uid(files, os.path.join(out_dir, ".parts", f"runs{k:04d}"))
+    with ExitStack() as stack:
+        node_files: Dict[str, Any] = {}
+
+        def nodes(group: str):
+            if group not in node_files:
+                name = f"phonelog-{group}-p{k:04d}.csv" if group else f"phonelog-p{k:04d}.csv"
+                node_files[group] = stack.enter_context(open(out / name, "w", encoding="utf-8"))
+            return node_files[group]
+
+        nodes("")
+        by_user = stack.enter_context(open(out / f"by_user-p{k:04d}.csv", "w", encoding="utf-8"))
+        from_device = stack.enter_context(open(out / f"from_device-p{k:04d}.csv", "w", encoding="utf-8"))
+        buckets = stack.enter_context(open(out / f"trackbucket-p{k:04d}.csv", "w", encoding="utf-8"))
+        for b in iter_track_buckets(_written(records, stats, nodes, by_user, from_device), levels):
+            buckets.write(_row([b["key"]] + [_cell(b.get(n)) for n, _ in BUCKET_COLUMNS]))
+            stats["track_buckets"] += 1
+    if not stats["track_buckets"]:
+        (out / f"trackbucket-p{k:04d}.csv").unlink()
+    return stats
+
+def _written(records: Iterator[Dict[str, Any]], stats: Dict[str, Any], nodes, by_user, from_device) -> Iterator[Dict[str, Any]]:
+    """Write each record's PhoneLog row (to the file group `nodes(group)`) and
+    relationships, then pass it on."""
+    for r in records:
+        stats["points"] += 1
+        cells = [r["uid"]]
+        overrides: List[Tuple[str, str]] = []
+        for name, kind in PHONELOG_COLUMNS:
+            value = r.get(name)
+            native = _NATIVE.get(kind)
+            if value is None or (native is not None and type(value) is native[0]):
+                cells.append(None if value is None else native[1](value))
+                continue
+            found = _value_kind(value)
+            if found is None:
+                raise ValueError(f"point {r['uid']}: {name}={value!r} cannot be stored as a Neo4j property")
+            if found != kind:
+                overrides.append((name, found))
+                _count(stats["fallback"], name)
+            cells.append(_cell(value))
+        lon, lat = r.get("longitude"), r.get("latitude")
+        loc = f"{{latitude:{float(lat)!r},longitude:{float(lon)!r}}}" \
+            if isinstance(lon, (int, float)) and isinstance(lat, (int, float)) else None
+        at = None if r.get("received_at") is None else str(int(r["received_at"]))
+        group = ""
+        if overrides:
+            group = group_id(overrides)
+            stats["groups"][group] = overrides
+        nodes(group).write(_row(cells + [loc, at, at, "1", "true"]))
+        if r.get("user_id") is not None:
+            by_user.write(_row([r["uid"], str(r["user_id"])]))
+            stats["users"].add(str(r["user_id"]))
+        if r.get("device_id") is not None:
+            from_device.write(_row([r["uid"], str(r["device_id"])]))
+            stats["devices"].add(str(r["device_id"]))
+        yield r
+
+def import_command(import_dir: str, database: str, buckets: bool, groups: List[str] = ()) -> str:
+    d = import_dir.rstrip("/")
+    parts = ["neo4j-admin database import full --overwrite-destination --multiline-fields=true",
+             f"--nodes=PhoneLog={d}/phonelog-header.csv,{d}/phonelog-p.*"]
+    parts += [f"--nodes=PhoneLog={d}/phonelog-{g}-header.csv,{d}/phonelog-{g}-p.*" for g in groups]
+    parts += [f"--nodes=User={d}/user-header.csv,{d}/user.csv",
+              f"--nodes=Device={d}/device-header.csv,{d}/device.csv"]
+    if buckets:
+        parts.append(f"--nodes=TrackBucket={d}/trackbucket-header.csv,{d}/trackbucket-p.*")
+    parts += [f"--relationships=BY_USER={d}/by_user-header.csv,{d}/by_user-p.*",
+              f"--relationships=FROM_DEVICE={d}/from_device-header.csv,{d}/from_device-p.*",
+              database]
+    return " ".join(parts)
+
+def export(wal_dir: str, out_dir: str, workers: int = 0, partitions: int = 0, include_open: bool = False,
+           levels: Optional[List[int]] = None, import_dir: Optional[str] = None, database: str = "neo4j") -> Dict[str, Any]:
+    """Write neo4j-admin import CSVs for every point in the WAL; returns the report."""
+    start = time.time()
+    out = pathlib.Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    entries = segments(wal_dir, include_open=include_open)
+    paths = [pathlib.Path(wal_dir) / e["segment"] for e in entries]
+    input_bytes = sum(e["bytes"] for e in entries)
+    workers = workers or os.cpu_count() or 1
+    partitions = partitions or max(workers, input_bytes // PARTITION_INPUT_BYTES + 1)
+    levels = list(settings.TRACK_BUCKET_LEVELS_S if levels is None else levels)
+    tmp_dir = out / ".parts"
+    tmp_dir.mkdir()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+            parts = list(pool.map(_partition_segment, paths, range(len(paths)), [str(tmp_dir)] * len(paths),
+                                  [partitions] * len(paths), [FIELDS] * len(paths)))
+            print(f"partitioned {len(paths)} segments into {partitions} partitions", file=sys.stderr)
+            by_part: Dict[int, List[str]] = {}
+            for f in sorted(tmp_dir.iterdir()):
+                by_part.setdefault(int(f.name[1:5]), []).append(str(f))
+            exported = []
+            for stats in pool.map(_export_partition, list(by_part), list(by_part.values()),
+                                  [str(out)] * len(by_part), [levels] * len(by_part)):
+                exported.append(stats)
+                print(f"exported {len(exported)}/{len(by_part)} partitions", file=sys.stderr)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    users = sorted(set().union(*(s["users"] for s in exported)))
+    devices = sorted(set().union(*(s["devices"] for s in exported)))
+    for name, ids in (("user", users), ("device", devices)):
+        with open(out / f"{name}.csv", "w", encoding="utf-8") as fh:
+            fh.writelines(_row([i]) for i in ids)
+    buckets = sum(s["track_buckets"] for s in exported)
+    for name, columns in HEADERS.items():
+        if name != "trackbucket" or buckets:
+            (out / f"{name}-header.csv").write_text(",".join(columns) + "\n", encoding="utf-8")
+
+    groups = dict(g for s in exported for g in s["groups"].items())
+    for g, overrides in groups.items():
+        (out / f"phonelog-{g}-header.csv").write_text(",".join(phonelog_header(overrides)) + "\n", encoding="utf-8")
+
+    fallback: Dict[str, int] = {}
+    for s in exported:
+        for name, n in s["fallback"].items():
+            fallback[name] = fallback.get(name, 0) + n
+    input_points = sum(p["points"] for p in parts)
+    points = sum(s["points"] for s in exported)
+    return {
+        "segments": len(entries), "input_bytes": input_bytes, "partitions": partitions,
+        "input_points": input_points, "points": points, "duplicates": input_points - points,
+        "dropped": sum(p["dropped"] for p in parts), "users": len(users), "devices": len(devices),
+        "track_buckets": buckets, "fallback": fallback,
+        "fallback_groups": {g: dict(o) for g, o in sorted(groups.items())},
+        "elapsed_s": round(time.time() - start, 1),
+        "command": import_command(import_dir or str(out.resolve()), database, bool(buckets), sorted(groups)),
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Export the WAL as neo4j-admin import CSVs (offline rebuild of an empty database).")
+    ap.add_argument("--wal-dir", default=settings.WAL_DIR)
+    ap.add_argument("--out-dir", required=True, help="must be empty or not exist")
+    ap.add_argument("--workers", type=int, default=0, help="processes (default: CPU count)")
+    ap.add_argument("--partitions", type=int, default=0,
+                    help="device partitions, exported in parallel (default: one per 2 MB of WAL)")
+    ap.add_argument("--include-open", action="store_true", help="also read segments that are not sealed")
+    ap.add_argument("--import-dir", default=None,
+                    help="where neo4j-admin will see --out-dir, for the printed command (default: --out-dir)")
+    ap.add_argument("--database", default=settings.NEO4J_DATABASE or "neo4j")
+    args = ap.parse_args()
+
+    out = pathlib.Path(args.out_dir)
+    if out.exists() and any(out.iterdir()):
+        ap.error(f"{out} is not empty")
+    try:
+        report = export(args.wal_dir, args.out_dir, args.workers, args.partitions, args.include_open,
+                        import_dir=args.import_dir, database=args.database)
+    except ValueError as e:
+        print(f"Export stopped: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(report))
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
-import argparse, pathlib, gzip, shutil, time, json, sys
-from typing import List
+import argparse, heapq, os, pathlib, shutil, time, json, sys, zlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from app.settings import settings
+from app.wal import (WalWriter, segments, scan_segment, read_manifest, append_manifest, update_manifest,
+                     index_path, read_index, write_index, SEGMENT_GLOB, MANIFEST_NAME)
+from scripts.replay_wal import iter_file_events, normalize_event
 
 def list_wal_files(wal_dir: pathlib.Path) -> List[pathlib.Path]:
-    return sorted(wal_dir.glob("events-*.ndjson.gz"))
+    return [wal_dir / e["segment"] for e in segments(str(wal_dir))]
 
-def file_age_days(p: pathlib.Path) -> float:
-    return (time.time() - p.stat().st_mtime) / 86400.0
+def entry_age_days(e: Dict[str, Any]) -> float:
+    last = e.get("last_received_at") or e.get("sealed_at") or 0
+    return (time.time() * 1000 - last) / 86_400_000.0
 
 def human(n):
     for unit in ['','K','M','G','T']:
@@ -14,67 +22,310 @@ def human(n):
         n /= 1024.0
     return f"{n:.1f}PB"
 
+def _drop_from_manifest(wal_dir: str, names):
+    names = set(names)
+    if names and (pathlib.Path(wal_dir) / MANIFEST_NAME).exists():
+        update_manifest(wal_dir, lambda entries: [e for e in entries if e["segment"] not in names])
+
 def prune(wal_dir: str, keep_days: int, archive_dir: str = None, dry_run: bool = False):
     wd = pathlib.Path(wal_dir)
-    files = list_wal_files(wd)
     archived = deleted = 0
-    for f in files:
-        age = file_age_days(f)
+    gone = []
+    for e in segments(wal_dir):
+        f = wd / e["segment"]
+        age = entry_age_days(e)
         if age <= keep_days:
             continue
         if dry_run:
-            print(f"DRY-RUN would prune {f.name} age={age:.1f}d size={human(f.stat().st_size)}", file=sys.stderr)
+            print(f"DRY-RUN would prune {f.name} age={age:.1f}d size={human(e['bytes'])}", file=sys.stderr)
             continue
         if archive_dir:
             ad = pathlib.Path(archive_dir); ad.mkdir(parents=True, exist_ok=True)
             shutil.move(str(f), str(ad / f.name))
+            if index_path(f).exists():
+                shutil.move(str(index_path(f)), str(index_path(ad / f.name)))
+            append_manifest(str(ad), e)
             archived += 1
         else:
             f.unlink(missing_ok=True)
+            index_path(f).unlink(missing_ok=True)
             deleted += 1
+        gone.append(e["segment"])
+    _drop_from_manifest(wal_dir, gone)
     return archived, deleted
 
-def compact(wal_dir: str, max_compact_size: int, output_name: str = None, dry_run: bool = False, delete_originals: bool = False):
+COMPACT_MODES = ("fast", "deep")
+EVENT_RECORDS = 500  # canonical records per compacted WAL line
+SORT_RUN_RECORDS = 200_000  # records sorted in memory at a time per partition (deep mode, wal_export)
+
+def _out_entry(name: str, size: int, entries: List[Dict[str, Any]], records: int) -> Dict[str, Any]:
+    firsts = [e["first_received_at"] for e in entries if e.get("first_received_at") is not None]
+    lasts = [e["last_received_at"] for e in entries if e.get("last_received_at") is not None]
+    return {
+        "segment": name, "worker": "compact", "seq": None,
+        "first_received_at": min(firsts) if firsts else None,
+        "last_received_at": max(lasts) if lasts else None,
+        "records": records, "bytes": size, "sealed_at": int(time.time() * 1000),
+    }
+
+def _concat(wd: pathlib.Path, entries: List[Dict[str, Any]], out_path: pathlib.Path) -> List[Dict[str, Any]]:
+    """Append the segments' bytes to out_path (gzip members concatenate) and merge their block indexes."""
+    blocks: List[Dict[str, Any]] = []
+    lines = 0
+    with open(out_path, "xb") as out:
+        for e in entries:
+            src = wd / e["segment"]
+            base = out.tell()
+            with open(src, "rb") as inp:
+                shutil.copyfileobj(inp, out, 1 << 20)
+            idx = read_index(src)
+            if idx is None:
+                # unindexed segment: one opaque block spanning all its members
+                blocks.append({"offset": base, "size": out.tell() - base, "first_line": lines + 1,
+                               "records": e["records"], "min_received_at": e.get("first_received_at"),
+                               "max_received_at": e.get("last_received_at"), "users": [], "devices": [], "opaque": True})
+            else:
+                blocks += [dict(b, offset=b["offset"] + base, first_line=b["first_line"] + lines) for b in idx["blocks"]]
+            lines += e["records"]
+    return blocks
+
+def _partition_segment(path: pathlib.Path, order: int, tmp_dir: str, partitions: int,
+                       fields: Optional[List[str]] = None) -> Dict[str, int]:
+    """Normalize one segment into per-partition NDJSON files (partition = hash of device_id).
+
+    With `fields`, only those keys of each record are kept.
+    """
+    outs: Dict[int, Any] = {}
+    stats = {"points": 0, "dropped": 0}
+    try:
+        for line_no, _, ev in iter_file_events(path):
+            if isinstance(ev.get("records"), list):
+                records, dropped = ev["records"], 0
+            else:
+                records, dropped = normalize_event(ev)
+            stats["points"] += len(records)
+            stats["dropped"] += dropped
+            for i, r in enumerate(records):
+                r.setdefault("received_at", ev.get("received_at"))
+                if fields is not None:
+                    r = {f: r.get(f) for f in fields}
+                k = zlib.crc32(str(r.get("device_id")).encode("utf-8")) % partitions
+                if k not in outs:
+                    outs[k] = open(os.path.join(tmp_dir, f"p{k:04d}-s{order:06d}.ndjson"), "w", encoding="utf-8")
+                # sort key: device, time, uid, then write position (the last copy wins)
+                key = [str(r.get("device_id")), r.get("epoch_millis") or 0, r["uid"], order, line_no, i]
+                outs[k].write(json.dumps([key, r], ensure_ascii=False) + "\n")
+    finally:
+        for fh in outs.values():
+            fh.close()
+    return stats
+
+def _sorted_runs(files: List[str], run_dir: str, run_records: int) -> Iterator[Tuple[list, Dict[str, Any]]]:
+    """(key, record) of the partition files in key order: an external merge sort
+    holding at most `run_records` records in memory."""
+    runs: List[str] = []
+    buf: List[Tuple[list, Dict[str, Any]]] = []
+
+    def spill():
+        buf.sort(key=itemgetter(0))
+        runs.append(os.path.join(run_dir, f"run{len(runs):06d}.ndjson"))
+        with open(runs[-1], "w", encoding="utf-8") as fh:
+            fh.writelines(json.dumps(item, ensure_ascii=False) + "\n" for item in buf)
+        buf.clear()
+
+    def read(path):
+        with open(path, "r", encoding="utf-8") as fh:
+            for line in fh:
+                yield json.loads(line)
+
+    for f in files:
+        for item in read(f):
+            buf.append(item)
+            if len(buf) >= run_records:
+                spill()
+    if not runs:
+        buf.sort(key=itemgetter(0))
+        yield from buf
+        return
+    if buf:
+        spill()
+    yield from heapq.merge(*(read(p) for p in runs), key=itemgetter(0))
+
+def _latest_by_uid(files: List[str], run_dir: str, run_records: int = SORT_RUN_RECORDS) -> Iterator[Dict[str, Any]]:
+    """Records of one partition, one per uid (the last written wins), ordered by device and time.
+
+    The uid is derived from device and time, so the copies of a point are
+    adjacent in key order and the last of them is kept while streaming.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    try:
+        prev = None
+        for key, r in _sorted_runs(files, run_dir, run_records):
+            if prev is not None and prev["uid"] != r["uid"]:
+                yield prev
+            prev = r
+        if prev is not None:
+            yield prev
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+def _rewrite_partition(k: int, files: List[str], staging: str) -> int:
+    # a small queue: records are streamed from the sort, not held for the writer
+    w = WalWriter(staging, rotate_bytes=settings.WAL_ROTATE_BYTES, durability="buffer", queue_size=8, max_latency_ms=0,
+                  worker_id=f"deep{k:04d}", block_records=settings.WAL_BLOCK_RECORDS, block_bytes=settings.WAL_BLOCK_BYTES)
+    futures = []
+    written = 0
+    chunk: List[Dict[str, Any]] = []
+
+    def submit():
+        received = [r["received_at"] for r in chunk if r.get("received_at") is not None]
+        futures.append(w.submit({
+            "received_at": max(received) if received else None,
+            "first_received_at": min(received) if received else None,
+            "api": "compact", "records": chunk,
+        }))
+
+    for r in _latest_by_uid(files, os.path.join(staging, f"runs{k:04d}")):
+        if chunk and (len(chunk) >= EVENT_RECORDS or r.get("device_id") != chunk[0].get("device_id")):
+            submit()
+            chunk = []
+        chunk.append(r)
+        written += 1
+    if chunk:
+        submit()
+    w.close()
+    for f in futures:
+        f.result()
+    return written
+
+def _deep(wd: pathlib.Path, entries: List[Dict[str, Any]], workers: int, partitions: int,
+          out_dir: pathlib.Path) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """Rewrite entries as canonical records into out_dir; returns (manifest entries of the outputs, point counts)."""
+    ts = time.strftime("%Y%m%d-%H%M%S")
+    staging = wd / f".compact-{ts}-p{os.getpid()}"
+    tmp_dir = staging / "parts"
+    tmp_dir.mkdir(parents=True)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+            parts = list(pool.map(_partition_segment, [wd / e["segment"] for e in entries], range(len(entries)),
+                                  [str(tmp_dir)] * len(entries), [partitions] * len(entries)))
+            by_part: Dict[int, List[str]] = {}
+            for f in sorted(tmp_dir.iterdir()):
+                by_part.setdefault(int(f.name[1:5]), []).append(str(f))
+            written = list(pool.map(_rewrite_partition, list(by_part), list(by_part.values()), [str(staging)] * len(by_part)))
+        shutil.rmtree(tmp_dir)
+        outputs = [dict(e, worker="compact") for e in read_manifest(str(staging))]
+        for e in outputs:
+            shutil.move(str(staging / e["segment"]), str(out_dir / e["segment"]))
+            shutil.move(str(index_path(staging / e["segment"])), str(index_path(out_dir / e["segment"])))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    points = {"input_points": sum(p["points"] for p in parts), "output_points": sum(written),
+              "dropped": sum(p["dropped"] for p in parts)}
+    points["duplicates"] = points["input_points"] - points["output_points"]
+    return outputs, points
+
+def compact(wal_dir: str, max_compact_size: int, output_name: str = None, dry_run: bool = False,
+            delete_originals: bool = False, mode: str = "fast", workers: int = 0, partitions: int = 0) -> Dict[str, Any]:
+    """Merge small segments; returns input/output bytes and records.
+
+    fast: the segments' gzip members are concatenated byte for byte (no
+    recompression) and their block indexes merged. deep: segments are
+    normalized in parallel into canonical records, deduplicated by uid and
+    ordered by device/time, one output segment per device partition.
+    """
+    if mode not in COMPACT_MODES:
+        raise ValueError(f"compaction mode must be one of {COMPACT_MODES}, got {mode!r}")
     wd = pathlib.Path(wal_dir)
-    files = [f for f in list_wal_files(wd) if f.stat().st_size <= max_compact_size]
-    if not files:
-        print("Nothing to compact", file=sys.stderr); return 0, 0
-    if output_name is None:
-        ts = time.strftime("%Y%m%d-%H%M%S")
-        output_name = f"events-compact-{ts}.ndjson.gz"
-    out_path = wd / output_name
+    listed = segments(wal_dir)
+    has_manifest = (wd / MANIFEST_NAME).exists()
+    entries = [e for e in listed if e["bytes"] <= max_compact_size]
+    report = {"mode": mode, "compacted_from": len(entries), "removed_originals": 0,
+              "input_bytes": sum(e["bytes"] for e in entries), "input_records": sum(e["records"] for e in entries),
+              "output_bytes": 0, "output_records": 0}
+    if not entries:
+        print("Nothing to compact", file=sys.stderr); return report
     if dry_run:
-        total = sum(f.stat().st_size for f in files)
-        print(f"DRY-RUN would compact {len(files)} files into {out_path.name} total={human(total)}", file=sys.stderr)
-        return len(files), 0
-
-    with gzip.open(out_path, 'wt', encoding='utf-8') as out:
-        for f in files:
-            with gzip.open(f, 'rt', encoding='utf-8') as inp:
-                shutil.copyfileobj(inp, out)
-    removed = 0
+        print(f"DRY-RUN would compact ({mode}) {len(entries)} files total={human(report['input_bytes'])}", file=sys.stderr)
+        return report
+
+    ts = time.strftime("%Y%m%d-%H%M%S")
+    # Kept originals stay the WAL; the compacted copy goes to a sibling WAL
+    # directory (own manifest), where reindex and --include-open cannot pick it
+    # up and replay it a second time.
+    out_dir = wd if delete_originals else wd.parent / f"{wd.name}-compacted-{ts}"
+    out_dir.mkdir(exist_ok=True)
+    if mode == "fast":
+        out_path = out_dir / (output_name or f"events-compact-{ts}.ndjson.gz")
+        write_index(out_path, _concat(wd, entries, out_path))
+        outputs = [_out_entry(out_path.name, out_path.stat().st_size, entries, report["input_records"])]
+    else:
+        workers = workers or os.cpu_count() or 1
+        # about one output segment per half rotation size of input, at most one per worker
+        partitions = partitions or max(1, min(workers, report["input_bytes"] // max(1, settings.WAL_ROTATE_BYTES // 2) + 1))
+        outputs, points = _deep(wd, entries, workers, partitions, out_dir)
+        report.update(points)
+    report["output_bytes"] = sum(e["bytes"] for e in outputs)
+    report["output_records"] = sum(e["records"] for e in outputs)
+    report["outputs"] = [e["segment"] for e in outputs]
+
     if delete_originals:
-        for f in files:
-            f.unlink(missing_ok=True)
-            removed += 1
-    return len(files), removed
+        names = {e["segment"] for e in entries}
+        # a legacy directory gets its manifest from the scan done above
+        update_manifest(wal_dir, lambda cur: [e for e in (cur if has_manifest else listed) if e["segment"] not in names] + outputs)
+        for e in entries:
+            (wd / e["segment"]).unlink(missing_ok=True)
+            index_path(wd / e["segment"]).unlink(missing_ok=True)
+            report["removed_originals"] += 1
+    else:
+        for e in outputs:
+            append_manifest(str(out_dir), e)
+        report["output_dir"] = str(out_dir)
+        print(f"Originals kept; compacted copy written to {out_dir}", file=sys.stderr)
+    return report
+
+def reindex(wal_dir: str, min_age_seconds: int = 3600, dry_run: bool = False):
+    """Add segments missing from the manifest (legacy files, or left open by a crashed worker)."""
+    wd = pathlib.Path(wal_dir)
+    known = {e["segment"] for e in read_manifest(wal_dir)}
+    added = 0
+    for f in sorted(wd.glob(SEGMENT_GLOB)):
+        if f.name in known or time.time() - f.stat().st_mtime < min_age_seconds:
+            continue
+        entry = scan_segment(f)
+        if dry_run:
+            print(f"DRY-RUN would index {f.name} records={entry['records']}", file=sys.stderr)
+        else:
+            append_manifest(wal_dir, entry)
+        added += 1
+    return added
 
 def main():
-    ap = argparse.ArgumentParser(description="WAL prune/compact utility")    
+    ap = argparse.ArgumentParser(description="WAL prune/compact utility")
     sub = ap.add_subparsers(dest="cmd", required=True)
 
-    ap_prune = sub.add_parser("prune", help="Delete or archive old WAL files")    
+    ap_prune = sub.add_parser("prune", help="Delete or archive old WAL files")
     ap_prune.add_argument("--wal-dir", required=True)
     ap_prune.add_argument("--keep-days", type=int, default=7)
     ap_prune.add_argument("--archive-dir", default=None)
-    ap_prune.add_argument("--dry-run", action="store_true")    
+    ap_prune.add_argument("--dry-run", action="store_true")
 
-    ap_compact = sub.add_parser("compact", help="Compact small WAL files into one")    
+    ap_compact = sub.add_parser("compact", help="Compact small WAL files")
     ap_compact.add_argument("--wal-dir", required=True)
-    ap_compact.add_argument("--max-compact-size", type=int, default=5_000_000, help="Max size (bytes) to include per file")    
+    ap_compact.add_argument("--max-compact-size", type=int, default=5_000_000, help="Max size (bytes) to include per file")
     ap_compact.add_argument("--output-name", default=None)
     ap_compact.add_argument("--dry-run", action="store_true")
-    ap_compact.add_argument("--delete-originals", action="store_true")    
+    ap_compact.add_argument("--delete-originals", action="store_true",
+                            help="replace the originals in the manifest; without it the copy goes to <wal-dir>-compacted-<ts>")
+    ap_compact.add_argument("--mode", choices=COMPACT_MODES, default="fast",
+                            help="fast: concatenate gzip members; deep: rewrite as deduplicated canonical records")
+    ap_compact.add_argument("--workers", type=int, default=0, help="deep mode processes (default: CPU count)")
+    ap_compact.add_argument("--partitions", type=int, default=0, help="deep mode device partitions = output segments (default: by input size)")
+
+    ap_reindex = sub.add_parser("reindex", help="Add unsealed/legacy segments to the manifest")
+    ap_reindex.add_argument("--wal-dir", required=True)
+    ap_reindex.add_argument("--min-age-seconds", type=int, default=3600, help="skip files modified more recently (still being written)")
+    ap_reindex.add_argument("--dry-run", action="store_true")
 
     args = ap.parse_args()
 
@@ -82,8 +333,12 @@ def main():
         a, d = prune(args.wal_dir, args.keep_days, args.archive_dir, args.dry_run)
         print(json.dumps({"archived": a, "deleted": d}))
     elif args.cmd == "compact":
-        n, r = compact(args.wal_dir, args.max_compact_size, args.output_name, args.dry_run, args.delete_originals)
-        print(json.dumps({"compacted_from": n, "removed_originals": r}))
+        if args.output_name and args.mode == "deep":
+            ap.error("--output-name applies to --mode fast")
+        print(json.dumps(compact(args.wal_dir, args.max_compact_size, args.output_name, args.dry_run,
+                                 args.delete_originals, args.mode, args.workers, args.partitions)))
+    elif args.cmd == "reindex":
+        print(json.dumps({"indexed": reindex(args.wal_dir, args.min_age_seconds, args.dry_run)}))
 
 if __name__ == "__main__":
     main()
@@ -1,18 +1,29 @@
-import os
+import atexit, os, shutil, tempfile
 import pytest
 from dotenv import load_dotenv
 from neo4j import GraphDatabase
 
 load_dotenv(dotenv_path=os.environ.get("TEST_ENV_FILE", None))
 
+# The service-backed fixtures below only use what the caller configured.
+_ENV = dict(os.environ)
+# app.settings needs these at import; the offline tests never connect anywhere
+os.environ.setdefault("NEO4J_URI", "bolt://tests.invalid:7687")
+os.environ.setdefault("NEO4J_USER", "tests")
+os.environ.setdefault("NEO4J_PASSWORD", "tests")
+# app.main creates its WalWriter directory at import; tests swap in their own
+if "WAL_DIR" not in os.environ:
+    os.environ["WAL_DIR"] = tempfile.mkdtemp(prefix="phonelog-tests-wal-")
+    atexit.register(shutil.rmtree, os.environ["WAL_DIR"], ignore_errors=True)
+
 def pytest_addoption(parser):
-    parser.addoption("--base-url", action="store", default=os.environ.get("API_BASE","http://localhost:8888"))
-    parser.addoption("--neo4j-uri", action="store", default=os.environ.get("NEO4J_URI","bolt://localhost:7687"))
-    parser.addoption("--neo4j-user", action="store", default=os.environ.get("NEO4J_USER"))
-    parser.addoption("--neo4j-password", action="store", default=os.environ.get("NEO4J_PASSWORD"))
-    parser.addoption("--neo4j-db", action="store", default=os.environ.get("NEO4J_DATABASE"))
-    parser.addoption("--wal-dir", action="store", default=os.environ.get("WAL_DIR"))
-    parser.addoption("--device-id", action="store", default=os.environ.get("TEST_DEVICE_ID","test-device"))
+    parser.addoption("--base-url", action="store", default=_ENV.get("API_BASE","http://localhost:8888"))
+    parser.addoption("--neo4j-uri", action="store", default=_ENV.get("NEO4J_URI","bolt://localhost:7687"))
+    parser.addoption("--neo4j-user", action="store", default=_ENV.get("NEO4J_USER"))
+    parser.addoption("--neo4j-password", action="store", default=_ENV.get("NEO4J_PASSWORD"))
+    parser.addoption("--neo4j-db", action="store", default=_ENV.get("NEO4J_DATABASE"))
+    parser.addoption("--wal-dir", action="store", default=_ENV.get("WAL_DIR"))
+    parser.addoption("--device-id", action="store", default=_ENV.get("TEST_DEVICE_ID","test-device"))
 
 @pytest.fixture(scope="session")
 def base_url(pytestconfig):
@@ -44,3 +55,31 @@ def unique_device(pytestconfig):
     base = pytestconfig.getoption("--device-id")
     import uuid
     return f"{base}-{uuid.uuid4().hex[:8]}"
+
+@pytest.fixture
+def drivers(request, monkeypatch):
+    """Recording Neo4j drivers (bench.fakedb) answering reads with the test module's
+    `responder(query, params)`, with app.db's per-process caches reset."""
+    from bench import fakedb
+    from app import db
+    saved = db._driver, db._async_driver
+    monkeypatch.setattr(db, "_known_users", set())
+    monkeypatch.setattr(db, "_known_devices", set())
+    db.spatial_cache.clear()
+    db.recent_uids.clear()
+    yield fakedb.install(responder=getattr(request.module, "responder", None))
+    db._driver, db._async_driver = saved
+    db.spatial_cache.clear()
+    db.recent_uids.clear()
+
+@pytest.fixture
+def api_get():
+    """GET against the app in-process: api_get(path, **query_params) -> httpx.Response."""
+    import asyncio, httpx
+    from app.main import app
+    def get(path, **params):
+        async def go():
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+                return await c.get(path, params=params)
+        return asyncio.run(go())
+    return get
@@ -0,0 +1,25 @@
+import json
+from bench import suite
+from bench.workloads import Workload
+from app.normalizer import normalize_items
+
+def test_workload_items_normalize():
+    wl = Workload(mix="realistic", seed=3)
+    p = wl.payload(200)
+    recs, dropped = normalize_items(p["locations"], p["user_id"], p["device_id"])
+    assert len(recs) == 200 and dropped == 0
+    assert len({r["uid"] for r in recs}) == 200
+
+def test_suite_runs_in_process(tmp_path):
+    results = suite.run(["normalize_one", "replay_wal"], scale=0.01, isolate=False)
+    for name, res in results.items():
+        assert res["points"] > 0 and res["points_per_s"] > 0
+        assert res["p99_ms"] >= res["p50_ms"]
+    json.dumps(results)
+
+def test_compare_flags_regressions():
+    results = {"x": {"points_per_s": 70.0, "p99_ms": 1.4, "peak_rss_mb": 100.0}}
+    base = {"x": {"points_per_s": 100.0, "p99_ms": 1.0, "peak_rss_mb": 100.0}}
+    regs = suite.compare(results, base, threshold=0.25)
+    assert [r["metric"] for r in regs] == ["points_per_s"]
+    assert suite.compare(results, base, threshold=0.35) == []
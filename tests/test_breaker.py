@@ -0,0 +1,107 @@
+import asyncio, time
+import httpx
+import pytest
+from app import db
+from app.breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from app.writebehind import WriteBehind
+
+def test_trips_on_error_rate_and_recovers_through_a_probe():
+    b = CircuitBreaker(window_s=10, min_calls=4, error_rate=0.5, open_s=0.05)
+    for ok in (True, False, True):
+        assert b.allow()
+        b.record(ok, 0.01)
+    assert b.state == CLOSED  # below min_calls
+    assert b.allow()
+    b.record(False, 0.01)
+    assert b.state == OPEN and not b.allow() and b.is_open()
+    time.sleep(0.06)
+    assert b.allow() and b.state == HALF_OPEN
+    assert not b.allow()  # one probe at a time
+    b.record(False, 0.01)
+    assert b.state == OPEN
+    time.sleep(0.06)
+    assert b.allow()
+    b.record(True, 0.01)
+    assert b.state == CLOSED and b.allow()
+
+def test_trips_on_slow_calls():
+    b = CircuitBreaker(min_calls=3, slow_call_s=0.5, slow_rate=0.6)
+    for seconds in (0.1, 0.9, 0.9):
+        assert b.allow()
+        b.record(True, seconds)
+    assert b.state == OPEN
+
+def test_drain_waits_for_the_breaker_and_is_paced(tmp_path):
+    written = []
+    async def upsert(rows):
+        written.append((time.monotonic(), len(rows)))
+    b = CircuitBreaker(min_calls=1, open_s=0.2)
+    b.allow()
+    b.record(False, 0.0)
+    async def go():
+        wb = WriteBehind(upsert, str(tmp_path), batch_size=10, breaker=b, pace_points_s=200.0)
+        wb.start()
+        start = time.monotonic()
+        wb.offer([{"uid": f"u{i}"} for i in range(30)])
+        while wb.pending():
+            await asyncio.sleep(0.01)
+        await wb.stop()
+        return start
+    start = asyncio.run(go())
+    assert written[0][0] - start >= 0.15  # nothing tried while open
+    assert sum(n for _, n in written) == 30 and written[-1][0] - written[0][0] >= 0.09  # 10 points per 50 ms
+    assert b.state == CLOSED
+
+class Down:
+    def __init__(self):
+        self.down = True
+    def __call__(self, query, params):
+        if self.down:
+            raise ConnectionError("neo4j unavailable")
+        return [{"n": len(params.get("rows", []))}]
+
+@pytest.fixture
+def api(drivers, monkeypatch, tmp_path):
+    from app import main
+    neo = Down()
+    for drv in drivers:
+        drv.responder = neo
+    breaker = CircuitBreaker(min_calls=2, open_s=0.1)
+    monkeypatch.setattr(main, "breaker", breaker)
+    monkeypatch.setattr(main, "pending", WriteBehind(db.upsert_phonelog_batch_async, str(tmp_path / "pending"),
+                                                     breaker=breaker, base_backoff_s=0.01))
+    yield main, neo, drivers[1]
+
+def post(app, body):
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+            return await c.post("/api/v1/locations", json=body)
+    return asyncio.run(go())
+
+def body(i):
+    return {"user_id": "u1", "device_id": "d1", "locations": [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [-80.0, 35.0 + i * 1e-4]},
+         "properties": {"timestamp": f"2024-05-07T10:00:{i:02d}Z"}}]}
+
+def test_degraded_db_answers_pending_then_drains(api):
+    main, neo, async_drv = api
+    r = post(main.app, body(0))
+    assert r.status_code == 202 and r.json()["result"] == "pending" and r.json()["pending"] == 1
+    post(main.app, body(1))
+    assert main.breaker.state == OPEN
+    tried = async_drv.transactions, sum(async_drv.statements.values())
+    r = post(main.app, body(2))
+    assert r.status_code == 202 and (async_drv.transactions, sum(async_drv.statements.values())) == tried  # fail fast
+    assert main.pending.pending() == 3
+    assert main._db_down().status_code == 503
+
+    neo.down = False
+    async def drain():
+        main.pending.start()
+        while main.pending.pending():
+            await asyncio.sleep(0.01)
+        await main.pending.stop()
+    asyncio.run(drain())
+    assert main.breaker.state == CLOSED and async_drv.rows == 3
+    r = post(main.app, body(3))
+    assert r.status_code == 200 and r.json()["result"] == "ok"
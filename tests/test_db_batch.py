@@ -0,0 +1,59 @@
+import asyncio
+import pytest
+from app import db
+
+class FakeResult:
+    def __init__(self, n=0): self.n = n
+    async def consume(self): return None
+    async def single(self): return {"n": self.n}
+
+class FakeTx:
+    def __init__(self, log): self.log = log
+    async def run(self, query, **params):
+        self.log.append((query, params))
+        return FakeResult(len(params.get("rows", [])))
+
+class FakeSession:
+    def __init__(self, log): self.log = log
+    async def __aenter__(self): return self
+    async def __aexit__(self, *exc): return False
+    async def execute_write(self, fn, *args):
+        return await fn(FakeTx(self.log), *args)
+
+class FakeDriver:
+    def __init__(self): self.log = []
+    def session(self, database=None): return FakeSession(self.log)
+
+@pytest.fixture
+def driver(monkeypatch):
+    d = FakeDriver()
+    monkeypatch.setattr(db, "get_async_driver", lambda: d)
+    monkeypatch.setattr(db, "_known_users", set())
+    monkeypatch.setattr(db, "_known_devices", set())
+    db.recent_uids.clear()
+    yield d
+    db.recent_uids.clear()
+
+def rec(uid, user="u1", device="d1", speed=1.0):
+    return {"uid": uid, "user_id": user, "device_id": device, "speed": speed}
+
+def test_owners_ensured_once(driver):
+    asyncio.run(db.upsert_phonelog_batch_async([rec("a"), rec("b", device="d2")]))
+    ensure = [p for q, p in driver.log if q == db.ENSURE_OWNERS_CYPHER]
+    assert ensure == [{"users": ["u1"], "devices": ["d1", "d2"]}]
+    driver.log.clear()
+    asyncio.run(db.upsert_phonelog_batch_async([rec("c"), rec("d", device=None)]))
+    assert [q for q, _ in driver.log] == [db.UPSERT_BATCH_CYPHER]
+
+def test_duplicate_uids_in_batch_sent_once(driver):
+    uids = asyncio.run(db.upsert_phonelog_batch_async([rec("a"), rec("a", speed=2.0)]))
+    assert uids == ["a", "a"]
+    rows = [p["rows"] for q, p in driver.log if q == db.UPSERT_BATCH_CYPHER][0]
+    assert len(rows) == 1 and rows[0]["speed"] == 2.0
+
+def test_resent_points_skip_db(driver):
+    asyncio.run(db.upsert_phonelog_batch_async([rec("a"), rec("b")]))
+    driver.log.clear()
+    asyncio.run(db.upsert_phonelog_batch_async([rec("a"), rec("b", speed=3.0)]))
+    rows = [p["rows"] for q, p in driver.log if q == db.UPSERT_BATCH_CYPHER][0]
+    assert [r["uid"] for r in rows] == ["b"]
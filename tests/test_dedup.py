@@ -0,0 +1,41 @@
+import time
+from app.dedup import RecentUids
+from app import metrics
+
+def row(uid, speed=1.0):
+    return {"uid": uid, "user_id": "u", "device_id": "d", "speed": speed, "coordinates": [1.0, 2.0]}
+
+def test_exact_repeat_is_skipped_changed_is_not():
+    c = RecentUids(capacity=10, ttl_s=60)
+    fresh, hashes = c.split([row("a"), row("b")])
+    assert len(fresh) == 2
+    c.remember(fresh, hashes)
+    fresh, _ = c.split([row("a"), row("b", speed=2.0), row("c")])
+    assert [r["uid"] for r in fresh] == ["b", "c"]
+
+def test_not_remembered_until_written():
+    c = RecentUids(capacity=10, ttl_s=60)
+    c.split([row("a")])
+    assert len(c.split([row("a")])[0]) == 1
+
+def test_ttl_and_eviction():
+    c = RecentUids(capacity=2, ttl_s=0.05)
+    before = metrics.DEDUP_EVICTIONS._value.get()
+    rows = [row("a"), row("b"), row("c")]
+    c.remember(*c.split(rows))
+    assert len(c) == 2 and metrics.DEDUP_EVICTIONS._value.get() == before + 1
+    assert [r["uid"] for r in c.split(rows)[0]] == ["a"]
+    time.sleep(0.06)
+    assert len(c.split(rows)[0]) == 3
+
+def test_disabled():
+    c = RecentUids(capacity=0, ttl_s=60)
+    c.remember(*c.split([row("a")]))
+    assert len(c.split([row("a")])[0]) == 1 and len(c) == 0
+
+def test_hit_refreshes_the_entry():
+    c = RecentUids(capacity=2, ttl_s=60)
+    c.remember(*c.split([row("a"), row("b")]))
+    assert c.split([row("a")])[0] == []  # hit: "a" is now the most recent
+    c.remember(*c.split([row("c")]))
+    assert [r["uid"] for r in c.split([row("a"), row("b"), row("c")])[0]] == ["b"]
@@ -0,0 +1,28 @@
+import json
+import pytest
+from app.fastpath import parse_ingest_body, BodyError
+
+def test_passes_items_through_untouched():
+    body = {"user_id": 42, "device_id": "d", "locations": [{"geometry": "{'coordinates': [1, 2]}", "x": None}]}
+    doc, user_id, device_id, items = parse_ingest_body(json.dumps(body).encode())
+    assert doc == body
+    assert (user_id, device_id) == ("42", "d")  # numbers coerced like Optional[str]
+    assert items == body["locations"]
+
+def test_missing_locations_is_empty():
+    assert parse_ingest_body(b'{"user_id": "u"}')[3] == []
+
+@pytest.mark.parametrize("body,loc,type_", [
+    (b"", ["body"], "value_error.missing"),
+    (b"{bad", ["body", 1], "json_invalid"),
+    (b"[1]", ["body"], "type_error.dict"),
+    (b'{"locations": 5}', ["body", "locations"], "type_error.list"),
+    (b'{"locations": null}', ["body", "locations"], "type_error.none.not_allowed"),
+    (b'{"locations": [{}, 1]}', ["body", "locations", 1], "type_error.dict"),
+    (b'{"device_id": []}', ["body", "device_id"], "type_error.str"),
+])
+def test_errors_follow_validation_contract(body, loc, type_):
+    with pytest.raises(BodyError) as exc:
+        parse_ingest_body(body)
+    assert exc.value.errors[0]["loc"] == loc
+    assert exc.value.errors[0]["type"] == type_
@@ -0,0 +1,104 @@
+import asyncio, json, logging, queue, time
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from app import metrics
+from app.logging_conf import JsonFormatter, NonBlockingHandler
+from app.middleware import RequestMiddleware
+
+def make_app(**kw):
+    app = FastAPI()
+    app.add_middleware(RequestMiddleware, **kw)
+
+    @app.get("/ok/{n}")
+    async def ok(n: int):
+        return {"n": n}
+
+    @app.get("/slow")
+    async def slow():
+        await asyncio.sleep(0.05)
+        return {}
+
+    @app.get("/boom")
+    async def boom():
+        raise RuntimeError("boom")
+    return app
+
+def get(app, *paths, **kw):
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+            return [await c.get(p, **kw) for p in paths]
+    return asyncio.run(go())
+
+def count(path, status):
+    return metrics.registry.get_sample_value("app_requests_total", {"path": path, "method": "GET", "status": status}) or 0
+
+def access(caplog):
+    return [(r.path, r.status, r.rid) for r in caplog.records if r.name == "app.access" and r.getMessage() == "request"]
+
+def test_request_id_metrics_and_unhandled_errors(caplog):
+    caplog.set_level(logging.INFO)
+    app = make_app()
+    before = count("/ok/{n}", "200"), count("/boom", "500")
+    r, = get(app, "/ok/1", headers={"x-request-id": "abc"})
+    assert r.json() == {"n": 1} and r.headers["x-request-id"] == "abc"
+    r, = get(app, "/boom")
+    assert r.status_code == 500 and r.json() == {"result": "error", "reason": "internal"}
+    assert len(r.headers["x-request-id"]) == 36
+    assert (count("/ok/{n}", "200"), count("/boom", "500")) == (before[0] + 1, before[1] + 1)
+    assert access(caplog) == [("/ok/1", 200, "abc"), ("/boom", 500, r.headers["x-request-id"])]
+
+def test_sampling_keeps_errors_and_slow_requests(caplog):
+    caplog.set_level(logging.INFO)
+    app = make_app(sample_rate=0.0, slow_ms=30)
+    before = count("<unmatched>", "404")
+    get(app, "/ok/1", "/ok/2", "/nope", "/slow")
+    assert [(p, s) for p, s, _ in access(caplog)] == [("/nope", 404), ("/slow", 200)]
+    assert count("<unmatched>", "404") == before + 1  # metrics are not sampled
+
+def test_streamed_body_is_not_buffered():
+    sent = []
+    async def chunks():
+        yield b"first\n"
+        assert sent[-1] == {"type": "http.response.body", "body": b"first\n", "more_body": True}
+        yield b"second\n"
+    app = FastAPI()
+    app.add_middleware(RequestMiddleware)
+    app.get("/s")(lambda: StreamingResponse(chunks()))
+    scope = {"type": "http", "method": "GET", "path": "/s", "raw_path": b"/s", "query_string": b"", "headers": [],
+             "http_version": "1.1", "scheme": "http", "server": ("t", 80), "client": ("c", 1), "root_path": "",
+             "app": app}
+    async def receive():
+        await asyncio.sleep(1)
+        return {"type": "http.disconnect"}
+    async def send(message):
+        sent.append(message)
+    asyncio.run(app(scope, receive, send))
+    assert sent[0]["status"] == 200 and (b"x-request-id", ) == tuple(k for k, _ in sent[0]["headers"] if k == b"x-request-id")
+    assert b"".join(m.get("body", b"") for m in sent[1:]) == b"first\nsecond\n"
+
+def test_handler_formats_on_the_listener_and_drops_when_full():
+    q = queue.Queue(1)
+    h = NonBlockingHandler(q)
+    logger = logging.getLogger("test.nonblocking")
+    logger.propagate, logger.handlers = False, [h]
+    logger.setLevel(logging.INFO)
+    before = metrics.registry.get_sample_value("app_log_dropped_total")
+    try:
+        args = {"k": 1}
+        logger.info("got %s", args, extra={"rid": "r1", "ms": 3})
+        args["k"] = 2  # changed after the call: the message was rendered already
+        start = time.perf_counter()
+        logger.info("dropped")
+        assert time.perf_counter() - start < 0.05
+        assert metrics.registry.get_sample_value("app_log_dropped_total") == before + 1
+        line = json.loads(JsonFormatter().format(q.get_nowait()))
+        assert (line["message"], line["rid"], line["ms"], line["level"]) == ("got {'k': 1}", "r1", 3, "INFO")
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            logger.exception("failed")
+        line = json.loads(JsonFormatter().format(q.get_nowait()))
+        assert "ValueError: bad" in line["exc_info"]
+    finally:
+        logger.handlers, logger.propagate = [], True
@@ -0,0 +1,74 @@
+import json, math, pathlib, random
+import pytest
+from app.normalizer import normalize_one, normalize_batch
+
+PAYLOADS = pathlib.Path(__file__).parent / "payloads"
+
+def same(a, b):
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+        return True
+    return type(a) is type(b) and a == b
+
+def assert_matches_scalar(items, default_user="kipnerter", default_device="dev-1"):
+    expected = [normalize_one(it, default_user=default_user, default_device=default_device) for it in items]
+    batch = normalize_batch(items, default_user=default_user, default_device=default_device)
+    kept = [e for e in expected if e is not None]
+    got = batch.records()
+    assert batch.dropped == len(expected) - len(kept)
+    assert len(got) == len(kept) == len(batch)
+    for e, g in zip(kept, got):
+        assert list(e) == list(g)
+        for k in e:
+            assert same(e[k], g[k]), (k, e[k], g[k])
+    return batch
+
+@pytest.mark.parametrize("name", sorted(p.name for p in PAYLOADS.glob("v1_*.json")))
+def test_curated_payloads(name):
+    payload = json.loads((PAYLOADS / name).read_text())
+    assert_matches_scalar(payload["locations"], payload.get("user_id") or "kipnerter", payload.get("device_id"))
+
+def _random_item(rnd):
+    coord = rnd.choice([
+        lambda: [rnd.uniform(-180, 180), rnd.uniform(-90, 90)],
+        lambda: [str(round(rnd.uniform(-180, 180), 5)), f" {rnd.uniform(-90, 90)} "],
+        lambda: [rnd.randint(-180, 180), rnd.randint(-90, 90), 12.5],
+        lambda: [None, 1.0], lambda: ["abc", 1], lambda: [1.0], lambda: "nope",
+        lambda: [0.0, 0.0], lambda: [float("nan"), 1.0], lambda: [True, False],
+    ])()
+    ts = rnd.choice([
+        lambda: rnd.randint(1_500_000_000, 1_900_000_000),
+        lambda: rnd.randint(1_500_000_000_000, 1_900_000_000_000),
+        lambda: rnd.uniform(1_500_000_000, 1_900_000_000),
+        lambda: rnd.uniform(-1e9, 1e9),
+        lambda: "2024-04-01T12:00:%02dZ" % rnd.randint(0, 59),
+        lambda: "2024-04-01T12:00:00.250+02:00",
+        lambda: "2024-04-01 12:00:00",
+        lambda: "yesterday", lambda: None, lambda: True, lambda: 0,
+        lambda: float("inf"), lambda: 10 ** 30, lambda: 9e15, lambda: [1],
+    ])()
+    props = {"timestamp": ts, "speed": rnd.choice([None, 3, 2.5, "4.0", "fast"]),
+             "motion": rnd.choice([None, "walking", ["walking", "stationary"]]),
+             "horizontal_accuracy": rnd.choice([None, 5, 65.0])}
+    if rnd.random() < 0.2:
+        props["device_id"] = "prop-device"
+    if rnd.random() < 0.1:
+        props["user_id"] = "prop-user"
+    item = {"type": "Feature", "geometry": {"type": "Point", "coordinates": coord}, "properties": props}
+    if rnd.random() < 0.3:
+        item["geometry"], item["properties"] = str(item["geometry"]), str(item["properties"])
+    if rnd.random() < 0.05:
+        item["geometry"] = None
+    return item
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_items_match_normalize_one(seed):
+    rnd = random.Random(seed)
+    assert_matches_scalar([_random_item(rnd) for _ in range(500)])
+
+def test_per_item_defaults_and_numeric_columns():
+    items = [{"geometry": {"coordinates": [1, 2]}, "properties": {"timestamp": 1700000000 + i, "speed": s}}
+             for i, s in enumerate([1, "2.5", None, "x"])]
+    batch = normalize_batch(items, default_user=["a", "b", "c", "d"], default_device=[None, "d1", None, "d2"])
+    assert list(batch.columns["user_id"]) == ["a", "b", "c", "d"]
+    assert batch.epoch_millis.tolist() == [1700000000000 + 1000 * i for i in range(4)]
+    assert batch.speed.tolist()[:2] == [1.0, 2.5] and all(math.isnan(x) for x in batch.speed.tolist()[2:])
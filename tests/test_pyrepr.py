@@ -0,0 +1,46 @@
+import json
+import pytest
+from app import pyrepr
+from app.normalizer import _coerce_to_dict
+
+@pytest.mark.parametrize("value", [
+    {"type": "Point", "coordinates": [-73.99, 40.75]},
+    {"timestamp": "2024-03-03T03:03:03Z", "motion": ["walking", "stationary"], "deferred": True, "wifi": None},
+    {"wifi": "Bob's iPhone", "note": 'say "hi"', "path": "a\\b", "u": "ü"},
+    {"nested": {"a": [1, 2.5, -1e-07, {"b": False}]}, "empty": {}, "list": []},
+])
+def test_parses_repr_and_json(value):
+    assert pyrepr.loads(repr(value)) == value
+    assert pyrepr.loads(json.dumps(value)) == value
+
+def test_tolerates_trailing_commas_tuples_and_tight_literals():
+    assert pyrepr.loads("{'a':True,'t':(1, 2),'l':[1,],}") == {"a": True, "t": [1, 2], "l": [1]}
+
+@pytest.mark.parametrize("bad", ["", "{", "{'a' 1}", "{'a':}", "[1 2]", "{'a':1,,}", "[,]", "{'a': 1}}", "12abc", "nope"])
+def test_rejects_malformed(bad):
+    with pytest.raises(ValueError):
+        pyrepr.loads(bad)
+
+def test_coerce_handles_what_the_replace_chain_mangled():
+    assert _coerce_to_dict("{'wifi': \"Bob's\", 'deferred':True}") == {"wifi": "Bob's", "deferred": True}
+    assert _coerce_to_dict('{"speed": "True North"}') == {"speed": "True North"}
+    assert _coerce_to_dict("[1, 2]") is None
+
+def test_coerce_returns_independent_copies():
+    s = "{'type': 'Point', 'coordinates': [1, 2]}"
+    a = _coerce_to_dict(s)
+    a["type"] = "changed"
+    assert _coerce_to_dict(s)["type"] == "Point"
+
+def test_replace_chain_does_not_rewrite_string_values():
+    assert _coerce_to_dict("{'name': 'Not True', 'x': None}") == {"name": "Not True", "x": None}
+    assert _coerce_to_dict('{"note": "is None", "a": [1,], "d": False}') == {"note": "is None", "a": [1], "d": False}
+    assert _coerce_to_dict("{'s': 'a, }', 'n': 1,}") == {"s": "a, }", "n": 1}
+
+def test_long_strings_are_parsed_but_not_cached():
+    from app.normalizer import _parse_cached, COERCE_CACHE_MAX_LEN
+    _parse_cached.cache_clear()
+    long = repr({"note": "x" * COERCE_CACHE_MAX_LEN})
+    assert _coerce_to_dict(long) == {"note": "x" * COERCE_CACHE_MAX_LEN}
+    _coerce_to_dict("{'a': 1}")
+    assert _parse_cached.cache_info().currsize == 1
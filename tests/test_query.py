@@ -0,0 +1,64 @@
+import asyncio, json
+import pytest
+from app.query import PointQuery, encode_cursor, decode_cursor
+
+POINTS = [{"uid": f"{i:04d}", "user_id": f"u{i % 2}", "device_id": f"d{i % 3}",
+           "epoch_millis": 1_700_000_000_000 + i // 2 * 1000, "longitude": -80.0, "latitude": 35.0 + i * 1e-4}
+          for i in range(60)]
+
+def responder(query, params):
+    """Evaluates the keyset page query over POINTS the way Neo4j would."""
+    key = "device_id" if "p.device_id = $owner" in query else "user_id"
+    rows = sorted((p for p in POINTS
+                   if p[key] == params["owner"] and params["lo"] <= p["epoch_millis"] <= params["hi"]
+                   and (p["epoch_millis"] > params["after_ms"] or p["uid"] > params["after_uid"])),
+                  key=lambda p: (p["epoch_millis"], p["uid"]))
+    return [{"point": p} for p in rows[:params["limit"]]]
+
+def expected(key, owner):
+    return sorted((p for p in POINTS if p[key] == owner), key=lambda p: (p["epoch_millis"], p["uid"]))
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(1_700_000_000_000, "ab")) == (1_700_000_000_000, "ab")
+    with pytest.raises(ValueError):
+        decode_cursor("not-a-cursor")
+
+def test_pages_continue_after_the_last_key(drivers):
+    _, async_drv = drivers
+    q = PointQuery("user_id", "u0", limit=1000, page_size=7)
+    async def all_pages():
+        out, page = [], await q.page()
+        while page:
+            out += page
+            page = await q.page()
+        return out
+    got = asyncio.run(all_pages())
+    assert [p["uid"] for p in got] == [p["uid"] for p in expected("user_id", "u0")]
+    assert async_drv.transactions == 5 and q.next_cursor is None  # 30 points: 4 full pages + 1 short one
+
+def test_ndjson_limit_and_cursor(drivers, api_get):
+    want = expected("device_id", "d1")
+    r = api_get("/api/v1/devices/d1/points", limit=8)
+    assert r.status_code == 200 and r.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(l) for l in r.text.splitlines()]
+    assert [p["uid"] for p in lines[:-1]] == [p["uid"] for p in want[:8]]
+    cursor = lines[-1]["next_cursor"]
+    r = api_get("/api/v1/devices/d1/points", limit=100, cursor=cursor)
+    rest = [json.loads(l) for l in r.text.splitlines()]
+    assert [p["uid"] for p in rest] == [p["uid"] for p in want[8:]]
+
+def test_geojson_time_window(drivers, api_get):
+    lo, hi = 1_700_000_003_000, 1_700_000_010_000
+    r = api_get("/api/v1/users/u1/points", since=str(lo), until="2023-11-14T22:13:30Z", format="geojson")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("application/geo+json")
+    fc = r.json()
+    assert fc["type"] == "FeatureCollection" and "next_cursor" not in fc
+    want = [p for p in expected("user_id", "u1") if lo <= p["epoch_millis"] <= hi]
+    assert [f["properties"]["uid"] for f in fc["features"]] == [p["uid"] for p in want]
+    assert fc["features"][0]["geometry"] == {"type": "Point", "coordinates": [want[0]["longitude"], want[0]["latitude"]]}
+
+def test_bad_parameters(drivers, api_get):
+    assert api_get("/api/v1/devices/d1/points", cursor="zzz").status_code == 400
+    assert api_get("/api/v1/devices/d1/points", since="yesterday").status_code == 400
+    assert api_get("/api/v1/devices/d1/points", format="csv").status_code == 400
+    assert api_get("/api/v1/devices/d1/points", limit=0).status_code == 400
@@ -0,0 +1,102 @@
+import threading
+import pytest
+from bench import fakedb
+from app import db
+from app.normalizer import normalize_one
+from scripts import run_normalize
+from scripts.run_normalize import Checkpoint, Job, legacy_item, plan
+
+def legacy(i):
+    """A node as the old APOC job found it: stringified Python reprs."""
+    return {"geometry": f"{{'type': 'Point', 'coordinates': [{-80.0 + i * 1e-4}, 35.2]}}",
+            "properties": f"{{'timestamp': '2024-05-07T10:00:{i % 60:02d}Z', 'speed': {i}.5, 'pauses': False, "
+                          f"'device_id': 'd{i % 3}', 'wifi': None}}"}
+
+class Graph:
+    """PhoneLog nodes by internal id, answering the job's statements."""
+    def __init__(self, n, gap=3):
+        self.nodes = {}
+        for i in range(n):
+            node = legacy(i) if i % 5 else {"uid": f"new{i}", "normalized": True, "schema_version": 1}
+            self.nodes[i * gap] = node
+        self.nodes[7] = {"geometry": "{'type': 'Point'}", "properties": "{}"}  # unparseable
+        self.windows = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, query, params):
+        if query == run_normalize.WINDOW_CYPHER:
+            with self.lock:
+                self.windows += 1
+            return [{"id": i, "p": dict(p)} for i, p in sorted(self.nodes.items()) if params["lo"] <= i < params["hi"]
+                    and (not p.get("normalized") or p.get("schema_version", 0) < params["version"])]
+        if query == run_normalize.WRITE_CYPHER:
+            uids = {p.get("uid") for p in self.nodes.values()}
+            dup = 0
+            for row in params["rows"]:
+                node = self.nodes[row["id"]]
+                taken = row["uid"] in uids and node.get("uid") != row["uid"]
+                dup += taken or not row["claim"]
+                if node.get("uid") is None and not taken and row["claim"]:
+                    node["uid"] = row["uid"]
+                node.update({k: row[k] for k in run_normalize.FIELDS}, schema_version=params["version"], normalized=True)
+            return [{"n": len(params["rows"]), "duplicates": dup}]
+        if query == run_normalize.UNPARSED_CYPHER:
+            for i in params["ids"]:
+                self.nodes[i].update(normalized=True, schema_version=params["version"], normalize_error="unparsed")
+        return [{"n": 0}]
+
+@pytest.fixture
+def graph():
+    saved = db._driver, db._async_driver
+    g = Graph(200)
+    fakedb.install(responder=g)
+    yield g
+    db._driver, db._async_driver = saved
+
+def test_nodes_match_the_ingest_normalizer(graph, tmp_path):
+    state = {"schema_version": 1, "max_id": 597, "totals": {}, "partitions": plan(597, 7)}
+    report = Job(state, window=40, workers=3, checkpoint=Checkpoint(str(tmp_path / "ck.json"))).run()
+    assert report["complete"] and report["failed_partitions"] == 0
+    assert report["normalized"] == 160 and report["unparsed"] == 1
+    node = graph.nodes[3]
+    want = normalize_one(legacy_item(legacy(1)), default_user="kipnerter", default_device=None)
+    assert node["uid"] == want["uid"] and node["speed"] == 1.5 and node["pauses"] is False
+    assert node["timestamp"] == want["timestamp"] and node["device_id"] == "d1" and node["user_id"] == "kipnerter"
+    assert graph.nodes[7]["normalize_error"] == "unparsed"
+    assert all(p.get("normalized") for p in graph.nodes.values())
+    # a second run finds nothing left to do
+    assert Job({"schema_version": 1, "max_id": 597, "totals": {}, "partitions": plan(597, 7)}, 40, 3).run()["normalized"] == 0
+
+def test_pause_and_resume_from_the_checkpoint(graph, tmp_path):
+    ck = Checkpoint(str(tmp_path / "ck.json"))
+    ck.save({"schema_version": 1, "max_id": 597, "totals": {}, "partitions": plan(597, 4)})
+    job = Job(ck.load(), window=25, workers=2, checkpoint=ck)
+    respond = graph.__call__
+    def pause_after_five(query, params):
+        if query == run_normalize.WINDOW_CYPHER and graph.windows >= 5:
+            job.stop.set()
+        return respond(query, params)
+    db._driver.responder = pause_after_five
+    first = job.run()
+    assert first["paused"] and not first["complete"] and 0 < first["normalized"] < 160
+
+    db._driver.responder = graph
+    windows_before = graph.windows
+    second = Job(ck.load(), window=25, workers=2, checkpoint=ck).run()
+    assert second["complete"] and first["normalized"] + second["normalized"] == 160
+    assert second["totals"]["normalized"] == 160
+    assert graph.windows - windows_before + first["windows"] == 24  # no window read twice after its commit
+
+def test_version_bump_renormalizes_stored_fields(graph):
+    graph.nodes = {0: {"uid": "x", "normalized": True, "schema_version": 1, "coordinates": [-80.0, 35.0],
+                       "geom_type": "Point", "timestamp": "2024-05-07T10:00:00+00:00", "speed": 3.0, "device_id": "d1"}}
+    report = Job({"schema_version": 2, "max_id": 0, "totals": {}, "partitions": plan(0, 4)}, 10, 1).run()
+    assert report["normalized"] == 1 and graph.nodes[0]["schema_version"] == 2 and graph.nodes[0]["uid"] == "x"
+    assert graph.nodes[0]["epoch_millis"] == 1715076000000 and graph.nodes[0]["speed"] == 3.0
+
+def test_duplicate_of_an_ingested_point_keeps_its_node(graph):
+    item = legacy_item(legacy(1))
+    uid = normalize_one(item, default_user="kipnerter", default_device=None)["uid"]
+    graph.nodes = {0: {"uid": uid, "normalized": True, "schema_version": 1}, 1: legacy(1), 2: legacy(1)}
+    report = Job({"schema_version": 1, "max_id": 2, "totals": {}, "partitions": plan(2, 1)}, 10, 1).run()
+    assert report["duplicates"] == 2 and graph.nodes[1].get("uid") is None and graph.nodes[2].get("uid") is None
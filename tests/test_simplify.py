@@ -0,0 +1,102 @@
+import asyncio, json, math
+import numpy as np
+import pytest
+from app import db
+from app.simplify import TrackShaper, douglas_peucker, first_per_bucket, iter_track_buckets, track_buckets, tolerance_for_zoom
+
+def walk(n, seed=3):
+    rng = np.random.default_rng(seed)
+    lon = -80.8 + np.cumsum(rng.normal(2e-5, 1e-4, n))
+    lat = 35.2 + np.cumsum(rng.normal(1e-5, 1e-4, n))
+    return lon, lat
+
+def deviation_m(lon, lat, keep):
+    """Largest distance from a dropped point to the kept polyline segment spanning it."""
+    k = math.cos(math.radians(lat.mean())) * math.pi / 180 * 6_371_008.8
+    x, y = lon * k, lat * (math.pi / 180 * 6_371_008.8)
+    idx = np.flatnonzero(keep)
+    worst = 0.0
+    for a, b in zip(idx[:-1], idx[1:]):
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        for m in range(a + 1, b):
+            t = min(1.0, max(0.0, ((x[m] - x[a]) * dx + (y[m] - y[a]) * dy) / (dx * dx + dy * dy or 1.0)))
+            worst = max(worst, math.hypot(x[m] - x[a] - t * dx, y[m] - y[a] - t * dy))
+    return worst
+
+def test_douglas_peucker_bounds_the_error():
+    lon, lat = walk(3000)
+    keep = douglas_peucker(lon, lat, 25.0)
+    assert keep[0] and keep[-1] and 10 < keep.sum() < 1500
+    assert deviation_m(lon, lat, keep) <= 25.0
+    line = douglas_peucker(np.linspace(0, 1, 50), np.zeros(50), 1.0)
+    assert list(np.flatnonzero(line)) == [0, 49]
+
+def test_paged_shaper_keeps_the_bound_across_pages():
+    lon, lat = walk(2500, seed=7)
+    rows = [{"uid": f"{i:05d}", "epoch_millis": i * 1000, "longitude": float(a), "latitude": float(b)}
+            for i, (a, b) in enumerate(zip(lon, lat))]
+    shaper = TrackShaper(tolerance_m=20.0)
+    kept = [r for i in range(0, len(rows), 300) for r in shaper.feed(rows[i:i + 300])]
+    keep = np.zeros(len(rows), dtype=bool)
+    keep[[int(r["uid"]) for r in kept]] = True
+    assert len(kept) == len({r["uid"] for r in kept}) and keep[0] and keep[-1]
+    assert deviation_m(lon, lat, keep) <= 20.0
+    assert shaper.points_in == 2500 and shaper.points_out == len(kept)
+
+def test_time_buckets_across_pages():
+    ms = np.array([0, 10_000, 59_999, 60_000, 61_000, 185_000])
+    assert list(first_per_bucket(ms, 60_000)) == [True, False, False, True, False, True]
+    assert list(first_per_bucket(ms[3:], 60_000, after_bucket=1)) == [False, False, True]
+    shaper = TrackShaper(bucket_ms=60_000)
+    rows = [{"uid": str(m), "epoch_millis": int(m), "longitude": 0.0, "latitude": 0.0} for m in ms]
+    assert [r["uid"] for r in shaper.feed(rows[:4]) + shaper.feed(rows[4:])] == ["0", "60000", "185000"]
+
+def test_zoom_tolerance():
+    assert tolerance_for_zoom(0, 0) == pytest.approx(156_543.03392)
+    assert tolerance_for_zoom(10, 60) == pytest.approx(156_543.03392 / 1024 / 2)
+
+def test_track_buckets_keep_the_first_point():
+    rows = [{"uid": u, "device_id": "d1", "user_id": "u1", "epoch_millis": ms, "longitude": 1.0, "latitude": 2.0}
+            for u, ms in (("b", 61_000), ("a", 65_000), ("c", 61_000), ("z", 900_000))]
+    buckets = track_buckets(rows, [60, 900])
+    by_key = {b["key"]: (b["uid"], b["epoch_millis"]) for b in buckets}
+    assert by_key == {"d1|60|60000": ("b", 61_000), "d1|60|900000": ("z", 900_000),
+                      "d1|900|0": ("b", 61_000), "d1|900|900000": ("z", 900_000)}
+    assert buckets[0]["day"] == "1970-01-01"
+    ordered = sorted(rows + [dict(rows[0], device_id="d0", uid="y")], key=lambda r: (r["device_id"], r["epoch_millis"], r["uid"]))
+    assert sorted(iter_track_buckets(ordered, [60, 900]), key=lambda b: b["key"]) == track_buckets(ordered, [60, 900])
+
+POINTS = [{"uid": f"{i:05d}", "user_id": "u1", "device_id": "d1", "epoch_millis": 1_700_000_000_000 + i * 5000,
+           "longitude": -80.8 + i * 1e-4, "latitude": 35.2} for i in range(500)]  # a straight line
+BUCKETS = track_buckets(POINTS, [60])
+
+def responder(query, params):
+    if "limit" not in params:
+        return [{"n": len(params.get("rows", []))}]
+    source = BUCKETS if "TrackBucket" in query else POINTS
+    rows = [p for p in source if p["device_id"] == params["owner"] and params["lo"] <= p["epoch_millis"] <= params["hi"]
+            and (p["epoch_millis"] > params["after_ms"] or p["uid"] > params["after_uid"])
+            and ("res_s" not in params or p["res_s"] == params["res_s"])]
+    rows.sort(key=lambda p: (p["epoch_millis"], p["uid"]))
+    return [{"point": p} for p in rows[:params["limit"]]]
+
+def test_writes_maintain_track_buckets(drivers):
+    _, async_drv = drivers
+    asyncio.run(db.upsert_phonelog_batch_async(POINTS[:30]))
+    assert async_drv.statements[db.TRACK_BUCKETS_CYPHER.split("\n", 1)[0]] == 1
+
+def test_track_endpoint(drivers, api_get):
+    _, async_drv = drivers
+    r = api_get("/api/v1/devices/d1/track", zoom=12, format="geojson")
+    feature = r.json()
+    assert feature["geometry"]["type"] == "LineString" and len(feature["geometry"]["coordinates"]) == 2
+    assert feature["properties"]["source_points"] == 500
+    assert feature["properties"]["epoch_millis"] == [POINTS[0]["epoch_millis"], POINTS[-1]["epoch_millis"]]
+
+    before = async_drv.transactions
+    r = api_get("/api/v1/devices/d1/track", bucket_s=120)
+    lines = [json.loads(l) for l in r.text.splitlines()]
+    assert async_drv.transactions == before + 1  # one page of TrackBucket points, not 500 raw ones
+    assert [p["epoch_millis"] // 120_000 for p in lines] == sorted({p["epoch_millis"] // 120_000 for p in POINTS})
+    assert set(lines[0]) == {"uid", "epoch_millis", "longitude", "latitude"}
+    assert api_get("/api/v1/devices/d1/track", zoom=30).status_code == 400
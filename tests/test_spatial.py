@@ -0,0 +1,98 @@
+import asyncio, json, math, time
+from app import db
+from app.tilecache import TileCache, tile_of, bbox_tiles, radius_bbox
+
+POINTS = [{"uid": f"{i:03d}", "user_id": "u1", "device_id": f"d{i % 2}", "epoch_millis": 1_700_000_000_000 + i,
+           "longitude": -80.0 + (i % 10) * 0.01, "latitude": 35.0 + (i // 10) * 0.01} for i in range(100)]
+
+def metres(lon1, lat1, lon2, lat2):
+    dx = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    return 6_371_000 * math.hypot(dx, math.radians(lat2 - lat1))
+
+def responder(query, params):
+    """Evaluates the spatial queries over POINTS; any other statement is a write."""
+    if "limit" not in params:
+        return [{"n": len(params.get("rows", []))}]
+    if "withinBBox" in query:
+        inside = lambda p: params["min_lon"] <= p["longitude"] <= params["max_lon"] and \
+                           params["min_lat"] <= p["latitude"] <= params["max_lat"]
+    else:
+        inside = lambda p: metres(params["lon"], params["lat"], p["longitude"], p["latitude"]) <= params["radius_m"]
+    rows = [p for p in POINTS if inside(p)
+            and (params["since"] is None or p["epoch_millis"] >= params["since"])
+            and (params["until"] is None or p["epoch_millis"] <= params["until"])
+            and (params["user_id"] is None or p["user_id"] == params["user_id"])
+            and (params["device_id"] is None or p["device_id"] == params["device_id"])]
+    rows.sort(key=lambda p: (p["epoch_millis"], p["uid"]))
+    return [{"point": p} for p in rows[:params["limit"]]]
+
+BBOX = {"min_lon": -80.005, "min_lat": 35.005, "max_lon": -79.975, "max_lat": 35.025}
+
+def test_bbox_query_is_cached_until_a_point_lands_in_its_tiles(drivers, api_get):
+    _, async_drv = drivers
+    r = api_get("/api/v1/points/bbox", **BBOX, device_id="d1")
+    want = [p["uid"] for p in POINTS if p["device_id"] == "d1" and BBOX["min_lon"] <= p["longitude"] <= BBOX["max_lon"]
+            and BBOX["min_lat"] <= p["latitude"] <= BBOX["max_lat"]]
+    assert r.status_code == 200 and [json.loads(l)["uid"] for l in r.text.splitlines()] == want == ["011", "021"]
+    assert api_get("/api/v1/points/bbox", **BBOX, device_id="d1").text == r.text
+    assert async_drv.transactions == 1
+
+    far = dict(POINTS[0], uid="far", longitude=10.0, latitude=50.0)
+    asyncio.run(db.upsert_phonelog_batch_async([far]))
+    api_get("/api/v1/points/bbox", **BBOX, device_id="d1")
+    assert async_drv.transactions == 2  # the write; the read is still cached
+
+    near = dict(POINTS[0], uid="near", longitude=-79.99, latitude=35.01)
+    asyncio.run(db.upsert_phonelog_batch_async([near]))
+    api_get("/api/v1/points/bbox", **BBOX, device_id="d1")
+    assert async_drv.transactions == 4  # invalidated: read again
+
+def test_near_geojson_and_truncation(drivers, api_get):
+    r = api_get("/api/v1/points/near", lon=-80.0, lat=35.0, radius_m=1600, format="geojson")
+    fc = r.json()
+    want = [p["uid"] for p in POINTS if metres(-80.0, 35.0, p["longitude"], p["latitude"]) <= 1600]
+    assert [f["properties"]["uid"] for f in fc["features"]] == want and "x-truncated" not in r.headers
+    r = api_get("/api/v1/points/near", lon=-80.0, lat=35.0, radius_m=1600, limit=2, since="1700000000001")
+    assert r.headers["x-truncated"] == "true" and len(r.text.splitlines()) == 2
+
+def test_bad_areas(drivers, api_get):
+    assert api_get("/api/v1/points/bbox", min_lon=1, min_lat=0, max_lon=0, max_lat=1).status_code == 400
+    assert api_get("/api/v1/points/near", lon=0, lat=0, radius_m=0).status_code == 400
+    assert api_get("/api/v1/points/near", lon=0, lat=0, radius_m=10, since="soon").status_code == 400
+
+def test_cache_refuses_results_read_across_a_write():
+    c = TileCache(capacity=10, ttl_s=60, zoom=14)
+    tiles = bbox_tiles(-80.01, 35.0, -80.0, 35.01, 14, 256)
+    token = c.token()
+    c.invalidate([{"longitude": -80.005, "latitude": 35.005}])  # lands while the query runs
+    c.put("q", tiles, ["stale"], token)
+    assert c.get("q") is None
+    c.put("q", tiles, ["fresh"], c.token())
+    assert c.get("q") == ["fresh"]
+
+def test_cache_is_bounded_and_expires():
+    c = TileCache(capacity=2, ttl_s=0.05, zoom=14)
+    t = frozenset({tile_of(0, 0, 14)})
+    for k in "abc":
+        c.put(k, t, k, c.token())
+    assert len(c) == 2 and c.get("a") is None and c.get("c") == "c"
+    time.sleep(0.06)
+    assert c.get("c") is None
+    assert c.get("b") is None and len(c) == 0
+
+def test_cache_row_budget():
+    c = TileCache(capacity=100, ttl_s=60, zoom=14, max_rows=10, max_result_rows=6)
+    t = frozenset({tile_of(0, 0, 14)})
+    c.put("big", t, [{}] * 7, c.token())
+    assert c.get("big") is None and len(c) == 0 and c.rows == 0  # larger results are not kept
+    for k in "abc":
+        c.put(k, t, [{}] * 4, c.token())
+    assert c.get("a") is None and c.get("c") is not None and c.rows == 8  # oldest evicted to fit
+    c.invalidate([{"longitude": 0.0, "latitude": 0.0}])
+    assert len(c) == 0 and c.rows == 0
+
+def test_area_tiles():
+    assert bbox_tiles(-80.5, 35.0, -80.0, 35.5, 14, 256) is None  # too many tiles
+    assert bbox_tiles(*radius_bbox(179.999, 0.0, 1000), 14, 256) is None  # crosses the antimeridian
+    lo_lon, lo_lat, hi_lon, hi_lat = radius_bbox(-80.0, 35.0, 1000)
+    assert metres(-80.0, 35.0, hi_lon, 35.0) >= 1000 and metres(-80.0, 35.0, -80.0, lo_lat) >= 1000
@@ -0,0 +1,80 @@
+import asyncio, json
+from app.stream import NdjsonIngest
+
+def feature(i, device=None):
+    f = {"geometry": {"type": "Point", "coordinates": [-80.0 + i * 1e-4, 35.0]},
+         "properties": {"timestamp": 1_700_000_000_000 + i * 1000}}
+    if device:
+        f["properties"]["device_id"] = device
+    return f
+
+async def chunked(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+class Recorder:
+    def __init__(self, delay=0.0, fail_on=None):
+        self.wal, self.batches = [], []
+        self.inflight = self.max_inflight = 0
+        self.delay, self.fail_on = delay, fail_on
+
+    async def wal_write(self, ev):
+        self.wal.append(ev)
+
+    async def upsert(self, rows):
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.fail_on is not None and len(self.batches) == self.fail_on:
+                raise RuntimeError("db down")
+            self.batches.append(rows)
+            return [r["uid"] for r in rows]
+        finally:
+            self.inflight -= 1
+
+def run(lines, chunk=7, **kw):
+    rec = Recorder(**{k: kw.pop(k) for k in ("delay", "fail_on") if k in kw})
+    job = NdjsonIngest("u1", "d1", rec.wal_write, rec.upsert, **kw)
+    body = b"\n".join(l if isinstance(l, bytes) else json.dumps(l).encode() for l in lines) + b"\n"
+    err = None
+    try:
+        asyncio.run(job.run(chunked(body, chunk)))
+    except RuntimeError as e:
+        err = e
+    return job, rec, err
+
+def test_batches_and_summary():
+    lines = [feature(i) for i in range(25)]
+    lines[3] = b"{not json"
+    lines[10] = {"user_id": "u2", "device_id": "d2", "locations": [feature(100), feature(101)]}
+    job, rec, err = run(lines, batch_points=5)
+    s = job.summary()
+    assert err is None
+    assert s["lines"] == 25 and s["rejected"] == 1 and s["rejected_lines"] == [4]
+    assert s["ingested"] == 25 and s["committed_lines"] == 25
+    assert all(len(b) <= 6 for b in rec.batches)
+    assert {(r["user_id"], r["device_id"]) for b in rec.batches for r in b} == {("u1", "d1"), ("u2", "d2")}
+    assert s["first_timestamp"].startswith("2023-11-14T22:13:20")
+    # WAL records are v1 payloads, grouped by owner
+    assert sum(len(ev["payload"]["locations"]) for ev in rec.wal) == 25
+    assert all(ev["api"] == "stream" for ev in rec.wal)
+
+def test_backpressure_bounds_inflight():
+    job, rec, err = run([feature(i) for i in range(40)], batch_points=2, max_inflight=2, delay=0.01)
+    assert err is None and job.ingested == 40
+    assert rec.max_inflight == 2
+
+def test_oversized_and_trailing_lines():
+    big = json.dumps({"pad": "x" * 200}).encode()
+    body = [feature(0), big, feature(1)]
+    job, rec, err = run(body, chunk=16, max_line_bytes=150)
+    assert job.summary()["rejected_lines"] == [2]
+    assert job.ingested == 2
+
+def test_failure_reports_committed_prefix():
+    job, rec, err = run([feature(i) for i in range(10)], batch_points=2, max_inflight=1, fail_on=2)
+    assert isinstance(err, RuntimeError)
+    assert job.ingested == 4 and job.committed_lines == 4
+    # everything read so far reached the WAL before the DB write
+    assert sum(len(ev["payload"]["locations"]) for ev in rec.wal) >= 6
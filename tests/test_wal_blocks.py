@@ -0,0 +1,58 @@
+import gzip
+from app.wal import WalWriter, segments, read_index
+from scripts import replay_wal
+from scripts.replay_wal import Filter, iter_file_events, replay_file
+
+def feature(ms, **props):
+    return {"geometry": {"type": "Point", "coordinates": [-80.0, 35.0 + ms * 1e-9]},
+            "properties": dict(props, timestamp=ms)}
+
+def write_wal(tmp_path, block_records=5):
+    w = WalWriter(str(tmp_path), rotate_bytes=10_000_000, block_records=block_records, max_latency_ms=0)
+    for i in range(40):
+        user, device = f"u{i % 2}", f"d{i % 4}"
+        w.write({"received_at": 1000 + i, "payload": {"user_id": user, "device_id": device,
+                                                       "locations": [feature(1_700_000_000_000 + i)]}})
+    w.write({"received_at": 2000, "payload": {"user_id": "u0", "locations": [
+        {"geometry": "{'type': 'Point', 'coordinates': [-80, 35]}",
+         "properties": "{'timestamp': 1700000009999, 'device_id': 'hidden'}"}]}})
+    w.close()
+    return tmp_path / segments(str(tmp_path))[0]["segment"]
+
+def test_blocks_are_independent_gzip_members(tmp_path):
+    seg = write_wal(tmp_path)
+    idx = read_index(seg)
+    assert len(idx["blocks"]) == 9
+    assert sum(b["records"] for b in idx["blocks"]) == 41
+    # the whole file is still one readable gzip stream
+    with gzip.open(seg, "rt") as fh:
+        assert len(fh.readlines()) == 41
+    b = idx["blocks"][2]
+    assert b["first_line"] == 11 and (b["min_received_at"], b["max_received_at"]) == (1010, 1014)
+    assert b["users"] == ["u0", "u1"] and b["devices"] == ["d0", "d1", "d2", "d3"]
+    assert idx["blocks"][-1]["opaque"] is True
+    events = list(iter_file_events(seg, blocks=[b]))
+    assert [ln for ln, _, _ in events] == list(range(11, 16))
+    assert [ev["received_at"] for _, _, ev in events] == list(range(1010, 1015))
+
+def test_filtered_replay_reads_only_matching_blocks(tmp_path, monkeypatch):
+    seg = write_wal(tmp_path)
+    written = []
+    monkeypatch.setattr(replay_wal, "upsert_phonelog_batch", lambda recs, chunk_size=None: written.extend(recs))
+    read = []
+    orig = replay_wal._iter_block_events
+    def spy(path, blocks, start_line):
+        read.extend(b["first_line"] for b in blocks)
+        return orig(path, blocks, start_line)
+    monkeypatch.setattr(replay_wal, "_iter_block_events", spy)
+
+    flt = Filter(since=1012, until=1023, devices=["d1"])
+    stats = replay_file(seg, {"filter": flt})
+    assert read == [11, 16, 21]
+    assert sorted(r["epoch_millis"] - 1_700_000_000_000 for r in written) == [13, 17, 21]
+    assert stats["error"] is None
+
+    written.clear(); read.clear()
+    replay_file(seg, {"filter": Filter(devices=["hidden"])})
+    assert read == [41]  # only the opaque block could hold it
+    assert [r["device_id"] for r in written] == ["hidden"]
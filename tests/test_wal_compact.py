@@ -0,0 +1,106 @@
+import gzip, json, pathlib
+from app.wal import WalWriter, segments, read_index
+from scripts import replay_wal, wal_prune
+from scripts.replay_wal import Filter, iter_file_events, replay_file
+
+def feature(ms, device):
+    return {"geometry": {"type": "Point", "coordinates": [-80.0, 35.0 + (ms % 1000) * 1e-6]},
+            "properties": {"timestamp": ms, "device_id": device}}
+
+def write_segments(root, count=3, per_segment=12):
+    """`count` sealed segments; every point is sent twice (a phone re-sending its batch)."""
+    received = 1000
+    for s in range(count):
+        w = WalWriter(str(root), rotate_bytes=10_000_000, block_records=4, max_latency_ms=0, worker_id=f"w{s}")
+        for i in range(per_segment):
+            ms = 1_700_000_000_000 + (s * per_segment + i) // 2
+            w.write({"received_at": received, "payload": {"user_id": f"u{i // 2 % 2}", "locations": [feature(ms, f"d{i // 2 % 3}")]}})
+            received += 1
+        w.close()
+    return segments(str(root))
+
+def replayed(root, monkeypatch, flt=None):
+    written = []
+    monkeypatch.setattr(replay_wal, "upsert_phonelog_batch", lambda recs, chunk_size=None: written.extend(recs))
+    for e in segments(str(root)):
+        assert replay_file(root / e["segment"], {"filter": flt or Filter()})["error"] is None
+    return written
+
+def test_fast_concatenates_members_and_merges_indexes(tmp_path, monkeypatch):
+    before = write_segments(tmp_path)
+    expected = sorted(r["uid"] for r in replayed(tmp_path, monkeypatch))
+    report = wal_prune.compact(str(tmp_path), 10_000_000, delete_originals=True)
+    assert report["compacted_from"] == 3 and report["removed_originals"] == 3
+    assert report["input_bytes"] == report["output_bytes"] == sum(e["bytes"] for e in before)
+    assert report["input_records"] == report["output_records"] == 36
+
+    (entry,) = segments(str(tmp_path))
+    out = tmp_path / entry["segment"]
+    with gzip.open(out, "rt") as fh:
+        assert [json.loads(l)["received_at"] for l in fh] == list(range(1000, 1036))
+    blocks = read_index(out)["blocks"]
+    assert [b["first_line"] for b in blocks] == [1, 5, 9, 13, 17, 21, 25, 29, 33]
+    events = list(iter_file_events(out, blocks=blocks[4:5]))
+    assert [ln for ln, _, _ in events] == [17, 18, 19, 20]
+    assert [ev["received_at"] for _, _, ev in events] == [1016, 1017, 1018, 1019]
+    assert sorted(r["uid"] for r in replayed(tmp_path, monkeypatch)) == expected
+
+def test_fast_indexes_unindexed_segments_as_opaque(tmp_path):
+    wal = tmp_path / "wal"
+    write_segments(wal, count=2)
+    first = segments(str(wal))[0]["segment"]
+    (wal / (first + ".idx.json")).unlink()
+    report = wal_prune.compact(str(wal), 10_000_000, output_name="events-compact-x.ndjson.gz")
+    out = pathlib.Path(report["output_dir"]) / "events-compact-x.ndjson.gz"
+    blocks = read_index(out)["blocks"]
+    assert blocks[0]["opaque"] and (blocks[0]["first_line"], blocks[0]["records"]) == (1, 12)
+    assert [ev["received_at"] for _, _, ev in iter_file_events(out, blocks=blocks[:1])] == list(range(1000, 1012))
+    assert blocks[1]["first_line"] == 13
+    # originals kept: the copy is a WAL directory of its own, never picked up by the original
+    assert out.parent != wal and [e["segment"] for e in segments(str(out.parent))] == [out.name]
+    assert wal_prune.reindex(str(wal), min_age_seconds=0) == 0
+    assert all(e["segment"] != out.name for e in segments(str(wal), include_open=True))
+
+def test_deep_with_originals_kept_writes_a_sibling_wal(tmp_path, monkeypatch):
+    wal = tmp_path / "wal"
+    before = write_segments(wal, count=2)
+    report = wal_prune.compact(str(wal), 10_000_000, mode="deep", workers=1, partitions=2)
+    assert segments(str(wal), include_open=True) == before and wal_prune.reindex(str(wal), min_age_seconds=0) == 0
+    assert sorted(e["segment"] for e in segments(report["output_dir"])) == sorted(report["outputs"])
+    assert len(replayed(pathlib.Path(report["output_dir"]), monkeypatch)) == report["output_points"] == 12
+
+def test_deep_dedupes_by_uid_and_orders_by_device_time(tmp_path, monkeypatch):
+    write_segments(tmp_path)
+    expected = {r["uid"] for r in replayed(tmp_path, monkeypatch)}
+    report = wal_prune.compact(str(tmp_path), 10_000_000, delete_originals=True, mode="deep", workers=2, partitions=2)
+    assert report["input_points"] == 36 and report["output_points"] == 18 and report["duplicates"] == 18
+    assert report["input_records"] == 36 and report["removed_originals"] == 3
+    outputs = segments(str(tmp_path))
+    assert {e["segment"] for e in outputs} == set(report["outputs"])
+    assert report["output_records"] == sum(e["records"] for e in outputs)
+
+    for e in outputs:
+        records = [r for _, _, ev in iter_file_events(tmp_path / e["segment"]) for r in ev["records"]]
+        keys = [(r["device_id"], r["epoch_millis"]) for r in records]
+        assert keys == sorted(keys)
+    written = replayed(tmp_path, monkeypatch)
+    assert len(written) == 18 and {r["uid"] for r in written} == expected
+
+    # each record keeps the receive time of its latest copy, so --since/--until still apply
+    early = [r for r in written if r["received_at"] <= 1005]
+    assert early and sorted(r["uid"] for r in replayed(tmp_path, monkeypatch, Filter(until=1005))) \
+        == sorted(r["uid"] for r in early)
+
+def test_partition_dedup_spills_sorted_runs(tmp_path):
+    write_segments(tmp_path / "wal")
+    parts = tmp_path / "parts"
+    parts.mkdir()
+    for order, e in enumerate(segments(str(tmp_path / "wal"))):
+        wal_prune._partition_segment(tmp_path / "wal" / e["segment"], order, str(parts), 1)
+    files = sorted(str(f) for f in parts.iterdir())
+    in_memory = list(wal_prune._latest_by_uid(files, str(tmp_path / "a")))
+    spilled = list(wal_prune._latest_by_uid(files, str(tmp_path / "b"), run_records=5))  # 8 runs
+    assert spilled == in_memory and len(spilled) == 18 and not (tmp_path / "b").exists()
+    keys = [(r["device_id"], r["epoch_millis"]) for r in spilled]
+    assert keys == sorted(keys)
+    assert all(r["received_at"] % 2 == 1 for r in spilled)  # each point was sent twice in a row: the later copy
@@ -0,0 +1,133 @@
+import csv, json
+import pytest
+from app.db import PARAM_KEYS, UPSERT_BATCH_CYPHER
+from app.wal import WalWriter, Framed, segments
+from scripts.replay_wal import replay_file
+from scripts.wal_export import PHONELOG_COLUMNS, HEADERS, export, _cell, _value_kind
+
+def feature(ms, lon=-80.0, **props):
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, 35.5]},
+            "properties": dict(props, timestamp=ms)}
+
+def write_wal(wal_dir):
+    w = WalWriter(str(wal_dir), rotate_bytes=1, max_latency_ms=0)  # one segment per record
+    w.write({"received_at": 1000, "payload": {"user_id": "u1", "device_id": "d1", "locations": [
+        feature(1_700_000_000_000, speed=1.5), feature(1_700_000_060_000, motion="walking")]}})
+    body = json.dumps({"user_id": "u1", "device_id": "d1", "locations": [
+        feature(1_700_000_000_000, speed=2, deferred=True, battery_level="high")]}).encode()
+    w.write(Framed({"received_at": 2000, "api": "v1"}, body, {"u1"}, {"d1"}))
+    w.write({"received_at": 3000, "payload": {"user_id": "u2", "device_id": "d2", "locations": [
+        feature(1_700_000_000_000, lon=-81.0, wifi=""), {"properties": {"speed": 1}}]}})
+    w.close()
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as fh:
+        return list(csv.reader(fh))
+
+def exported_rows(out, groups):
+    """uid -> {property: field text}, over the default and fallback PhoneLog file groups."""
+    rows = {}
+    for g in [""] + list(groups):
+        prefix = f"phonelog-{g}-" if g else "phonelog-"
+        header = read_csv(out / f"{prefix}header.csv")[0]
+        for f in sorted(out.glob(f"{prefix}p*.csv")):
+            for r in read_csv(f):
+                rows[r[0]] = dict(zip((h.split(":")[0] for h in header), r), types=header)
+    return rows
+
+def stored(text, kind):
+    """A field as neo4j-admin imports it into a column of `kind`."""
+    if text == "":
+        return None
+    if kind.endswith("[]"):
+        return [stored(t, kind[:-2]) for t in text.split(";")]
+    return {"long": int, "double": float, "boolean": lambda t: t == "true"}.get(kind, str)(text)
+
+def typed(value):
+    return [typed(v) for v in value] if isinstance(value, list) else (type(value), value)
+
+def test_columns_follow_the_upsert_parameters():
+    assert [n for n, _ in PHONELOG_COLUMNS] == PARAM_KEYS[1:]
+
+@pytest.mark.parametrize("value,cell", [
+    (65, "65"), (65.0, "65.0"), ("1", "1"), (0, "0"), (False, "false"), ("walking", "walking"),
+    (["a", "b"], "a;b"), ([1, None, 2], "1;2"), ("", ""), (None, None),
+])
+def test_cells_keep_the_value_type(value, cell):
+    assert _cell(value) == cell
+
+def test_export_deduplicates_and_writes_import_files(tmp_path):
+    write_wal(tmp_path / "wal")
+    out = tmp_path / "import"
+    report = export(str(tmp_path / "wal"), str(out), workers=1, partitions=2, levels=[60])
+    assert (report["segments"], report["input_points"], report["points"], report["duplicates"], report["dropped"]) == \
+        (3, 4, 3, 1, 1)
+    assert (report["users"], report["devices"]) == (2, 2)
+    assert report["fallback"] == {"speed": 1, "deferred": 1, "battery_level": 1, "motion": 1}
+    groups = report["fallback_groups"]
+    assert sorted(groups.values(), key=len) == [
+        {"motion": "string"}, {"speed": "long", "battery_level": "string", "deferred": "boolean"}]
+
+    header = read_csv(out / "phonelog-header.csv")[0]
+    assert header == HEADERS["phonelog"]
+    rows = exported_rows(out, groups)
+    assert len(rows) == 3
+    first = next(r for r in rows.values() if r["device_id"] == "d1" and r["epoch_millis"] == "1700000000000")
+    assert (first["speed"], first["deferred"], first["created_at"]) == ("2", "true", "2000")  # last copy wins
+    assert first["loc"] == "{latitude:35.5,longitude:-80.0}"
+    assert first["coordinates"] == "-80.0;35.5" and first["battery_level"] == "high"  # as replay stores them
+    assert first["normalized"] == "true" and first["schema_version"] == "1"
+    text = "".join(f.read_text(encoding="utf-8") for f in out.glob("phonelog-*p0*.csv"))
+    assert ',"",' in text and ",," in text  # "" is an empty string, an empty field no property
+
+    assert sorted(r[1] for f in out.glob("by_user-p*.csv") for r in read_csv(f)) == ["u1", "u1", "u2"]
+    assert sorted(r[0] for r in read_csv(out / "device.csv")) == ["d1", "d2"]
+    buckets = [r for f in out.glob("trackbucket-p*.csv") for r in read_csv(f)]
+    assert report["track_buckets"] == len(buckets) == 3
+    assert "--nodes=PhoneLog=" + str(out.resolve()) + "/phonelog-header.csv" in report["command"]
+    for group in groups:
+        assert f"--nodes=PhoneLog={out.resolve()}/phonelog-{group}-header.csv,{out.resolve()}/phonelog-{group}-p.*" \
+            in report["command"]
+    assert not (out / ".parts").exists()
+
+@pytest.mark.parametrize("value,kind", [
+    ("high", "string"), (1.5, "double"), (True, "boolean"), (["a", "b"], "string[]"), ([1, None], "long[]"),
+    ({"a": 1}, None), ([1, "a"], None), ([[1]], None),
+])
+def test_fallback_column_type_is_the_stored_type(value, kind):
+    assert _value_kind(value) == kind
+
+def test_values_neo4j_cannot_store_stop_the_export(tmp_path):
+    w = WalWriter(str(tmp_path / "wal"), rotate_bytes=10_000_000, max_latency_ms=0)
+    w.write({"received_at": 1, "payload": {"user_id": "u1", "device_id": "d1", "locations": [
+        feature(1_700_000_000_000, activity={"type": "walking"})]}})
+    w.close()
+    with pytest.raises(ValueError, match="activity"):
+        export(str(tmp_path / "wal"), str(tmp_path / "import"), workers=1, partitions=1, levels=[])
+
+def test_export_stores_what_replay_stores(tmp_path, drivers):
+    upserted = {}
+    def capture(query, params):
+        if query == UPSERT_BATCH_CYPHER:
+            upserted.update((r["uid"], r) for r in params["rows"])
+            return [{"n": len(params["rows"])}]
+        return []
+    drivers[0].responder = capture
+    w = WalWriter(str(tmp_path / "wal"), rotate_bytes=1, max_latency_ms=0)
+    for i, props in enumerate([
+            dict(speed=2, battery_level=0.5, deferred=1, pauses=0, motion="walking", wifi="1", altitude=10),
+            dict(speed=2.5, battery_level="high", deferred=True, pauses=False, motion=["a", "b"], wifi=1),
+            dict(speed="3", battery_level=80, desired_accuracy=-1.5, significant_change=True, activity=7)]):
+        w.write({"received_at": 1000 + i, "payload": {"user_id": "u1", "device_id": "d1",
+                                                      "locations": [feature(1_700_000_000_000 + i * 1000, **props)]}})
+    w.close()
+    for e in segments(str(tmp_path / "wal")):
+        assert replay_file(tmp_path / "wal" / e["segment"], {})["error"] is None
+    report = export(str(tmp_path / "wal"), str(tmp_path / "import"), workers=1, partitions=1, levels=[])
+    rows = exported_rows(tmp_path / "import", report["fallback_groups"])
+
+    assert sorted(rows) == sorted(upserted) and len(rows) == 3
+    for uid, replayed in upserted.items():
+        kinds = dict(h.split(":", 1) for h in rows[uid]["types"][1:] if ":" in h)
+        for name, _ in PHONELOG_COLUMNS:
+            assert typed(stored(rows[uid][name], kinds[name])) == typed(replayed[name]), (uid, name)
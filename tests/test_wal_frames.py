@@ -0,0 +1,79 @@
+import asyncio, gzip, json
+import httpx
+import pytest
+from bench import fakedb
+from app import db
+from app.wal import WalWriter, Framed, segments, read_index, scan_segment
+from scripts.replay_wal import Filter, iter_events, iter_file_events, replay_file
+from scripts import replay_wal
+
+BODY = b'{\n  "user_id": "u1", "device_id": "d1",\n  "locations": [{"geometry": {"type": "Point", "coordinates": [-80.0, 35.0]},\n    "properties": {"timestamp": "2023-11-14T22:13:20Z"}}]\n}'
+
+def test_framed_and_json_records_share_a_segment(tmp_path):
+    w = WalWriter(str(tmp_path), rotate_bytes=10_000_000, block_records=2, max_latency_ms=0)
+    w.write({"received_at": 1, "payload": {"user_id": "old", "locations": []}})
+    w.write(Framed({"received_at": 2, "api": "v1", "content_type": "application/json", "rid": "r2"}, BODY, {"u1"}, {"d1"}))
+    w.write(Framed({"received_at": 3, "api": "v0", "content_type": None, "rid": "r3"}, b'{"lat": 1}'))
+    w.close()
+    entry = segments(str(tmp_path))[0]
+    seg = tmp_path / entry["segment"]
+    with gzip.open(seg, "rb") as fh:
+        assert BODY in fh.read()  # byte for byte, newlines included
+    events = [ev for _, _, ev in iter_file_events(seg)]
+    assert events[0] == {"received_at": 1, "payload": {"user_id": "old", "locations": []}}
+    assert events[1] == {"received_at": 2, "api": "v1", "content_type": "application/json", "rid": "r2",
+                         "payload": json.loads(BODY)}
+    assert events[2]["payload"] == {"lat": 1} and list(iter_events(str(tmp_path))) == events
+    blocks = read_index(seg)["blocks"]
+    assert [(b["first_line"], b["users"], b["devices"], b["opaque"]) for b in blocks] == \
+        [(1, ["old", "u1"], [None, "d1"], False), (3, [], [], True)]  # v0 owners are unknown
+    assert [ln for ln, _, _ in iter_file_events(seg, start_line=2, blocks=blocks)] == [3]
+    assert {k: entry[k] for k in ("records", "first_received_at", "last_received_at")} == \
+        {k: scan_segment(seg)[k] for k in ("records", "first_received_at", "last_received_at")}
+
+def test_truncated_frame_ends_the_segment(tmp_path):
+    path = tmp_path / "events-x.ndjson.gz"
+    with gzip.open(path, "wb") as fh:
+        fh.write(b'{"received_at": 1, "payload": null}\n')
+        fh.write(b'\x1e{"received_at":2,"len":100}\n{"user_id"')
+    assert [ev["received_at"] for _, _, ev in iter_file_events(path)] == [1]
+    assert scan_segment(path)["records"] == 1
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    from app import main
+    saved = db._driver, db._async_driver
+    monkeypatch.setattr(db, "_known_users", set())
+    monkeypatch.setattr(db, "_known_devices", set())
+    db.recent_uids.clear()
+    fakedb.install()
+    wal = WalWriter(str(tmp_path / "wal"), rotate_bytes=10_000_000, max_latency_ms=0)
+    monkeypatch.setattr(main, "wal", wal)
+    yield main, wal
+    wal.close()
+    db._driver, db._async_driver = saved
+    db.recent_uids.clear()
+
+def test_requests_are_logged_as_sent_and_replay(api, monkeypatch):
+    main, wal = api
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://t") as c:
+            r1 = await c.post("/api/v1/locations", content=BODY,
+                              headers={"content-type": "application/json", "x-request-id": "req-1"})
+            r0 = await c.post("/api/v0", content=b'{"lat": 35.0, "lon": -80.0}')
+            bad = await c.post("/api/v0", content=b"{nope")
+            return r1, r0, bad
+    r1, r0, bad = asyncio.run(go())
+    assert r1.status_code == 200 and r0.status_code == 200 and bad.status_code == 400
+    wal.close()
+    seg = wal.root / segments(str(wal.root))[0]["segment"]
+    events = [ev for _, _, ev in iter_file_events(seg)]
+    assert [(ev["api"], ev["rid"], ev["content_type"]) for ev in events] == \
+        [("v1", "req-1", "application/json"), ("v0", events[1]["rid"], None)]
+    assert events[0]["payload"] == json.loads(BODY) and events[1]["payload"] == {"lat": 35.0, "lon": -80.0}
+    assert read_index(seg)["blocks"][0]["users"] == ["u1"]
+
+    written = []
+    monkeypatch.setattr(replay_wal, "upsert_phonelog_batch", lambda recs, chunk_size=None: written.extend(recs))
+    replay_file(seg, {"filter": Filter(users=["u1"])})
+    assert [(r["user_id"], r["device_id"], r["epoch_millis"]) for r in written] == [("u1", "d1", 1700000000000)]
@@ -0,0 +1,58 @@
+import asyncio, gzip, json, pathlib, zlib
+import pytest
+from app.wal import WalWriter, segments
+
+def read_all(wal_dir):
+    out = []
+    for f in sorted(pathlib.Path(wal_dir).glob("events-*.ndjson.gz")):
+        with gzip.open(f, "rt", encoding="utf-8") as fh:
+            out.extend(json.loads(line) for line in fh if line.strip())
+    return out
+
+@pytest.mark.parametrize("durability", ["buffer", "flush", "fsync"])
+def test_group_commit_roundtrip(tmp_path, durability):
+    w = WalWriter(str(tmp_path), rotate_bytes=10_000_000, durability=durability, queue_size=8, max_latency_ms=1)
+    futs = [w.submit({"i": i}) for i in range(100)]
+    for f in futs:
+        f.result(timeout=5)
+    w.close()
+    assert [r["i"] for r in read_all(tmp_path)] == list(range(100))
+
+def test_flush_policy_is_readable_before_close(tmp_path):
+    w = WalWriter(str(tmp_path), rotate_bytes=10_000_000, durability="flush")
+    w.write({"a": 1})
+    data = next(tmp_path.glob("events-*.ndjson.gz")).read_bytes()
+    # the gzip member is still open, but the acked record must already be on disk
+    assert zlib.decompressobj(wbits=31).decompress(data) == b'{"a": 1}\n'
+    w.close()
+    assert read_all(tmp_path) == [{"a": 1}]
+
+def test_write_async_and_close_drains(tmp_path):
+    w = WalWriter(str(tmp_path), rotate_bytes=10_000_000, queue_size=2)
+
+    async def go():
+        await asyncio.gather(*(w.write_async({"i": i}) for i in range(20)))
+
+    asyncio.run(go())
+    w.close()
+    assert sorted(r["i"] for r in read_all(tmp_path)) == list(range(20))
+    with pytest.raises(RuntimeError):
+        w.submit({"late": True})
+
+def test_rejects_unknown_durability(tmp_path):
+    with pytest.raises(ValueError):
+        WalWriter(str(tmp_path), rotate_bytes=1, durability="sometimes")
+
+def test_workers_get_own_segments_and_manifest(tmp_path):
+    a = WalWriter(str(tmp_path), rotate_bytes=200, worker_id="w1", max_latency_ms=0)
+    b = WalWriter(str(tmp_path), rotate_bytes=200, worker_id="w2", max_latency_ms=0)
+    for i in range(60):
+        (a if i % 2 else b).write({"received_at": 1000 + i, "i": i})
+    a.close(); b.close()
+    entries = segments(str(tmp_path))
+    names = [e["segment"] for e in entries]
+    assert len(names) == len(set(names)) > 2
+    assert {e["worker"] for e in entries} == {"w1", "w2"}
+    assert sum(e["records"] for e in entries) == 60
+    assert min(e["first_received_at"] for e in entries) == 1000
+    assert sorted(r["i"] for r in read_all(tmp_path)) == list(range(60))
@@ -0,0 +1,43 @@
+import asyncio, gzip, json, os
+import httpx
+from app import db, worker
+from app.wal import WalWriter, segments
+
+def test_forked_worker_writes_its_own_wal_segments(tmp_path):
+    w = WalWriter(str(tmp_path), rotate_bytes=10_000_000, max_latency_ms=0)
+    worker.on_fork(w.after_fork)
+    try:
+        w.write({"received_at": 1, "who": "parent"})
+        pid = os.fork()
+        if pid == 0:
+            try:
+                worker.post_fork()
+                w.write({"received_at": 2, "who": "child"})
+                w.close()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        w.write({"received_at": 3, "who": "parent"})
+        w.close()
+    finally:
+        worker._hooks.remove(w.after_fork)
+    by_worker = {}
+    for e in segments(str(tmp_path)):
+        with gzip.open(tmp_path / e["segment"], "rt") as fh:
+            by_worker.setdefault(e["worker"], []).extend(json.loads(l)["who"] for l in fh)
+    assert by_worker == {f"p{os.getpid()}": ["parent", "parent"], f"p{pid}": ["child"]}
+
+def test_after_fork_drops_inherited_drivers_and_health_reports_the_worker():
+    saved = db._driver, db._async_driver
+    db._driver, db._async_driver = object(), object()
+    try:
+        worker.post_fork()
+        assert db._driver is None and db._async_driver is None
+    finally:
+        db._driver, db._async_driver = saved
+    from app.main import app
+    async def go():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://t") as c:
+            return (await c.get("/healthz")).json()
+    body = asyncio.run(go())
+    assert body["status"] == "ok" and body["worker"]["pid"] == os.getpid()
@@ -0,0 +1,110 @@
+import asyncio
+from app.writebehind import WriteBehind
+
+def recs(start, n):
+    return [{"uid": f"u{i}", "epoch_millis": i} for i in range(start, start + n)]
+
+class FlakyDb:
+    def __init__(self, failures=0):
+        self.failures, self.written, self.batches = failures, [], []
+    async def __call__(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("unavailable")
+        self.batches.append(len(rows))
+        self.written.extend(r["uid"] for r in rows)
+        return [r["uid"] for r in rows]
+
+async def settle(wb, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while wb.pending() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+def test_retries_until_written(tmp_path):
+    db = FlakyDb(failures=3)
+    async def go():
+        wb = WriteBehind(db, str(tmp_path), batch_size=10, base_backoff_s=0.001, max_backoff_s=0.01)
+        wb.start()
+        wb.offer(recs(0, 25))
+        await settle(wb)
+        await wb.stop()
+    asyncio.run(go())
+    assert sorted(db.written) == sorted(r["uid"] for r in recs(0, 25))
+    assert max(db.batches) <= 10
+
+def test_overflow_spills_and_drains(tmp_path):
+    db = FlakyDb()
+    async def go():
+        wb = WriteBehind(db, str(tmp_path), queue_points=10, high_water=25, batch_size=10)
+        wb.offer(recs(0, 10))
+        wb.offer(recs(10, 10))  # over queue_points: spilled
+        assert len(list(tmp_path.glob("spill-*.ndjson"))) == 1
+        wb.offer(recs(20, 10))
+        assert wb.overloaded()
+        wb.start()
+        await settle(wb)
+        assert not wb.overloaded()
+        await wb.stop()
+    asyncio.run(go())
+    assert sorted(db.written) == sorted(r["uid"] for r in recs(0, 30))
+    assert not list(tmp_path.iterdir())
+
+def test_stop_spills_and_restart_drains(tmp_path):
+    db = FlakyDb()
+    async def first():
+        wb = WriteBehind(db, str(tmp_path))
+        wb.offer(recs(0, 5))
+        await wb.stop()  # never started
+    asyncio.run(first())
+    assert db.written == [] and len(list(tmp_path.glob("spill-*.ndjson"))) == 1
+    async def second():
+        wb = WriteBehind(db, str(tmp_path))
+        wb.start()
+        for _ in range(200):
+            if len(db.written) == 5:
+                break
+            await asyncio.sleep(0.01)
+        await wb.stop()
+    asyncio.run(second())
+    assert sorted(db.written) == sorted(r["uid"] for r in recs(0, 5))
+
+class CountingBreaker:
+    """Allows every call and checks that each allowed call is recorded exactly once."""
+    def __init__(self):
+        self.allowed, self.recorded = 0, []
+    def allow(self):
+        assert self.allowed == len(self.recorded)
+        self.allowed += 1
+        return True
+    def retry_in(self):
+        return 0.0
+    def record(self, ok, seconds):
+        self.recorded.append(ok)
+
+def test_one_breaker_record_per_attempt(tmp_path):
+    db, breaker = FlakyDb(failures=2), CountingBreaker()
+    async def go():
+        wb = WriteBehind(db, str(tmp_path), batch_size=10, base_backoff_s=0.001, breaker=breaker)
+        wb.start()
+        wb.offer(recs(0, 25))
+        await settle(wb)
+        await wb.stop()
+    asyncio.run(go())
+    assert breaker.recorded == [False, False, True, True, True]  # 2 failed attempts, then 3 chunks
+
+def test_spilled_points_drained_elsewhere_are_no_longer_pending(tmp_path):
+    async def go():
+        a = WriteBehind(FlakyDb(), str(tmp_path), queue_points=0)
+        a.offer(recs(0, 7))
+        a.offer(recs(7, 3))
+        assert a.pending() == 10
+        b = WriteBehind(FlakyDb(), str(tmp_path))  # another worker drains the files
+        b.start()
+        for _ in range(200):
+            if not list(tmp_path.iterdir()):
+                break
+            await asyncio.sleep(0.01)
+        await b.stop()
+        a._reconcile()
+        assert a.pending() == 0
+    asyncio.run(go())